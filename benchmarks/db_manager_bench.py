@@ -0,0 +1,110 @@
+"""
+Benchmark: requests/sec of the sync DBManager (pg8000 + QueuePool, run in a thread pool the way
+FastAPI runs blocking calls) against AsyncDBManager (asyncpg pool awaited on the event loop).
+
+Runs against a local Postgres initialized with src/init_db.py. Creates a scratch user with
+random document embeddings, then issues the same mix of requests from N concurrent clients:
+a user context refresh, a document page and a top-k vector search with a precomputed embedding.
+The scratch user and its documents are deleted afterwards.
+
+Usage:
+    DB_HOST=localhost DB_PORT=5432 DB_USER=postgres DB_NAME=bench DB_SSL_CA= AIVEN_PASSWORD=postgres \\
+        python benchmarks/db_manager_bench.py [concurrency] [requests] [documents]
+    e.g. python benchmarks/db_manager_bench.py 1,8,32 2000 1000
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import asyncio
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.db_manager import DBManager
+from src.async_db_manager import AsyncDBManager
+
+BENCH_EMAIL = "db-manager-bench@example.com"
+DIMENSIONS = 384
+# Starlette's default thread pool size for blocking endpoints
+THREADPOOL_SIZE = 40
+
+def random_embedding(rng: np.random.Generator) -> np.ndarray:
+    embedding = rng.standard_normal(DIMENSIONS).astype(np.float32)
+    return embedding / np.linalg.norm(embedding)
+
+async def load(manager: AsyncDBManager, num_documents: int, rng: np.random.Generator) -> None:
+    pool = await manager.connect()
+    await pool.execute("DELETE FROM users WHERE email = $1;", BENCH_EMAIL)
+    await manager.insert_new_user("bench", BENCH_EMAIL, "refresh-token", "1")
+    user_id = await manager._get_user_id(BENCH_EMAIL)
+    await pool.executemany(
+        "INSERT INTO documents (user_id, document_name, embedding, content) VALUES ($1, $2, $3, $4);",
+        [(user_id, f"doc {i:06d}", random_embedding(rng), "x" * 500) for i in range(num_documents)]
+    )
+
+def sync_request(manager: DBManager, embedding: np.ndarray) -> None:
+    manager.get_user_context(BENCH_EMAIL, refresh=True)
+    manager.get_documents(BENCH_EMAIL, limit=10, offset=0)
+    manager.get_top_k_results("", 3, BENCH_EMAIL, query_embedding=embedding)
+
+async def async_request(manager: AsyncDBManager, embedding: np.ndarray) -> None:
+    await manager.get_user_context(BENCH_EMAIL, refresh=True)
+    await manager.get_documents(BENCH_EMAIL, limit=10, offset=0)
+    await manager.get_top_k_results("", 3, BENCH_EMAIL, query_embedding=embedding)
+
+async def run_sync(manager: DBManager, executor: ThreadPoolExecutor, embeddings: list, concurrency: int) -> float:
+    loop = asyncio.get_running_loop()
+    queue = iter(embeddings)
+
+    async def client():
+        for embedding in queue:
+            await loop.run_in_executor(executor, sync_request, manager, embedding)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return len(embeddings) / (time.perf_counter() - start)
+
+async def run_async(manager: AsyncDBManager, embeddings: list, concurrency: int) -> float:
+    queue = iter(embeddings)
+
+    async def client():
+        for embedding in queue:
+            await async_request(manager, embedding)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return len(embeddings) / (time.perf_counter() - start)
+
+async def main():
+    concurrency_levels = [int(level) for level in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1, 8, 32]
+    num_requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    num_documents = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+
+    rng = np.random.default_rng(0)
+    sync_manager = DBManager()
+    async_manager = AsyncDBManager(
+        embedding_model=sync_manager.embedding_model,
+        embedding_cache=sync_manager.embedding_cache
+    )
+    executor = ThreadPoolExecutor(max_workers=THREADPOOL_SIZE)
+    try:
+        await load(async_manager, num_documents, rng)
+        embeddings = [random_embedding(rng) for _ in range(num_requests)]
+        # Warm both pools and the prepared statement caches
+        await run_sync(sync_manager, executor, embeddings[:50], 8)
+        await run_async(async_manager, embeddings[:50], 8)
+
+        print(f"{num_requests} requests, {num_documents} documents")
+        for concurrency in concurrency_levels:
+            sync_rps = await run_sync(sync_manager, executor, embeddings, concurrency)
+            async_rps = await run_async(async_manager, embeddings, concurrency)
+            print(f"  concurrency={concurrency:<4} sync={sync_rps:8.1f} req/s  async={async_rps:8.1f} req/s  ({async_rps / sync_rps:.2f}x)")
+    finally:
+        pool = await async_manager.connect()
+        await pool.execute("DELETE FROM users WHERE email = $1;", BENCH_EMAIL)
+        await async_manager.close()
+        executor.shutdown()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,157 @@
+"""
+Benchmark: HTTP round trips per email when fetching new messages.
+
+Starts a local fake Gmail server, points a Gmail service built from the static
+discovery document at it, and compares the old one-request-per-message fetch
+with the batched fetch used by get_unprocessed_emails.
+
+Usage:
+    python benchmarks/gmail_batch_bench.py [num_messages] [batch_size] [latency_ms]
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+import httplib2
+import threading
+import base64
+import json
+import time
+import sys
+import os
+import re
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# db_manager reads this at import time, no database connection is made here
+os.environ.setdefault("AIVEN_PASSWORD", "")
+
+from src.mail import _get_new_message_ids, _fetch_messages, _parse_message
+
+class FakeGmail(BaseHTTPRequestHandler):
+    """
+    Serves just enough of the Gmail API for history.list, messages.get and the batch endpoint.
+    """
+    num_messages = 0
+    latency = 0.0
+    round_trips = 0
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    @classmethod
+    def message(cls, msg_id: str) -> dict:
+        body = base64.urlsafe_b64encode(f"Body of message {msg_id}".encode()).decode()
+        return {
+            "id": msg_id,
+            "threadId": f"thread-{msg_id}",
+            "historyId": str(1000 + int(msg_id[1:])),
+            "payload": {
+                "headers": [{"name": "Subject", "value": f"Subject {msg_id}"}, {"name": "From", "value": "a@example.com"}],
+                "body": {"data": body},
+            },
+        }
+
+    def handle_get(self, path: str) -> tuple[int, dict]:
+        if "/history" in path:
+            records = [
+                {"id": str(1000 + i), "messagesAdded": [{"message": {"id": f"m{i}", "labelIds": ["INBOX"]}}]}
+                for i in range(self.num_messages)
+            ]
+            return 200, {"history": records, "historyId": str(1000 + self.num_messages)}
+
+        match = re.search(r"/messages/([^/?]+)", path)
+        if match:
+            return 200, self.message(match.group(1))
+        return 404, {"error": {"code": 404, "message": "Not found"}}
+
+    def count_round_trip(self):
+        time.sleep(self.latency)
+        with self.lock:
+            FakeGmail.round_trips += 1
+
+    def send_json(self, status: int, payload: dict):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self.count_round_trip()
+        self.send_json(*self.handle_get(self.path))
+
+    def do_POST(self):
+        self.count_round_trip()
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length).decode()
+        boundary = self.headers.get_content_type() and self.headers.get_param("boundary")
+
+        parts = []
+        for part in raw.split(f"--{boundary}"):
+            content_id = re.search(r"Content-ID: <([^>]+)>", part)
+            request_line = re.search(r"^(GET|POST) (\S+) HTTP/1.1", part, re.MULTILINE)
+            if not content_id or not request_line:
+                continue
+            status, payload = self.handle_get(request_line.group(2))
+            parts.append(
+                f"--batch_response\r\n"
+                f"Content-Type: application/http\r\n"
+                f"Content-ID: <response-{content_id.group(1)}>\r\n\r\n"
+                f"HTTP/1.1 {status} OK\r\n"
+                f"Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(payload)}\r\n"
+            )
+
+        data = ("".join(parts) + "--batch_response--\r\n").encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/mixed; boundary=batch_response")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def fetch_one_by_one(service, message_ids: list[str]) -> list[dict]:
+    """
+    The previous fetch path: one messages.get round trip per message.
+    """
+    return [
+        service.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        for msg_id in message_ids
+    ]
+
+def run(label: str, service, fetch) -> None:
+    FakeGmail.round_trips = 0
+    start = time.perf_counter()
+    message_ids = list(_get_new_message_ids(service, "1000"))
+    emails = [_parse_message(message) for message in fetch(service, message_ids)]
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"{label:<12} emails={len(emails):<5} round_trips={FakeGmail.round_trips:<5} "
+        f"round_trips/email={FakeGmail.round_trips / max(len(emails), 1):.3f} "
+        f"wall={elapsed * 1000:.1f}ms"
+    )
+
+def main():
+    num_messages = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    latency_ms = float(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    FakeGmail.num_messages = num_messages
+    FakeGmail.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGmail)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # The batch URI is derived from rootUrl, so point the whole document at the fake server
+    discovery_doc = json.loads(get_static_doc("gmail", "v1"))
+    discovery_doc["rootUrl"] = f"http://127.0.0.1:{server.server_address[1]}/"
+    service = build_from_document(discovery_doc, http=httplib2.Http())
+
+    print(f"messages={num_messages} batch_size={batch_size} simulated_latency={latency_ms}ms")
+    run("sequential", service, fetch_one_by_one)
+    run("batched", service, lambda svc, ids: _fetch_messages(svc, ids, batch_size)[0])
+
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Benchmark: cost of obtaining a Gmail service per processed email.
+
+Compares googleapiclient.discovery.build() on every call with the per-user
+service cache built from the preloaded discovery document. No network calls are made.
+
+Usage:
+    python benchmarks/gmail_service_bench.py [iterations]
+"""
+from googleapiclient.discovery import build
+from google.oauth2.credentials import Credentials
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+from src.gmail_service import GmailServiceCache
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    creds = Credentials(token="fake-access-token")
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        build('gmail', 'v1', credentials=creds)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    cache = GmailServiceCache()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        cache.get("user@example.com", creds)
+    cache_ms = (time.perf_counter() - start) * 1000
+
+    print(f"iterations={iterations}")
+    print(f"build() per call     total={build_ms:.1f}ms per_call={build_ms / iterations:.3f}ms")
+    print(f"cached service       total={cache_ms:.1f}ms per_call={cache_ms / iterations:.3f}ms")
+    for name, timer in metrics.snapshot()["timers"].items():
+        print(f"{name:<32} count={timer['count']:<5} avg={timer['avg_ms']:.3f}ms max={timer['max_ms']:.3f}ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+Benchmark: CPU time and parameter size of the ways an embedding is sent to Postgres.
+
+Compares the original str(embedding.tolist()) literal, the float32 text literal used with pg8000,
+and pgvector's binary format used with asyncpg. Bytes are per vector as sent on the wire, and the
+original query sent its literal twice. No database is needed.
+
+Usage:
+    python benchmarks/vector_encoding_bench.py [dimensions] [iterations]
+"""
+import numpy as np
+import timeit
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.vector_codec import encode_vector, to_vector_literal
+
+def main():
+    dimensions = int(sys.argv[1]) if len(sys.argv) > 1 else 384
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    embedding = np.random.default_rng(0).standard_normal(dimensions).astype(np.float32)
+    embedding /= np.linalg.norm(embedding)
+
+    encodings = {
+        "str(tolist())": lambda: str(embedding.tolist()),
+        "float32 literal": lambda: to_vector_literal(embedding),
+        "binary": lambda: encode_vector(embedding),
+    }
+    print(f"{dimensions}-dim embedding, {iterations} iterations")
+    for label, encode in encodings.items():
+        size = len(encode())
+        seconds = timeit.timeit(encode, number=iterations) / iterations
+        print(f"  {label:<16} {size:6d} bytes  {seconds * 1e6:7.1f}us per vector")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark: recall vs. latency of the HNSW index for per-user top-k search.
+
+Creates a scratch table in DATABASE_URL (a local Postgres with pgvector), loads N random
+384-dim embeddings for one user plus the same number for a second user, and compares an exact
+scan against HNSW search at several hnsw.ef_search values. Recall@k is measured against the
+exact results. The scratch table is dropped afterwards.
+
+Usage:
+    DATABASE_URL=postgresql://localhost/bench python benchmarks/vector_index_bench.py [sizes] [queries] [k]
+    e.g. python benchmarks/vector_index_bench.py 1000,10000,100000 50 3
+"""
+import statistics
+import asyncio
+import asyncpg
+import random
+import time
+import sys
+import os
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+EF_SEARCH_VALUES = [10, 20, 40, 80, 160]
+DIMENSIONS = 384
+
+def random_vector() -> str:
+    return "[" + ",".join(f"{random.gauss(0, 1):.6f}" for _ in range(DIMENSIONS)) + "]"
+
+async def load(conn: asyncpg.Connection, size: int) -> None:
+    await conn.execute("DROP TABLE IF EXISTS bench_documents;")
+    await conn.execute(f"""
+        CREATE TABLE bench_documents (
+            doc_id SERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            embedding vector({DIMENSIONS})
+        );
+    """)
+    # Generated server side, the correlated reference to g forces a new vector per row
+    await conn.execute(f"""
+        INSERT INTO bench_documents (user_id, embedding)
+        SELECT 1 + (g % 2), (SELECT array_agg(random() - 0.5 + g * 0) FROM generate_series(1, {DIMENSIONS}))::vector
+        FROM generate_series(1, $1) g;
+    """, size * 2)
+    await conn.execute("CREATE INDEX ON bench_documents(user_id);")
+    start = time.perf_counter()
+    await conn.execute("""
+        CREATE INDEX ON bench_documents USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+    """)
+    print(f"  index build: {time.perf_counter() - start:.1f}s")
+    await conn.execute("ANALYZE bench_documents;")
+
+async def search(conn: asyncpg.Connection, query: str, k: int, exact: bool, ef_search: int = 40) -> tuple[list[int], float]:
+    async with conn.transaction():
+        if exact:
+            await conn.execute("SET LOCAL enable_indexscan = off;")
+        else:
+            await conn.execute("SELECT set_config('hnsw.ef_search', $1, true);", str(ef_search))
+        start = time.perf_counter()
+        rows = await conn.fetch("""
+            SELECT doc_id FROM bench_documents
+            WHERE user_id = 1
+            ORDER BY embedding <=> $1::text::vector
+            LIMIT $2;
+        """, query, k)
+        return [row["doc_id"] for row in rows], time.perf_counter() - start
+
+def report(label: str, latencies: list[float], recall: float = None) -> None:
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    p95 = latencies_ms[int(len(latencies_ms) * 0.95) - 1] if len(latencies_ms) >= 20 else max(latencies_ms)
+    recall_str = f"recall@k={recall:.3f}" if recall is not None else "recall@k=1.000 (ground truth)"
+    print(f"  {label:<16} p50={statistics.median(latencies_ms):7.2f}ms p95={p95:7.2f}ms {recall_str}")
+
+async def main():
+    sizes = [int(size) for size in sys.argv[1].split(",")] if len(sys.argv) > 1 else [1000, 10000, 100000]
+    num_queries = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    conn = await asyncpg.connect(DATABASE_URL)
+    await conn.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    try:
+        for size in sizes:
+            print(f"documents per user: {size}")
+            await load(conn, size)
+            queries = [random_vector() for _ in range(num_queries)]
+
+            ground_truth, exact_latencies = [], []
+            for query in queries:
+                ids, latency = await search(conn, query, k, exact=True)
+                ground_truth.append(set(ids))
+                exact_latencies.append(latency)
+            report("exact", exact_latencies)
+
+            for ef_search in EF_SEARCH_VALUES:
+                latencies, hits = [], 0
+                for query, expected in zip(queries, ground_truth):
+                    ids, latency = await search(conn, query, k, exact=False, ef_search=ef_search)
+                    hits += len(expected.intersection(ids))
+                    latencies.append(latency)
+                report(f"hnsw ef={ef_search}", latencies, hits / (k * num_queries))
+    finally:
+        await conn.execute("DROP TABLE IF EXISTS bench_documents;")
+        await conn.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
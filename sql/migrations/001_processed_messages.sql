@@ -0,0 +1,15 @@
+-- Adds the processed message ledger to an existing database, see schema.sql
+CREATE TABLE IF NOT EXISTS processed_messages (
+    user_id INTEGER NOT NULL,
+    message_id VARCHAR(255) NOT NULL,
+    retrieved_doc_ids INTEGER[],
+    draft_id VARCHAR(255),
+    draft_claimed_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (user_id, message_id),
+    CONSTRAINT fk_user
+        FOREIGN KEY(user_id)
+        REFERENCES users(user_id)
+        ON DELETE CASCADE
+);
@@ -0,0 +1,5 @@
+-- Approximate nearest neighbour index for cosine similarity search over documents.
+-- m and ef_construction are the pgvector defaults; ef_search is tuned per query, see VECTOR_SEARCH_EF_SEARCH.
+CREATE INDEX IF NOT EXISTS idx_documents_embedding_hnsw
+    ON documents USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
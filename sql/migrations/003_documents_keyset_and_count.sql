@@ -0,0 +1,38 @@
+-- Supports keyset pagination of a user's documents ordered by (document_name, doc_id)
+CREATE INDEX IF NOT EXISTS idx_documents_user_name_id ON documents(user_id, document_name, doc_id);
+
+-- Per-user document count maintained by statement-level triggers, so listing totals don't need count(*)
+ALTER TABLE users ADD COLUMN IF NOT EXISTS document_count INTEGER NOT NULL DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION increment_document_count() RETURNS trigger AS $$
+BEGIN
+    UPDATE users u SET document_count = u.document_count + n.added
+    FROM (SELECT user_id, count(*) AS added FROM new_documents GROUP BY user_id) n
+    WHERE u.user_id = n.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION decrement_document_count() RETURNS trigger AS $$
+BEGIN
+    UPDATE users u SET document_count = u.document_count - o.removed
+    FROM (SELECT user_id, count(*) AS removed FROM old_documents GROUP BY user_id) o
+    WHERE u.user_id = o.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS documents_count_insert ON documents;
+CREATE TRIGGER documents_count_insert
+    AFTER INSERT ON documents
+    REFERENCING NEW TABLE AS new_documents
+    FOR EACH STATEMENT EXECUTE FUNCTION increment_document_count();
+
+DROP TRIGGER IF EXISTS documents_count_delete ON documents;
+CREATE TRIGGER documents_count_delete
+    AFTER DELETE ON documents
+    REFERENCING OLD TABLE AS old_documents
+    FOR EACH STATEMENT EXECUTE FUNCTION decrement_document_count();
+
+-- Backfill, also corrects any drift when the migration is re-run
+UPDATE users u SET document_count = (SELECT count(*) FROM documents d WHERE d.user_id = u.user_id);
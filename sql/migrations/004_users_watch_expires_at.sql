@@ -0,0 +1,5 @@
+-- Expiration returned by Gmail's watch(), renewal runs only select users whose watch expires soon.
+-- Users without a recorded watch are '-infinity' so they are always due, and the range scan needs no IS NULL branch.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS watch_expires_at TIMESTAMPTZ NOT NULL DEFAULT '-infinity';
+-- Renewal runs page through due users on (watch_expires_at, user_id)
+CREATE INDEX IF NOT EXISTS idx_users_watch_expires_at_id ON users(watch_expires_at, user_id);
@@ -0,0 +1,2 @@
+-- Supports pruning old ledger entries, see PROCESSED_MESSAGE_RETENTION_DAYS
+CREATE INDEX IF NOT EXISTS idx_processed_messages_created_at ON processed_messages(created_at);
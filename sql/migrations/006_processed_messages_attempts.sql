@@ -0,0 +1,2 @@
+-- Counts drafting attempts per message, so a message that keeps failing stops holding back the history marker
+ALTER TABLE processed_messages ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
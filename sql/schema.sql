@@ -1,4 +1,5 @@
 -- PostgreSQL Schema for the User and Document Tables
+DROP TABLE IF EXISTS processed_messages CASCADE;
 DROP TABLE IF EXISTS documents CASCADE;
 DROP TABLE IF EXISTS users CASCADE;
 
@@ -12,9 +13,16 @@ CREATE TABLE users (
     email VARCHAR(255) UNIQUE NOT NULL,
     history_id VARCHAR(255) UNIQUE,
     -- Store the ENCRYPTED refresh token, never plain text.
-    encrypted_refresh_token TEXT
+    encrypted_refresh_token TEXT,
+    -- Maintained by the documents_count_* triggers below
+    document_count INTEGER NOT NULL DEFAULT 0,
+    -- Expiration returned by Gmail's watch(), '-infinity' until a watch is recorded so the user is always due
+    watch_expires_at TIMESTAMPTZ NOT NULL DEFAULT '-infinity'
 );
 
+-- Renewal runs range scan the users whose watch expires soonest, keyset paginated on (watch_expires_at, user_id)
+CREATE INDEX IF NOT EXISTS idx_users_watch_expires_at_id ON users(watch_expires_at, user_id);
+
 --Operators for calculating similarity
     -- <-> - Euclidean distance (L2 distance)
     -- <#> - negative inner product
@@ -36,3 +44,64 @@ CREATE TABLE documents (
 
 -- Create an index on the user_id in the document table for faster lookups of documents by user.
 CREATE INDEX IF NOT EXISTS idx_document_user_id ON documents(user_id);
+
+-- Supports keyset pagination of a user's documents ordered by (document_name, doc_id)
+CREATE INDEX IF NOT EXISTS idx_documents_user_name_id ON documents(user_id, document_name, doc_id);
+
+-- Keep users.document_count in step with the documents table. Statement-level triggers update
+-- each user once per statement, so a bulk insert doesn't rewrite the user row once per document.
+CREATE OR REPLACE FUNCTION increment_document_count() RETURNS trigger AS $$
+BEGIN
+    UPDATE users u SET document_count = u.document_count + n.added
+    FROM (SELECT user_id, count(*) AS added FROM new_documents GROUP BY user_id) n
+    WHERE u.user_id = n.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION decrement_document_count() RETURNS trigger AS $$
+BEGIN
+    UPDATE users u SET document_count = u.document_count - o.removed
+    FROM (SELECT user_id, count(*) AS removed FROM old_documents GROUP BY user_id) o
+    WHERE u.user_id = o.user_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER documents_count_insert
+    AFTER INSERT ON documents
+    REFERENCING NEW TABLE AS new_documents
+    FOR EACH STATEMENT EXECUTE FUNCTION increment_document_count();
+
+CREATE TRIGGER documents_count_delete
+    AFTER DELETE ON documents
+    REFERENCING OLD TABLE AS old_documents
+    FOR EACH STATEMENT EXECUTE FUNCTION decrement_document_count();
+
+-- HNSW index for approximate cosine similarity search (<=>) over document embeddings.
+CREATE INDEX IF NOT EXISTS idx_documents_embedding_hnsw
+    ON documents USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
+
+-- Ledger of Gmail messages already handled by /processEmails, so Pub/Sub redeliveries and
+-- retries reuse the earlier retrieval and never create a second draft for the same message.
+CREATE TABLE processed_messages (
+    user_id INTEGER NOT NULL,
+    message_id VARCHAR(255) NOT NULL,
+    retrieved_doc_ids INTEGER[],
+    draft_id VARCHAR(255),
+    -- Set while a delivery is generating the draft, stale claims can be taken over
+    draft_claimed_at TIMESTAMPTZ,
+    -- Claims granted so far, a message still without a draft after MAX_DRAFT_ATTEMPTS is dead-lettered
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+
+    PRIMARY KEY (user_id, message_id),
+    CONSTRAINT fk_user
+        FOREIGN KEY(user_id)
+        REFERENCES users(user_id)
+        ON DELETE CASCADE
+);
+
+-- Entries older than PROCESSED_MESSAGE_RETENTION_DAYS are pruned by /tasks/prune-processed-messages
+CREATE INDEX IF NOT EXISTS idx_processed_messages_created_at ON processed_messages(created_at);
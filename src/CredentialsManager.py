@@ -2,41 +2,136 @@ import json
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from functools import partial
+import threading
+import hashlib
+import os
 
-from .dependencies import CLIENT_SECRETS
+from . import metrics
+
+# Cached access tokens are refreshed once they are this close to expiring (they live about an hour)
+ACCESS_TOKEN_REFRESH_MARGIN_SECONDS = int(os.environ.get("ACCESS_TOKEN_REFRESH_MARGIN_SECONDS", 300))
+ACCESS_TOKEN_CACHE_SIZE = int(os.environ.get("ACCESS_TOKEN_CACHE_SIZE", 10000))
+
+class _AccessTokenEntry:
+    def __init__(self):
+        # Held while refreshing, so concurrent requests for the same user wait for one refresh
+        self.lock = threading.Lock()
+        self.creds: Credentials = None
+        self.source_refresh_token: str = None
+
+class AccessTokenCache:
+    """
+    Process-wide cache of refreshed Credentials per user, so an access token is reused until it
+    nears expiry instead of being refreshed for every webhook.
+    """
+
+    def __init__(self, max_entries: int = ACCESS_TOKEN_CACHE_SIZE, margin_seconds: int = ACCESS_TOKEN_REFRESH_MARGIN_SECONDS):
+        self.max_entries = max_entries
+        self.margin = timedelta(seconds=margin_seconds)
+        self._entries: OrderedDict[str, _AccessTokenEntry] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, key: str) -> _AccessTokenEntry:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _AccessTokenEntry()
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            self._entries.move_to_end(key)
+            return entry
+
+    def _is_fresh(self, creds: Credentials) -> bool:
+        # google-auth keeps expiry as a naive UTC datetime
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        return bool(creds.token) and creds.expiry is not None and creds.expiry - now > self.margin
+
+    def get(self, key: str, refresh_token: str, build, on_rotated=None) -> Credentials:
+        """
+        Returns credentials for key with an access token valid for at least the refresh margin.
+        build(refresh_token) creates unrefreshed Credentials. If Google rotates the refresh token,
+        on_rotated(new_refresh_token) is called so it can be persisted.
+        """
+        entry = self._entry(key)
+        with entry.lock:
+            creds = entry.creds
+            # A refresh token we didn't start from or rotate to means the user logged in again
+            known = creds is not None and refresh_token in (entry.source_refresh_token, creds.refresh_token)
+            if known and self._is_fresh(creds):
+                metrics.incr("credentials.cache_hit")
+                return creds
+
+            if not known:
+                creds = entry.creds = build(refresh_token)
+                entry.source_refresh_token = refresh_token
+            previous_refresh_token = creds.refresh_token
+
+            metrics.incr("credentials.refresh")
+            with metrics.timed("credentials.refresh"):
+                creds.refresh(Request())
+
+        if creds.refresh_token and creds.refresh_token != previous_refresh_token:
+            metrics.incr("credentials.refresh_token_rotated")
+            if on_rotated:
+                on_rotated(creds.refresh_token)
+        return creds
+
+    def invalidate(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+access_tokens = AccessTokenCache()
 
 class CredentialsManager:
     creds: Credentials = None
 
-    def __init__(self, token: dict = None, refresh_token: str = None):
+    def __init__(
+            self,
+            token: dict = None,
+            refresh_token: str = None,
+            user_email: str = None,
+            client_secrets: dict = None,
+            on_rotated=None
+        ):
         """
         Builds credentials from either a provided access token or a refresh token.
+        Credentials built from a refresh token use the OAuth client in client_secrets, and are cached
+        per user (by user_email when given) and only refreshed when the access token is close to expiring.
+        If Google rotates the refresh token, on_rotated(new_refresh_token) is called so the caller can persist it.
         """
-        print("this is token", token, " this is refresh token: ", refresh_token)
         if not refresh_token and not token:
             raise ValueError("Either token or refresh_token must be provided")
         # If a token is provided, use it directly
         elif token:
             self.creds = Credentials(token=token['access_token'])
-        # If a refresh token is provided, build credentials from it
+        # If a refresh token is provided, build credentials from it, or reuse the cached ones
         else:
-            client_secrets = CLIENT_SECRETS['web']
-
-            creds = Credentials(
-                token=None,
-                refresh_token=refresh_token,
-                token_uri="https://oauth2.googleapis.com/token",
-                client_id=client_secrets['client_id'],
-                client_secret=client_secrets['client_secret'],
-                scopes=[
-                    "https://www.googleapis.com/auth/userinfo.email",
-                    "https://mail.google.com/",
-                    "https://www.googleapis.com/auth/gmail.compose"
-                ]
+            if not client_secrets:
+                raise ValueError("client_secrets must be provided with a refresh_token")
+            key = user_email or hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+            self.creds = access_tokens.get(
+                key, refresh_token, partial(self._build_credentials, client_secrets), on_rotated
             )
 
-            creds.refresh(Request())
-            self.creds = creds
+    @staticmethod
+    def _build_credentials(client_secrets: dict, refresh_token: str) -> Credentials:
+        client_secrets = client_secrets['web']
+
+        return Credentials(
+            token=None,
+            refresh_token=refresh_token,
+            token_uri="https://oauth2.googleapis.com/token",
+            client_id=client_secrets['client_id'],
+            client_secret=client_secrets['client_secret'],
+            scopes=[
+                "https://www.googleapis.com/auth/userinfo.email",
+                "https://mail.google.com/",
+                "https://www.googleapis.com/auth/gmail.compose"
+            ]
+        )
 
     def get_access_token(self) -> str:
         if not self.creds:
@@ -49,9 +144,9 @@ class CredentialsManager:
         return self.creds.refresh_token
 
     @staticmethod
-    async def get_initial_token(request: Request) -> dict:
+    async def get_initial_token(request: Request, client_secrets: dict) -> dict:
         flow: Flow = Flow.from_client_config(
-            CLIENT_SECRETS,
+            client_secrets,
             scopes=[
                 "openid",
                 "https://www.googleapis.com/auth/userinfo.email",
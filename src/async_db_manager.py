@@ -0,0 +1,934 @@
+from fastembed import TextEmbedding
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from datetime import datetime
+import numpy as np
+import threading
+import traceback
+import asyncpg
+import asyncio
+import time
+import sys, os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.embedding_cache import EmbeddingCache
+from src.vector_codec import encode_vector, decode_vector
+from src import metrics
+from src.db_manager import (
+    UserContext,
+    UserContextCache,
+    get_ssl_context,
+    AIVEN_PASSWORD,
+    DB_HOST,
+    DB_PORT,
+    DB_USER,
+    DB_NAME,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE_SECONDS,
+    MAX_DOCUMENT_LENGTH,
+    VECTOR_SEARCH_EF_SEARCH,
+    VECTOR_SEARCH_ITERATIVE_SCAN,
+)
+
+# Same capacity as the sync QueuePool (pool_size=5, max_overflow=10)
+ASYNC_DB_POOL_MIN_SIZE = int(os.environ.get("ASYNC_DB_POOL_MIN_SIZE", 5))
+ASYNC_DB_POOL_MAX_SIZE = int(os.environ.get("ASYNC_DB_POOL_MAX_SIZE", 15))
+# Idle connections above ASYNC_DB_POOL_MIN_SIZE are closed after this long, 0 keeps them open
+ASYNC_DB_POOL_MAX_INACTIVE_SECONDS = float(os.environ.get("ASYNC_DB_POOL_MAX_INACTIVE_SECONDS", 300))
+# Connections idle for longer than this are pinged on acquire and replaced if dead, -1 disables pinging.
+# Connections in active use skip the ping so hot paths don't pay an extra round trip.
+DB_POOL_PRE_PING_IDLE_SECONDS = int(os.environ.get("DB_POOL_PRE_PING_IDLE_SECONDS", 30))
+# A ping slower than this counts as a dead connection
+DB_POOL_PING_TIMEOUT_SECONDS = 5
+# Debug aid for diagnosing pool starvation: records where every connection was acquired and reports
+# connections held longer than DB_POOL_LEAK_THRESHOLD_SECONDS. Captures a stack trace per acquire.
+DB_POOL_LEAK_DEBUG = os.environ.get("DB_POOL_LEAK_DEBUG", "").lower() in ("1", "true", "yes")
+DB_POOL_LEAK_THRESHOLD_SECONDS = float(os.environ.get("DB_POOL_LEAK_THRESHOLD_SECONDS", 10))
+# Prepared statements cached per connection, every query below is reused so they are parsed and planned once.
+# Must be 0 when connecting through a transaction-mode pooler such as pgbouncer.
+ASYNC_DB_STATEMENT_CACHE_SIZE = int(os.environ.get("ASYNC_DB_STATEMENT_CACHE_SIZE", 100))
+# A delivery that claimed a message but hasn't recorded a draft after this long is assumed dead
+DRAFT_CLAIM_TIMEOUT_SECONDS = 600
+# Number of documents embedded per model call during bulk ingestion
+EMBEDDING_BATCH_SIZE = 64
+# Documents per unnest() INSERT statement, bounds the size of one statement and its arrays
+INSERT_BATCH_SIZE = 500
+# Rows fetched per round trip when streaming a user's documents out through a server-side cursor
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", 200))
+# Users fetched per query by iter_users_for_watch, a pooled connection is only held while one batch is read
+USER_ITER_BATCH_SIZE = int(os.environ.get("USER_ITER_BATCH_SIZE", 500))
+
+class ConnectionLeakTracker:
+    """
+    Tracks acquired connections, reported by AsyncDBManager on every acquire and release.
+    A background thread reports connections still held past the threshold (likely leaks) with the
+    stack that acquired them, and connections released after the threshold are reported on release.
+    """
+
+    def __init__(self, threshold_seconds: float = DB_POOL_LEAK_THRESHOLD_SECONDS):
+        self.threshold_seconds = threshold_seconds
+        self._checkouts: dict[int, dict] = {}
+        self._lock = threading.Lock()
+        self._reporter: threading.Thread = None
+
+    def start_reporter(self) -> None:
+        if not self._reporter:
+            self._reporter = threading.Thread(target=self._report_loop, name="db-leak-reporter", daemon=True)
+            self._reporter.start()
+
+    def checkout(self, key: int) -> None:
+        # Drop this method and the pool internals so the trace ends at the code that asked for a
+        # connection, and keep the innermost frames only
+        frames = [
+            frame for frame in traceback.extract_stack()[:-1]
+            if "asyncpg" not in frame.filename and "contextlib" not in frame.filename and frame.name != "_acquire"
+        ][-10:]
+        task = asyncio.current_task()
+        with self._lock:
+            self._checkouts[key] = {
+                "since": time.monotonic(),
+                "task": task.get_name() if task else threading.current_thread().name,
+                "stack": "".join(traceback.format_list(frames)),
+                "reported": False,
+            }
+
+    def checkin(self, key: int) -> None:
+        with self._lock:
+            checkout = self._checkouts.pop(key, None)
+        if not checkout:
+            return
+        held = time.monotonic() - checkout["since"]
+        if held > self.threshold_seconds:
+            metrics.incr("async_db_pool.long_held")
+            print(f"DB connection returned after {held:.1f}s by {checkout['task']}, acquired at:\n{checkout['stack']}")
+
+    def long_held(self) -> list[dict]:
+        """
+        Returns the connections currently held longer than the threshold, longest first.
+        """
+        now = time.monotonic()
+        with self._lock:
+            held = [
+                {"held_seconds": round(now - checkout["since"], 1), "task": checkout["task"], "stack": checkout["stack"]}
+                for checkout in self._checkouts.values()
+                if now - checkout["since"] > self.threshold_seconds
+            ]
+        return sorted(held, key=lambda checkout: checkout["held_seconds"], reverse=True)
+
+    def _report_loop(self) -> None:
+        while True:
+            time.sleep(self.threshold_seconds)
+            now = time.monotonic()
+            with self._lock:
+                suspects = [
+                    checkout for checkout in self._checkouts.values()
+                    if not checkout["reported"] and now - checkout["since"] > self.threshold_seconds
+                ]
+                for checkout in suspects:
+                    checkout["reported"] = True
+            for checkout in suspects:
+                metrics.incr("async_db_pool.leak_suspected")
+                print(
+                    f"Possible DB connection leak: held for {now - checkout['since']:.1f}s by {checkout['task']}, "
+                    f"acquired at:\n{checkout['stack']}"
+                )
+
+class AsyncDBManager:
+    """
+    asyncio database manager awaited by the routers, backed by an asyncpg pool. Every request path
+    goes through it, the sync DBManager only keeps the original methods.
+    Three of those have no async equivalent, they are replaced by safer queries: get_attribute by
+    get_processing_state, update_historyID by advance_history_id (which never moves the marker back),
+    and the load-all get_all_users_for_watch by the batched iter_users_for_watch.
+    Queries run as cached prepared statements and vectors are sent in pgvector's binary format.
+    Embedding is CPU bound and runs in a worker thread.
+    """
+    pool: asyncpg.Pool = None
+    embedding_model: TextEmbedding = None
+    embedding_cache: EmbeddingCache = None
+    user_contexts: UserContextCache = None
+    leak_tracker: ConnectionLeakTracker = None
+
+    def __init__(
+            self,
+            embedding_model: TextEmbedding = None,
+            embedding_cache: EmbeddingCache = None,
+            user_contexts: UserContextCache = None
+        ):
+        # Pass the sync DBManager's model and caches to share them instead of loading a second model
+        self.embedding_model = embedding_model or TextEmbedding()
+        self.embedding_cache = embedding_cache or EmbeddingCache()
+        self.user_contexts = user_contexts or UserContextCache()
+        self._pool_lock = asyncio.Lock()
+        # Server pid -> [opened, last released] monotonic times of every open pooled connection
+        self._connection_times: dict[int, list[float]] = {}
+        if DB_POOL_LEAK_DEBUG:
+            self.leak_tracker = ConnectionLeakTracker()
+            self.leak_tracker.start_reporter()
+
+    async def connect(self) -> asyncpg.Pool:
+        """
+        Creates the pool if it doesn't exist yet. Called on startup, and lazily by the first query otherwise.
+        """
+        if self.pool:
+            return self.pool
+        async with self._pool_lock:
+            if not self.pool:
+                self.pool = await asyncpg.create_pool(
+                    user=DB_USER,
+                    password=AIVEN_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    database=DB_NAME,
+                    ssl=get_ssl_context(),
+                    min_size=ASYNC_DB_POOL_MIN_SIZE,
+                    max_size=ASYNC_DB_POOL_MAX_SIZE,
+                    max_inactive_connection_lifetime=ASYNC_DB_POOL_MAX_INACTIVE_SECONDS,
+                    statement_cache_size=ASYNC_DB_STATEMENT_CACHE_SIZE,
+                    connect=self._connect,
+                    init=self._init_connection,
+                )
+        return self.pool
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Acquires a pooled connection for the duration of the block and always releases it, recording
+        how long the caller waited. Connections opened more than DB_POOL_RECYCLE_SECONDS ago are closed
+        and replaced, and connections idle past DB_POOL_PRE_PING_IDLE_SECONDS are pinged and replaced if dead.
+        """
+        pool = await self.connect()
+        start = time.perf_counter()
+        try:
+            while True:
+                conn = await pool.acquire(timeout=DB_POOL_TIMEOUT)
+                try:
+                    if await self._check_connection(conn):
+                        break
+                except BaseException:
+                    await pool.release(conn)
+                    raise
+                # The closed connection's slot goes back to the pool and reconnects on its next acquire
+                await pool.release(conn)
+        finally:
+            metrics.observe("async_db_pool.acquire_wait", time.perf_counter() - start)
+
+        pid = conn.get_server_pid()
+        if self.leak_tracker:
+            self.leak_tracker.checkout(id(conn))
+        try:
+            yield conn
+        finally:
+            if self.leak_tracker:
+                self.leak_tracker.checkin(id(conn))
+            times = self._connection_times.get(pid)
+            if times:
+                times[1] = time.monotonic()
+            await pool.release(conn)
+
+    async def _check_connection(self, conn: asyncpg.Connection) -> bool:
+        """
+        Returns True if an acquired connection can be used. Otherwise closes it and returns False.
+        """
+        times = self._connection_times.get(conn.get_server_pid())
+        if times is None:
+            return True
+        opened, last_used = times
+        now = time.monotonic()
+
+        if now - opened > DB_POOL_RECYCLE_SECONDS:
+            metrics.incr("async_db_pool.recycled")
+            conn.terminate()
+            return False
+
+        if DB_POOL_PRE_PING_IDLE_SECONDS < 0 or now - last_used < DB_POOL_PRE_PING_IDLE_SECONDS:
+            return True
+        try:
+            await conn.execute("SELECT 1;", timeout=DB_POOL_PING_TIMEOUT_SECONDS)
+            return True
+        except Exception as e:
+            print(f"Discarding dead pooled connection: {e}")
+            metrics.incr("async_db_pool.ping_failed")
+            conn.terminate()
+            return False
+
+    def pool_status(self) -> dict:
+        """
+        Returns current pool occupancy, and the time callers waited to acquire a connection and
+        the time taken to open one, since the last metrics reset.
+        """
+        if not self.pool:
+            return {}
+        timers = metrics.snapshot()["timers"]
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "max_size": self.pool.get_max_size(),
+            "acquire_wait": timers.get("async_db_pool.acquire_wait"),
+            "connect": timers.get("async_db_pool.connect"),
+            **({"long_held": self.leak_tracker.long_held()} if self.leak_tracker else {}),
+        }
+
+    async def close(self) -> None:
+        if self.pool:
+            await self.pool.close()
+            self.pool = None
+
+    @staticmethod
+    async def _connect(*args, **kwargs) -> asyncpg.Connection:
+        with metrics.timed("async_db_pool.connect"):
+            return await asyncpg.connect(*args, **kwargs)
+
+    async def _init_connection(self, conn: asyncpg.Connection) -> None:
+        await conn.set_type_codec(
+            'vector', schema='public', encoder=encode_vector, decoder=decode_vector, format='binary'
+        )
+        pid = conn.get_server_pid()
+        now = time.monotonic()
+        times = self._connection_times[pid] = [now, now]
+
+        def forget(_):
+            # A newer connection may have been given the same server pid
+            if self._connection_times.get(pid) is times:
+                del self._connection_times[pid]
+
+        conn.add_termination_listener(forget)
+
+    async def embed(self, texts: list[str]) -> list[np.ndarray]:
+        """
+        Embeds texts through the embedding cache in a worker thread.
+        """
+        return await asyncio.to_thread(self.embedding_cache.embed, self.embedding_model, texts)
+
+    async def get_user_context(self, user_email: str, refresh: bool = False) -> UserContext | None:
+        """
+        Resolves a user's id and frequently read attributes in one query, cached in process.
+        Pass refresh=True to bypass the cache and reload from the db. Returns None if the user doesn't exist or on error.
+        """
+        if not refresh:
+            context = self.user_contexts.get(user_email)
+            if context:
+                return context
+
+        try:
+            async with self._acquire() as conn:
+                row = await conn.fetchrow(
+                    'SELECT user_id, name, email, history_id, encrypted_refresh_token FROM users WHERE email = $1;',
+                    user_email
+                )
+        except Exception as e:
+            print(f"Database operation failed while getting user context for {user_email}.")
+            print(e)
+            return None
+
+        if row is None:
+            self.invalidate_user_context(user_email)
+            return None
+
+        context = UserContext(*row)
+        self.user_contexts.put(user_email, context)
+        return context
+
+    def invalidate_user_context(self, user_email: str) -> None:
+        self.user_contexts.invalidate(user_email)
+
+    async def _get_user_id(self, user_email: str) -> int | None:
+        context = await self.get_user_context(user_email)
+        return context.user_id if context else None
+
+    async def user_exists(self, user_email: str) -> bool:
+        """
+        Checks if a user exists in the database based on their email.
+        """
+        try:
+            async with self._acquire() as conn:
+                return await conn.fetchval('SELECT 1 FROM users WHERE email = $1;', user_email) is not None
+        except Exception as e:
+            print(f"Database operation failed while checking if user {user_email} exists.")
+            print(e)
+            return False # Assume user doesn't exist on error
+
+    async def insert_new_user(self, name: str, user_email: str, refresh_token: str, history_id: str) -> bool:
+        """
+        Inserts a new user into the database.
+        Returns True if a new user was created, False if the user already existed.
+        """
+        if not user_email or not refresh_token:
+            print("user_email or refresh_token are None.")
+            return False
+
+        try:
+            async with self._acquire() as conn:
+                inserted = await conn.fetchval(
+                    'INSERT INTO users (name, email, encrypted_refresh_token, history_id) '
+                    'VALUES ($1, $2, $3, $4) '
+                    'ON CONFLICT (email) DO NOTHING RETURNING user_id;',
+                    name, user_email, refresh_token, history_id
+                )
+                self.invalidate_user_context(user_email)
+                return inserted is not None
+        except Exception as e:
+            print("Exception trying to insert new user into db.")
+            print(e)
+            return False
+
+    async def get_processing_state(self, user_email: str) -> UserContext | None:
+        """
+        Fetches everything needed to process a notification (user_id, refresh token, history_id)
+        in a single statement, always from the db since another instance may have advanced it.
+        """
+        return await self.get_user_context(user_email, refresh=True)
+
+    async def advance_history_id(self, user_email: str, history_id: str) -> bool:
+        """
+        Compare-and-set update of the history marker: it only moves forward, so concurrent
+        deliveries for the same user can't regress it. Returns True if the marker was advanced,
+        False if the stored marker is already at or past history_id, or on error.
+        """
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return False
+
+        try:
+            async with self._acquire() as conn:
+                # history_id is stored as text, only compare numerically when the stored value is numeric
+                status = await conn.execute(
+                    """
+                    UPDATE users
+                        SET history_id = $1::varchar
+                        WHERE user_id = $2
+                        AND CASE
+                            WHEN history_id ~ '^[0-9]+$' THEN history_id::numeric < $1::varchar::numeric
+                            ELSE true
+                        END;
+                    """, history_id, user_id
+                )
+                self.invalidate_user_context(user_email)
+                return status == "UPDATE 1"
+        except Exception as e:
+            print("Database operation failed in advance_history_id.")
+            print(e)
+            return False
+
+    async def insert_document(
+            self,
+            user_email: str,
+            doc_name: str,
+            text_content: str,
+            doc_id: str = None
+        ) -> bool:
+        """
+        Insert a given document into the database using the user's email.
+        If doc_id is provided, it will update the existing document instead.
+        """
+        doc = doc_name + "\n" + text_content
+        if len(doc) > MAX_DOCUMENT_LENGTH:
+            raise ValueError(f"Document too long, must be under {MAX_DOCUMENT_LENGTH} characters., got {len(doc)}")
+
+        embedding = (await self.embed([doc]))[0]
+
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            print(f"User {user_email} not found in insert_document.")
+            return False
+
+        try:
+            async with self._acquire() as conn:
+                if doc_id:
+                    await conn.execute(
+                        'UPDATE documents SET embedding = $1, content = $2 WHERE doc_id = $3;',
+                        embedding, text_content, int(doc_id)
+                    )
+                else:
+                    await conn.execute(
+                        'INSERT INTO documents (user_id, document_name, embedding, content) VALUES ($1, $2, $3, $4);',
+                        user_id, doc_name, embedding, text_content
+                    )
+        except Exception as e:
+            print("Database operation failed in insert_document.")
+            print(e)
+            return False
+        return True
+
+    async def insert_documents(self, user_email: str, documents: list[dict], batch_size: int = EMBEDDING_BATCH_SIZE) -> list[dict]:
+        """
+        Bulk insert documents for a user. Each document is a dict with doc_name and text_content.
+        Documents are embedded batch_size at a time and inserted INSERT_BATCH_SIZE at a time, in a single
+        transaction. Returns one result per input document, in order, with either a doc_id or an error.
+        Each chunk is inserted with a single unnest() statement, so its parameters are four arrays
+        regardless of the chunk size and the prepared statement is reused across chunks.
+        doc_ids are drawn per unnest ordinal before inserting, so results map back to input documents
+        without relying on the order of RETURNING.
+        """
+        results: list[dict] = []
+        valid: list[int] = []
+        for i, document in enumerate(documents):
+            doc_name = document.get("doc_name") if isinstance(document, dict) else None
+            text_content = document.get("text_content") if isinstance(document, dict) else None
+            result = {"index": i, "doc_name": doc_name, "success": False}
+            results.append(result)
+
+            if not isinstance(doc_name, str) or not doc_name or not isinstance(text_content, str):
+                result["error"] = "doc_name and text_content are required."
+                continue
+            doc_length = len(doc_name + "\n" + text_content)
+            if doc_length > MAX_DOCUMENT_LENGTH:
+                result["error"] = f"Document too long, must be under {MAX_DOCUMENT_LENGTH} characters., got {doc_length}"
+                continue
+            valid.append(i)
+
+        if not valid:
+            return results
+
+        try:
+            embeddings = []
+            for start in range(0, len(valid), batch_size):
+                chunk = valid[start:start + batch_size]
+                embeddings.extend(await self.embed([documents[i]["doc_name"] + "\n" + documents[i]["text_content"] for i in chunk]))
+        except Exception as e:
+            print("Embedding failed in insert_documents.")
+            print(e)
+            for i in valid:
+                results[i]["error"] = "Failed to embed document."
+            return results
+
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            for i in valid:
+                results[i]["error"] = "User not found."
+            return results
+
+        try:
+            doc_ids: dict[int, int] = {}
+            async with self._acquire() as conn:
+                async with conn.transaction():
+                    for start in range(0, len(valid), INSERT_BATCH_SIZE):
+                        chunk = valid[start:start + INSERT_BATCH_SIZE]
+                        rows = await conn.fetch(
+                            """
+                            WITH doc AS (
+                                SELECT nextval(pg_get_serial_sequence('documents', 'doc_id')) AS doc_id, name, embedding, content, ord
+                                FROM unnest($2::text[], $3::vector[], $4::text[]) WITH ORDINALITY AS doc(name, embedding, content, ord)
+                            ), inserted AS (
+                                INSERT INTO documents (doc_id, user_id, document_name, embedding, content)
+                                SELECT doc_id, $1, name, embedding, content FROM doc
+                                RETURNING doc_id
+                            )
+                            SELECT doc.ord, doc.doc_id FROM doc JOIN inserted USING (doc_id);
+                            """,
+                            user_id,
+                            [documents[i]["doc_name"] for i in chunk],
+                            [encode_vector(embedding) for embedding in embeddings[start:start + INSERT_BATCH_SIZE]],
+                            [documents[i]["text_content"] for i in chunk],
+                        )
+                        # RETURNING order is not guaranteed, rows carry their 1-based position in the chunk
+                        doc_ids.update((chunk[row["ord"] - 1], row["doc_id"]) for row in rows)
+
+            for i, doc_id in doc_ids.items():
+                results[i]["success"] = True
+                results[i]["doc_id"] = doc_id
+        except Exception as e:
+            print("Database operation failed in insert_documents.")
+            print(e)
+            for i in valid:
+                results[i]["error"] = "Database error, batch was not saved."
+
+        return results
+
+    async def delete_document(self, doc_id: str) -> bool:
+        try:
+            async with self._acquire() as conn:
+                await conn.execute("DELETE FROM documents WHERE doc_id = $1;", int(doc_id))
+        except Exception as e:
+            print("Database operation failed in delete_document.")
+            print(e)
+            return False
+        return True
+
+    async def get_documents(
+            self,
+            user_email: str,
+            limit: int,
+            offset: int = 0,
+            content: bool = True,
+            after: tuple[str, int] = None
+        ) -> list[dict] | None:
+        """
+        Fetch a page of documents for a given user by email, ordered by name then id.
+        Pass after=(document_name, doc_id) of the last document on the previous page for keyset
+        pagination, which reads only the requested rows from idx_documents_user_name_id.
+        offset is kept for older clients, deep offsets scan and discard every skipped row.
+        """
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return []
+
+        columns = "d.doc_id, d.document_name"
+        if content:
+            columns += ", d.content"
+
+        try:
+            async with self._acquire() as conn:
+                if after:
+                    rows = await conn.fetch(
+                        f"""
+                        SELECT {columns}
+                        FROM documents d
+                        WHERE d.user_id = $1 AND (d.document_name, d.doc_id) > ($2, $3)
+                        ORDER BY d.document_name ASC, d.doc_id ASC
+                        LIMIT $4;
+                        """, user_id, after[0], after[1], limit
+                    )
+                else:
+                    rows = await conn.fetch(
+                        f"""
+                        SELECT {columns}
+                        FROM documents d
+                        WHERE d.user_id = $1
+                        ORDER BY d.document_name ASC, d.doc_id ASC
+                        LIMIT $2 OFFSET $3;
+                        """, user_id, limit, offset
+                    )
+                documents = []
+                for row in rows:
+                    doc = {"id": row[0], "name": row[1]}
+                    if content:
+                        doc["content"] = row[2]
+                    documents.append(doc)
+                return documents
+        except Exception as e:
+            print("Database operation failed in get_documents.")
+            print(e)
+            return None
+
+    async def iter_documents(self, user_email: str, content: bool = True, fetch_size: int = EXPORT_FETCH_SIZE) -> AsyncIterator[dict]:
+        """
+        Yields all of a user's documents ordered by name, read through a server-side cursor
+        fetch_size rows at a time, so memory stays flat however many documents the user has.
+        Holds a pooled connection until the iteration finishes or the generator is closed.
+        """
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return
+
+        columns = "d.doc_id, d.document_name"
+        if content:
+            columns += ", d.content"
+
+        async with self._acquire() as conn:
+            # Cursors only live inside a transaction
+            async with conn.transaction():
+                cursor = conn.cursor(
+                    f"""
+                    SELECT {columns}
+                    FROM documents d
+                    WHERE d.user_id = $1
+                    ORDER BY d.document_name ASC, d.doc_id ASC;
+                    """, user_id, prefetch=fetch_size
+                )
+                async for row in cursor:
+                    doc = {"id": row[0], "name": row[1]}
+                    if content:
+                        doc["content"] = row[2]
+                    yield doc
+
+    async def get_document_count(self, user_email: str) -> int | None:
+        """
+        Returns the number of documents a user has, from the trigger-maintained users.document_count.
+        """
+        try:
+            async with self._acquire() as conn:
+                count = await conn.fetchval('SELECT document_count FROM users WHERE email = $1;', user_email)
+                return count or 0
+        except Exception as e:
+            print("Database operation failed in get_document_count.")
+            print(e)
+            return None
+
+    async def get_document_by_id(self, doc_id: str) -> dict | None:
+        """
+        Fetch a single document by its ID. May return None if not found or on error.
+        """
+        try:
+            async with self._acquire() as conn:
+                row = await conn.fetchrow(
+                    'SELECT doc_id, document_name, content FROM documents WHERE doc_id = $1;', int(doc_id)
+                )
+                if row:
+                    return {"id": row[0], "name": row[1], "content": row[2]}
+                return None
+        except Exception as e:
+            print("Database operation failed in get_document_by_id.")
+            print(e)
+            return None
+
+    async def get_top_k_results(
+            self,
+            query: str,
+            k: int,
+            user_email: str,
+            query_embedding: np.ndarray = None,
+            ef_search: int = VECTOR_SEARCH_EF_SEARCH
+        ) -> list[dict] | None:
+        """
+        Returns the top k most similar documents for a user, see DBManager.get_top_k_results.
+        The query vector is bound once, in binary.
+        """
+        if query_embedding is None:
+            query_embedding = (await self.embed([query]))[0]
+
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return []
+
+        try:
+            async with self._acquire() as conn:
+                # set_config(..., true) is transaction-local, so it has to share a transaction with the search
+                async with conn.transaction():
+                    await conn.execute("SELECT set_config('hnsw.ef_search', $1, true);", str(max(ef_search, k)))
+                    if VECTOR_SEARCH_ITERATIVE_SCAN:
+                        await conn.execute("SELECT set_config('hnsw.iterative_scan', $1, true);", VECTOR_SEARCH_ITERATIVE_SCAN)
+                    sql = """
+                        SELECT
+                            d.doc_id,
+                            d.document_name,
+                            d.content,
+                            d.embedding <=> $1 AS distance
+                        FROM
+                            documents d
+                        WHERE
+                            d.user_id = $2
+                        ORDER BY
+                            distance
+                        LIMIT $3;
+                    """
+                    rows = await conn.fetch(sql, query_embedding, user_id, k)
+
+                    if len(rows) < k:
+                        # A filtered HNSW scan can stop short of k rows for users whose documents are sparse in the
+                        # shared index. If the user has more documents, redo the search as an exact scan.
+                        document_count = await conn.fetchval('SELECT document_count FROM users WHERE user_id = $1;', user_id)
+                        if document_count > len(rows):
+                            metrics.incr("vector_search.exact_fallback")
+                            await conn.execute("SET LOCAL enable_indexscan = off;")
+                            rows = await conn.fetch(sql, query_embedding, user_id, k)
+
+            # relaxed_order can return rows slightly out of order
+            return [
+                {"id": row[0], "name": row[1], "content": row[2], "similarity": round(1 - row[3], 4)}
+                for row in sorted(rows, key=lambda row: row[3])
+            ]
+        except Exception as e:
+            print("Database operation failed in get_top_k_results.")
+            print(e)
+            return None
+
+    async def get_documents_by_ids(self, user_email: str, doc_ids: list[int]) -> list[dict] | None:
+        """
+        Fetch a user's documents by ID, returned in the order of doc_ids. Missing IDs are skipped.
+        """
+        user_id = await self._get_user_id(user_email)
+        if not doc_ids or user_id is None:
+            return []
+
+        try:
+            async with self._acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT doc_id, document_name, content
+                    FROM documents
+                    WHERE user_id = $1 AND doc_id = ANY($2::integer[]);
+                    """, user_id, list(doc_ids)
+                )
+                documents = {row[0]: {"id": row[0], "name": row[1], "content": row[2]} for row in rows}
+                return [documents[doc_id] for doc_id in doc_ids if doc_id in documents]
+        except Exception as e:
+            print("Database operation failed in get_documents_by_ids.")
+            print(e)
+            return None
+
+    async def claim_processed_message(self, user_email: str, message_id: str) -> dict | None:
+        """
+        Reads a message's ledger entry and claims it for drafting, in one statement.
+        The claim is granted if no draft exists yet and no other delivery holds a claim younger
+        than DRAFT_CLAIM_TIMEOUT_SECONDS. Returns {"draft_id", "doc_ids", "claimed", "attempts"}, or None on error,
+        where attempts counts the claims granted so far, including this one.
+        """
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return None
+
+        try:
+            async with self._acquire() as conn:
+                row = await conn.fetchrow(
+                    """
+                    INSERT INTO processed_messages (user_id, message_id, draft_claimed_at, attempts)
+                    VALUES ($1, $2, now(), 1)
+                    ON CONFLICT (user_id, message_id) DO UPDATE
+                        SET draft_claimed_at = CASE
+                            WHEN processed_messages.draft_id IS NULL
+                                AND (processed_messages.draft_claimed_at IS NULL
+                                    OR processed_messages.draft_claimed_at < now() - make_interval(secs => $3))
+                            THEN now()
+                            ELSE processed_messages.draft_claimed_at
+                        END,
+                            attempts = CASE
+                                WHEN processed_messages.draft_id IS NULL
+                                    AND (processed_messages.draft_claimed_at IS NULL
+                                        OR processed_messages.draft_claimed_at < now() - make_interval(secs => $3))
+                                THEN processed_messages.attempts + 1
+                                ELSE processed_messages.attempts
+                            END
+                    RETURNING draft_id, retrieved_doc_ids, draft_claimed_at = now(), attempts;
+                    """, user_id, message_id, DRAFT_CLAIM_TIMEOUT_SECONDS
+                )
+                return {"draft_id": row[0], "doc_ids": row[1], "claimed": bool(row[2]), "attempts": row[3]}
+        except Exception as e:
+            print("Database operation failed in claim_processed_message.")
+            print(e)
+            return None
+
+    async def record_retrieval(self, user_email: str, message_id: str, doc_ids: list[int]) -> bool:
+        """
+        Stores the IDs of the documents retrieved for a message.
+        """
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return False
+
+        try:
+            async with self._acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO processed_messages (user_id, message_id, retrieved_doc_ids)
+                    VALUES ($1, $2, $3)
+                    ON CONFLICT (user_id, message_id) DO UPDATE
+                        SET retrieved_doc_ids = EXCLUDED.retrieved_doc_ids;
+                    """, user_id, message_id, list(doc_ids)
+                )
+        except Exception as e:
+            print("Database operation failed in record_retrieval.")
+            print(e)
+            return False
+        return True
+
+    async def delete_processed_messages_before(self, cutoff: datetime) -> int | None:
+        """
+        Deletes ledger entries created before cutoff, returning how many were deleted, or None on error.
+        """
+        try:
+            async with self._acquire() as conn:
+                status = await conn.execute('DELETE FROM processed_messages WHERE created_at < $1;', cutoff)
+                return int(status.split()[-1])
+        except Exception as e:
+            print("Database operation failed in delete_processed_messages_before.")
+            print(e)
+            return None
+
+    async def record_draft(self, user_email: str, message_id: str, draft_id: str | None) -> bool:
+        """
+        Stores the draft created for a message and releases the claim.
+        Passing draft_id=None only releases the claim, so a later delivery can retry.
+        """
+        user_id = await self._get_user_id(user_email)
+        if user_id is None:
+            return False
+
+        try:
+            async with self._acquire() as conn:
+                await conn.execute(
+                    """
+                    UPDATE processed_messages
+                        SET draft_id = $1, draft_claimed_at = NULL
+                        WHERE user_id = $2 AND message_id = $3;
+                    """, draft_id, user_id, message_id
+                )
+        except Exception as e:
+            print("Database operation failed in record_draft.")
+            print(e)
+            return False
+        return True
+
+    async def iter_users_for_watch(self, expires_before: datetime | None = None, batch_size: int = USER_ITER_BATCH_SIZE) -> AsyncIterator[tuple[str, str]]:
+        """
+        Yields (email, encrypted_refresh_token) for every user, or only for users whose watch expires before
+        expires_before (soonest first, using the watch_expires_at index). Users are fetched batch_size at a time
+        with keyset pagination, so memory stays flat and a pooled connection is only held while a batch is read.
+        """
+        if expires_before is None:
+            # Keyed on user_id, so users whose expiration changes during the sweep are still visited exactly once
+            last_user_id = 0
+            while True:
+                async with self._acquire() as conn:
+                    rows = await conn.fetch(
+                        """
+                        SELECT user_id, email, encrypted_refresh_token FROM users
+                        WHERE user_id > $1
+                        ORDER BY user_id
+                        LIMIT $2;
+                        """, last_user_id, batch_size
+                    )
+                for row in rows:
+                    yield row[1], row[2]
+                if len(rows) < batch_size:
+                    return
+                last_user_id = rows[-1][0]
+
+        # Renewed users move past expires_before, so they are not revisited by later batches
+        async with self._acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT watch_expires_at, user_id, email, encrypted_refresh_token FROM users
+                WHERE watch_expires_at < $1
+                ORDER BY watch_expires_at, user_id
+                LIMIT $2;
+                """, expires_before, batch_size
+            )
+        while True:
+            for row in rows:
+                yield row[2], row[3]
+            if len(rows) < batch_size:
+                return
+            async with self._acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT watch_expires_at, user_id, email, encrypted_refresh_token FROM users
+                    WHERE watch_expires_at < $1 AND (watch_expires_at, user_id) > ($2, $3)
+                    ORDER BY watch_expires_at, user_id
+                    LIMIT $4;
+                    """, expires_before, rows[-1][0], rows[-1][1], batch_size
+                )
+
+    async def record_watch_renewal(self, user_email: str, expires_at: datetime | None) -> bool:
+        """
+        Stores the expiration of a user's newly created or renewed Gmail watch.
+        A missing expiration leaves the user due for the next renewal run.
+        """
+        try:
+            async with self._acquire() as conn:
+                status = await conn.execute(
+                    "UPDATE users SET watch_expires_at = COALESCE($2::timestamptz, '-infinity') "
+                    "WHERE email = $1;", user_email, expires_at
+                )
+                return status == "UPDATE 1"
+        except Exception as e:
+            print("Database operation failed in record_watch_renewal.")
+            print(e)
+            return False
+
+    async def update_refresh_token(self, refresh_token: str, email: str) -> bool:
+        """
+        This method will serve to update a user's refresh token to the most up to date token
+        """
+        try:
+            async with self._acquire() as conn:
+                status = await conn.execute(
+                    'UPDATE users SET encrypted_refresh_token = $1 WHERE email = $2;', refresh_token, email
+                )
+                self.invalidate_user_context(email)
+                return status == "UPDATE 1"
+        except Exception as e:
+            print("Database operation failed in update_refresh_token.")
+            print(e)
+            return False
@@ -0,0 +1,144 @@
+from fastapi import Header
+from fastapi.concurrency import run_in_threadpool
+from google.oauth2 import id_token
+from google.auth import transport
+from google.auth.transport import requests as google_requests
+from collections import OrderedDict
+import requests
+import threading
+import hashlib
+import time
+import re
+import os
+
+from . import metrics
+from .dependencies import WEB_CLIENT_ID
+
+# Verified ID token claims are reused until the token expires, bounded to this many tokens
+AUTH_TOKEN_CACHE_SIZE = int(os.environ.get("AUTH_TOKEN_CACHE_SIZE", 10000))
+# Allowed clock difference with Google when checking iat and exp
+AUTH_CLOCK_SKEW_SECONDS = 10
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+class AuthenticationError(Exception):
+    """
+    Raised by the auth dependency, turned into a 401 {"error": ...} response by the app's exception handler.
+    """
+
+class CachingRequest(transport.Request):
+    """
+    google-auth transport that reuses one pooled requests.Session and caches successful GET
+    responses (Google's public certs) for as long as their Cache-Control max-age allows.
+    """
+
+    def __init__(self, session: requests.Session = None):
+        self._request = google_requests.Request(session=session or requests.Session())
+        self._cache: dict[str, tuple[float, object]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        cacheable = method == "GET" and body is None
+        if cacheable:
+            with self._lock:
+                entry = self._cache.get(url)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+
+        metrics.incr("auth.http_fetch")
+        response = self._request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        max_age = self._max_age(response.headers)
+        if cacheable and response.status == 200 and max_age > 0:
+            with self._lock:
+                self._cache[url] = (time.monotonic() + max_age, response)
+        return response
+
+    @staticmethod
+    def _max_age(headers) -> int:
+        match = _MAX_AGE.search(headers.get("Cache-Control", "") or "")
+        if not match or "no-store" in headers.get("Cache-Control", ""):
+            return 0
+        # Age is how long a shared cache already held the response
+        try:
+            age = int(headers.get("Age", 0))
+        except ValueError:
+            age = 0
+        return int(match.group(1)) - age
+
+class TokenClaimsCache:
+    """
+    Bounded LRU of verified ID token claims keyed by token hash, each entry valid until the token's exp.
+    """
+
+    def __init__(self, max_entries: int = AUTH_TOKEN_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token: str) -> dict | None:
+        key = self.key(token)
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is None:
+                return None
+            if claims.get("exp", 0) <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return claims
+
+    def put(self, token: str, claims: dict) -> None:
+        key = self.key(token)
+        with self._lock:
+            self._entries[key] = claims
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+certs_request = CachingRequest()
+token_claims = TokenClaimsCache()
+
+def verify_id_token(token: str) -> dict:
+    """
+    Verifies a Google ID token against WEB_CLIENT_ID and returns its claims.
+    Claims of tokens verified before are served from memory until the token expires.
+    Raises ValueError if the token is invalid.
+    """
+    claims = token_claims.get(token)
+    if claims is not None:
+        metrics.incr("auth.token_cache_hit")
+        return claims
+
+    metrics.incr("auth.token_cache_miss")
+    with metrics.timed("auth.verify"):
+        claims = id_token.verify_oauth2_token(
+            token, certs_request, WEB_CLIENT_ID, clock_skew_in_seconds=AUTH_CLOCK_SKEW_SECONDS
+        )
+    token_claims.put(token, dict(claims))
+    return claims
+
+async def get_user_email(authorization: str = Header(None)) -> str:
+    """
+    FastAPI dependency that authenticates the "Authorization: Bearer <id token>" header and returns the user's email.
+    """
+    if not authorization:
+        raise AuthenticationError("Authorization header missing")
+
+    try:
+        # The token is expected to be in the format "Bearer <token>"
+        token = authorization.split(" ")[1]
+        claims = token_claims.get(token)
+        if claims is None:
+            # Signature checks are CPU bound and a cert refresh is a network call, keep both off the event loop
+            claims = await run_in_threadpool(verify_id_token, token)
+        else:
+            metrics.incr("auth.token_cache_hit")
+    except Exception as e:
+        raise AuthenticationError(f"Invalid token: {e}")
+
+    return claims.get('email')
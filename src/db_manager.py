@@ -1,45 +1,193 @@
 from sqlalchemy import pool
 from fastembed import TextEmbedding
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+import numpy as np
+import threading
 import pg8000
-import os
+import time
+import sys, os
 import ssl
 from dataclasses import dataclass
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.embedding_cache import EmbeddingCache
+from src.vector_codec import to_vector_literal
+from src import metrics
+
 AIVEN_PASSWORD = os.environ["AIVEN_PASSWORD"]
+# Connection settings, default to the hosted Aiven instance
+DB_HOST = os.environ.get("DB_HOST", "pg-38474cd-agent-email.e.aivencloud.com")
+DB_PORT = int(os.environ.get("DB_PORT", 17757))
+DB_USER = os.environ.get("DB_USER", "avnadmin")
+DB_NAME = os.environ.get("DB_NAME", "defaultdb")
+# CA bundle for verifying the server, set DB_SSL_CA to an empty string to connect without TLS (local only)
+DB_SSL_CA = os.environ.get("DB_SSL_CA", "ca.pem")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_POOL_MAX_OVERFLOW = int(os.environ.get("DB_POOL_MAX_OVERFLOW", 10))
+# Seconds to wait for a free connection before failing the checkout
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 30))
+# Connections older than this are replaced on checkout, before the server or a NAT drops them
+DB_POOL_RECYCLE_SECONDS = int(os.environ.get("DB_POOL_RECYCLE_SECONDS", 1800))
 # Ensure our content fits into RAG vector limit (384 dims)
 MAX_DOCUMENT_LENGTH = 2000
+# HNSW candidate list size per search (pgvector default 40), higher improves recall at the cost of latency.
+# See benchmarks/vector_index_bench.py for the trade-off at different collection sizes.
+VECTOR_SEARCH_EF_SEARCH = int(os.environ.get("VECTOR_SEARCH_EF_SEARCH", 40))
+# "relaxed_order" or "strict_order" keeps scanning the index until enough rows pass the user_id filter,
+# instead of returning fewer than k results for users with few documents. Needs pgvector >= 0.8, set it
+# empty on older versions. Searches that still come back short are redone as an exact scan.
+VECTOR_SEARCH_ITERATIVE_SCAN = os.environ.get("VECTOR_SEARCH_ITERATIVE_SCAN", "relaxed_order")
+# How long a resolved user context (user_id and common attributes) is reused without hitting the db
+USER_CONTEXT_TTL_SECONDS = int(os.environ.get("USER_CONTEXT_TTL_SECONDS", 300))
+USER_CONTEXT_CACHE_SIZE = int(os.environ.get("USER_CONTEXT_CACHE_SIZE", 10000))
+
+@lru_cache(maxsize=1)
+def get_ssl_context() -> ssl.SSLContext | None:
+    """
+    Returns the SSL context for db connections, created once since loading the CA bundle is not free.
+    """
+    return ssl.create_default_context(cafile=DB_SSL_CA) if DB_SSL_CA else None
+
+@dataclass(frozen=True)
+class UserContext:
+    user_id: int
+    name: str
+    email: str
+    history_id: str | None
+    encrypted_refresh_token: str | None
+
+class UserContextCache:
+    """
+    In-process TTL + LRU cache of UserContext by email, shared by the sync and async db managers
+    so an update through either one invalidates both.
+    """
+
+    def __init__(self, ttl_seconds: int = USER_CONTEXT_TTL_SECONDS, max_entries: int = USER_CONTEXT_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, UserContext]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_email: str) -> UserContext | None:
+        with self._lock:
+            entry = self._entries.get(user_email)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(user_email)
+                return entry[1]
+            return None
+
+    def put(self, user_email: str, context: UserContext) -> None:
+        with self._lock:
+            self._entries[user_email] = (time.monotonic() + self.ttl_seconds, context)
+            self._entries.move_to_end(user_email)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_email: str) -> None:
+        with self._lock:
+            self._entries.pop(user_email, None)
 
 class DBManager:
     mypool : pool.QueuePool = None
     embedding_model: TextEmbedding = None
+    embedding_cache: EmbeddingCache = None
+    user_contexts: UserContextCache = None
 
     def __init__(self):
         # pooling to manage potential concurrent connections
         try:
-            self.mypool = pool.QueuePool(self.getcon, max_overflow=10, pool_size=5)
+            self.mypool = pool.QueuePool(
+                self.getcon,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_POOL_MAX_OVERFLOW,
+                timeout=DB_POOL_TIMEOUT,
+                recycle=DB_POOL_RECYCLE_SECONDS
+            )
         except Exception as e:
             print(f"Failed connecting, Exception: {e}")
         # Load the embedding model once when the DBManager is initialized for efficiency
         self.embedding_model = TextEmbedding()
+        self.embedding_cache = EmbeddingCache()
+        # Invalidated by every method that updates a user
+        self.user_contexts = UserContextCache()
+
+    @contextmanager
+    def _connection(self):
+        """
+        Checks out a pooled connection for the duration of the block and always returns it.
+        Anything left uncommitted, e.g. when the block raises, is rolled back by the pool on return.
+        """
+        conn = self.mypool.connect()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def embed(self, texts: list[str]) -> list[np.ndarray]:
+        """
+        Embeds texts through the embedding cache, so identical texts are only run through the model once.
+        """
+        return self.embedding_cache.embed(self.embedding_model, texts)
+
+    def get_user_context(self, user_email: str, refresh: bool = False) -> UserContext | None:
+        """
+        Resolves a user's id and frequently read attributes in one query, cached in process for
+        USER_CONTEXT_TTL_SECONDS. Pass refresh=True to bypass the cache and reload from the db.
+        Returns None if the user doesn't exist or on error.
+        """
+        if not refresh:
+            context = self.user_contexts.get(user_email)
+            if context:
+                return context
+
+        try:
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    'SELECT user_id, name, email, history_id, encrypted_refresh_token FROM users WHERE email = %s;',
+                    (user_email,)
+                )
+                row = cur.fetchone()
+        except Exception as e:
+            print(f"Database operation failed while getting user context for {user_email}.")
+            print(e)
+            return None
+
+        if row is None:
+            self.invalidate_user_context(user_email)
+            return None
+
+        context = UserContext(*row)
+        self.user_contexts.put(user_email, context)
+        return context
+
+    def invalidate_user_context(self, user_email: str) -> None:
+        self.user_contexts.invalidate(user_email)
+
+    def _get_user_id(self, user_email: str) -> int | None:
+        """
+        Returns the user's id from the cached user context, so document queries can skip joining on users.email.
+        """
+        context = self.get_user_context(user_email)
+        return context.user_id if context else None
 
     def user_exists(self, user_email: str) -> bool:
         """
         Checks if a user exists in the database based on their email.
         Returns True if the user exists, False otherwise.
         """
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute('SELECT 1 FROM users WHERE email = %s;', (user_email,))
-            return cur.fetchone() is not None
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT 1 FROM users WHERE email = %s;', (user_email,))
+                return cur.fetchone() is not None
         except Exception as e:
             print(f"Database operation failed while checking if user {user_email} exists.")
             print(e)
             return False # Assume user doesn't exist on error
-        finally:
-            if conn:
-                conn.close()
 
     def insert_new_user(self, name: str, user_email: str, refresh_token: str, history_id: str) -> bool:
         """
@@ -50,27 +198,24 @@ class DBManager:
             print("user_email or refresh_token are None.")
             return False
 
-        conn = None
         was_inserted = False
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute(
-                'INSERT INTO users (name, email, encrypted_refresh_token, history_id) '
-                'VALUES (%s, %s, %s, %s) '
-                'ON CONFLICT (email) DO NOTHING',
-                (name, user_email, refresh_token, history_id)
-            )
-            # rowcount will be 1 if a row was inserted, 0 otherwise.
-            was_inserted = cur.rowcount == 1
-            conn.commit()
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    'INSERT INTO users (name, email, encrypted_refresh_token, history_id) '
+                    'VALUES (%s, %s, %s, %s) '
+                    'ON CONFLICT (email) DO NOTHING',
+                    (name, user_email, refresh_token, history_id)
+                )
+                # rowcount will be 1 if a row was inserted, 0 otherwise.
+                was_inserted = cur.rowcount == 1
+                conn.commit()
+                self.invalidate_user_context(user_email)
         except Exception as e:
             print("Exception trying to insert new user into db.")
             print(e)
             return False
-        finally:
-            if conn:
-                conn.close()
 
         return was_inserted
 
@@ -78,24 +223,21 @@ class DBManager:
     Updates the historyID for a user identified by their email. Returns True if successful, False
     """
     def update_historyID(self, user_email: str, historyID: str) -> bool:
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute(
-                """
-                UPDATE users
-                    SET history_id = %s
-                    WHERE email = %s;
-                """, (historyID, user_email)
-            )
-            conn.commit()
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    """
+                    UPDATE users
+                        SET history_id = %s
+                        WHERE email = %s;
+                    """, (historyID, user_email)
+                )
+                conn.commit()
+                self.invalidate_user_context(user_email)
         except Exception as e:
             print("Database operation failed.")
             return False
-        finally:
-            if conn:
-                conn.close()
 
         return True
 
@@ -104,26 +246,22 @@ class DBManager:
         Fetch an attribute from the db with a given user email.
         Note: The attribute name is controlled internally and not by user input.
         """
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            # Use parameterized query for user_email to prevent SQL injection
-            sql = f'SELECT {attribute} FROM users WHERE email = %s;'
-            cur.execute(sql, (user_email,))
-
-            res = cur.fetchone()
-            if res:
-                return res[0]
-            else:
-                return None
+            with self._connection() as conn:
+                cur = conn.cursor()
+                # Use parameterized query for user_email to prevent SQL injection
+                sql = f'SELECT {attribute} FROM users WHERE email = %s;'
+                cur.execute(sql, (user_email,))
+
+                res = cur.fetchone()
+                if res:
+                    return res[0]
+                else:
+                    return None
         except Exception as e:
             print(f"Database operation failed while getting attribute {attribute}.")
             print(e)
             return None
-        finally:
-            if conn:
-                conn.close()
 
     def insert_document(
             self,
@@ -141,218 +279,210 @@ class DBManager:
         if len(doc) > MAX_DOCUMENT_LENGTH:
             raise ValueError(f"Document too long, must be under {MAX_DOCUMENT_LENGTH} characters., got {len(doc)}")
 
-        embeddings_list = list(self.embedding_model.embed([doc]))
-        embedding = embeddings_list[0]
-        embedding_str = str(embedding.tolist())
+        embedding = self.embed([doc])[0]
+        embedding_str = to_vector_literal(embedding)
+
+        user_id = self._get_user_id(user_email)
+        if user_id is None:
+            print(f"User {user_email} not found in insert_document.")
+            return False
 
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            if doc_id:
-                cur.execute(
-                    'UPDATE documents SET embedding = %s, content = %s WHERE doc_id = %s;',
-                    (embedding_str, text_content, doc_id)
-                )
-            else:
-                sql = """
-                    INSERT INTO documents (user_id, document_name, embedding, content)
-                    SELECT
-                        u.user_id,
-                        %s,
-                        %s,
-                        %s
-                    FROM
-                        users u
-                    WHERE
-                        u.email = %s;
-                """
-                params = (doc_name, embedding_str, text_content, user_email)
-                cur.execute(sql, params)
-            conn.commit()
+            with self._connection() as conn:
+                cur = conn.cursor()
+                if doc_id:
+                    cur.execute(
+                        'UPDATE documents SET embedding = %s, content = %s WHERE doc_id = %s;',
+                        (embedding_str, text_content, doc_id)
+                    )
+                else:
+                    sql = """
+                        INSERT INTO documents (user_id, document_name, embedding, content)
+                        VALUES (%s, %s, %s, %s);
+                    """
+                    params = (user_id, doc_name, embedding_str, text_content)
+                    cur.execute(sql, params)
+                conn.commit()
         except Exception as e:
             print("Database operation failed in insert_document.")
             print(e)
             return False
-        finally:
-            if conn:
-                conn.close()
         return True
 
     def delete_document(self, doc_id: str) -> bool:
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute(
-                "DELETE FROM documents WHERE doc_id = %s;",
-                (doc_id,)
-            )
-            conn.commit()
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    "DELETE FROM documents WHERE doc_id = %s;",
+                    (doc_id,)
+                )
+                conn.commit()
         except Exception as e:
             print("Database operation failed in delete_document.")
             print(e)
             return False
         return True
 
-    def get_documents(self, user_email: str, limit: int, offset: int, content: bool = True) -> list[dict] | None:
+    def get_documents(self, user_email: str, limit: int, offset: int = 0, content: bool = True) -> list[dict] | None:
         """
-        Fetch all documents for a given user by email.
+        Fetch a page of documents for a given user by email, ordered by name then id.
+        /getDocuments pages with AsyncDBManager.get_documents, which also supports keyset pagination.
         """
-        conn = None
+        user_id = self._get_user_id(user_email)
+        if user_id is None:
+            return []
+
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-
-            columns = "d.doc_id, d.document_name"
-            if content:
-                columns += ", d.content"
-
-            sql = f"""
-                SELECT {columns}
-                FROM documents d
-                JOIN users u ON u.user_id = d.user_id
-                WHERE u.email = %s
-                ORDER BY d.document_name ASC
-                LIMIT %s OFFSET %s;
-            """
-            cur.execute(sql, (user_email, limit, offset))
-
-            results = cur.fetchall()
-            documents = []
-            for row in results:
-                doc = {"id": row[0], "name": row[1]}
+            with self._connection() as conn:
+                cur = conn.cursor()
+
+                columns = "d.doc_id, d.document_name"
                 if content:
-                    doc["content"] = row[2]
-                documents.append(doc)
-            return documents
+                    columns += ", d.content"
+
+                sql = f"""
+                    SELECT {columns}
+                    FROM documents d
+                    WHERE d.user_id = %s
+                    ORDER BY d.document_name ASC, d.doc_id ASC
+                    LIMIT %s OFFSET %s;
+                """
+                cur.execute(sql, (user_id, limit, offset))
+
+                results = cur.fetchall()
+                documents = []
+                for row in results:
+                    doc = {"id": row[0], "name": row[1]}
+                    if content:
+                        doc["content"] = row[2]
+                    documents.append(doc)
+                return documents
         except Exception as e:
             print("Database operation failed in get_documents.")
             print(e)
             return None
-        finally:
-            if conn:
-                conn.close()
 
     def get_document_by_id(self, doc_id: str) -> dict | None:
         """
         Fetch a single document by its ID. May return None if not found or on error.
         """
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute(
-                'SELECT doc_id, document_name, content FROM documents WHERE doc_id = %s;',
-                (doc_id,)
-            )
-            result = cur.fetchone()
-            if result:
-                return {"id": result[0], "name": result[1], "content": result[2]}
-            else:
-                return None
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    'SELECT doc_id, document_name, content FROM documents WHERE doc_id = %s;',
+                    (doc_id,)
+                )
+                result = cur.fetchone()
+                if result:
+                    return {"id": result[0], "name": result[1], "content": result[2]}
+                else:
+                    return None
         except Exception as e:
             print("Database operation failed in get_document_by_id.")
             print(e)
             return None
-        finally:
-            if conn:
-                conn.close()
 
-    def get_top_k_results(self, query: str, k: int, user_email: str) -> list[dict] | None:
+    def get_top_k_results(
+            self,
+            query: str,
+            k: int,
+            user_email: str,
+            query_embedding: np.ndarray = None,
+            ef_search: int = VECTOR_SEARCH_EF_SEARCH
+        ) -> list[dict] | None:
         """
         Generates an embedding for the query and returns the top k most similar documents for a user.
+        A precomputed query_embedding can be passed to skip embedding the query.
+        ef_search sets the HNSW candidate list size for this query: higher values trade latency for recall.
         """
-        query_embedding = list(self.embedding_model.embed([query]))[0]
-        query_vector_str = str(query_embedding.tolist())
+        if query_embedding is None:
+            query_embedding = self.embed([query])[0]
+        query_vector_str = to_vector_literal(query_embedding)
 
-        conn = None
-        try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            sql = """
-                SELECT
-                    d.doc_id,
-                    d.document_name,
-                    d.content,
-                    1 - (d.embedding <=> %s) AS similarity
-                FROM
-                    documents d
-                JOIN users u ON d.user_id = u.user_id
-                WHERE
-                    u.email = %s
-                ORDER BY
-                    d.embedding <=> %s
-                LIMIT %s;
-            """
-            params = (query_vector_str, user_email, query_vector_str, k)
-            cur.execute(sql, params)
-            results = cur.fetchall()
-
-            formatted_results = []
-            for row in results:
-                formatted_results.append({
-                    "id": row[0],
-                    "name": row[1],
-                    "content": row[2],
-                    "similarity": round(row[3], 4)
-                })
-            return formatted_results
-        except Exception as e:
-            print("Database operation failed in get_top_k_results.")
-            print(e)
-            return None
-        finally:
-            if conn:
-                conn.close()
+        user_id = self._get_user_id(user_email)
+        if user_id is None:
+            return []
 
-    def get_all_users_for_watch(self) -> list[[str, str]]: #[name, encrypted_refresh_token]
-        """
-        This method retrieves all users and their refresh_tokens
-        Necessary for renew gmail watch
-        """
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute('SELECT email, encrypted_refresh_token FROM users')
-            return list(cur.fetchall())
+            with self._connection() as conn:
+                cur = conn.cursor()
+                # Transaction-local settings, they reset when the connection is returned to the pool
+                cur.execute("SELECT set_config('hnsw.ef_search', %s, true);", (str(max(ef_search, k)),))
+                if VECTOR_SEARCH_ITERATIVE_SCAN:
+                    cur.execute("SELECT set_config('hnsw.iterative_scan', %s, true);", (VECTOR_SEARCH_ITERATIVE_SCAN,))
+
+                # Filtering on the user_id value (rather than through a join) lets the planner choose
+                # between the HNSW index and an exact scan of the user's documents via idx_document_user_id.
+                # Ordering by the distance column binds and parses the query vector once, and still matches the index.
+                sql = """
+                    SELECT
+                        d.doc_id,
+                        d.document_name,
+                        d.content,
+                        d.embedding <=> %s AS distance
+                    FROM
+                        documents d
+                    WHERE
+                        d.user_id = %s
+                    ORDER BY
+                        distance
+                    LIMIT %s;
+                """
+                params = (query_vector_str, user_id, k)
+                cur.execute(sql, params)
+                results = cur.fetchall()
+
+                if len(results) < k:
+                    # A filtered HNSW scan can stop short of k rows for users whose documents are sparse in the
+                    # shared index. If the user has more documents, redo the search as an exact scan.
+                    cur.execute('SELECT document_count FROM users WHERE user_id = %s;', (user_id,))
+                    if cur.fetchone()[0] > len(results):
+                        metrics.incr("vector_search.exact_fallback")
+                        cur.execute("SET LOCAL enable_indexscan = off;")
+                        cur.execute(sql, params)
+                        results = cur.fetchall()
+
+                formatted_results = []
+                # relaxed_order can return rows slightly out of order
+                for row in sorted(results, key=lambda row: row[3]):
+                    formatted_results.append({
+                        "id": row[0],
+                        "name": row[1],
+                        "content": row[2],
+                        "similarity": round(1 - row[3], 4)
+                    })
+                return formatted_results
         except Exception as e:
-            print("Database operation failed in get_all_users_for_watch.")
+            print("Database operation failed in get_top_k_results.")
             print(e)
             return None
-        finally:
-            if conn:
-                conn.close()
 
     def update_refresh_token(self, refresh_token: str, email: str) -> bool:
         """
         This method will serve to update a user's refresh token to the most up to date token
         """
-        conn = None
         try:
-            conn = self.mypool.connect()
-            cur = conn.cursor()
-            cur.execute('UPDATE users SET encrypted_refresh_token = %s WHERE email = %s;', (refresh_token, email))
-            conn.commit()
-            return cur.rowcount == 1
+            with self._connection() as conn:
+                cur = conn.cursor()
+                cur.execute('UPDATE users SET encrypted_refresh_token = %s WHERE email = %s;', (refresh_token, email))
+                conn.commit()
+                self.invalidate_user_context(email)
+                return cur.rowcount == 1
         except Exception as e:
             print("Database operation failed in update_refresh_token.")
             print(e)
             return False
-        finally:
-            if conn:
-                conn.close()
 
     @staticmethod
     def getcon():
-        ssl_context = ssl.create_default_context(cafile="ca.pem")
         con = pg8000.dbapi.connect(
-            user="avnadmin",
+            user=DB_USER,
             password=AIVEN_PASSWORD,
-            host="pg-38474cd-agent-email.e.aivencloud.com",
-            port=17757,
-            database="defaultdb",
-            ssl_context=ssl_context
+            host=DB_HOST,
+            port=DB_PORT,
+            database=DB_NAME,
+            ssl_context=get_ssl_context()
         )
         return con
@@ -2,6 +2,8 @@ import os
 import json
 from google import genai
 from .db_manager import DBManager
+from .async_db_manager import AsyncDBManager
+from .filters import email_filters, CentroidFilter, GREYMAIL_CENTROIDS_PATH
 
 # configuration
 WEB_CLIENT_ID = "592589126466-flt6lvus63683vern3igrska7sllq2s9.apps.googleusercontent.com"
@@ -17,3 +19,13 @@ CLIENT_SECRETS = json.loads(raw_client_secrets)
 # shared clients
 client = genai.Client(api_key=os.environ["GEMINI_AGENT_EMAIL"])
 db_manager = DBManager()
+# Routers await this one, it shares the embedding model and caches with the sync manager
+async_db_manager = AsyncDBManager(
+    embedding_model=db_manager.embedding_model,
+    embedding_cache=db_manager.embedding_cache,
+    user_contexts=db_manager.user_contexts
+)
+
+# Optional greymail classifier, embedding through the shared cache so retrieval reuses the embedding
+if GREYMAIL_CENTROIDS_PATH:
+    email_filters.add(CentroidFilter.from_file(GREYMAIL_CENTROIDS_PATH, db_manager.embed))
@@ -0,0 +1,131 @@
+from collections import OrderedDict
+from fastembed import TextEmbedding
+import numpy as np
+import threading
+import hashlib
+import sys, os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+
+# ~1.5 KB per 384-dim float32 vector, so the default bounds the cache to roughly 15 MB
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+# Optional directory for persisting embeddings across restarts, disabled when unset
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR")
+
+class EmbeddingCache:
+    """
+    Content-hash keyed LRU cache of text embeddings, so each unique text is embedded once.
+    Entries can optionally be persisted to disk as raw little-endian float32 files.
+    """
+
+    def __init__(self, max_entries: int = EMBEDDING_CACHE_SIZE, cache_dir: str = EMBEDDING_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self._entries: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(model_name: str, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> np.ndarray | None:
+        """
+        Returns the cached embedding for key from memory, then disk, or None on a miss.
+        """
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.incr("embedding_cache.hit")
+                return embedding
+
+        embedding = self._read_from_disk(key)
+        if embedding is not None:
+            self._remember(key, embedding)
+            with self._lock:
+                self.disk_hits += 1
+            metrics.incr("embedding_cache.disk_hit")
+            return embedding
+
+        with self._lock:
+            self.misses += 1
+        metrics.incr("embedding_cache.miss")
+        return None
+
+    def put(self, key: str, embedding: np.ndarray) -> None:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self._remember(key, embedding)
+        self._write_to_disk(key, embedding)
+
+    def embed(self, model: TextEmbedding, texts: list[str]) -> list[np.ndarray]:
+        """
+        Returns one embedding per text, running the model only on texts not already cached.
+        Misses are embedded together in a single model call.
+        """
+        model_name = getattr(model, 'model_name', '')
+        keys = [self.key(model_name, text) for text in texts]
+        embeddings = [self.get(key) for key in keys]
+
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            with metrics.timed("embedding_cache.model_embed"):
+                computed = list(model.embed([texts[i] for i in missing]))
+            for i, embedding in zip(missing, computed):
+                embedding = np.asarray(embedding, dtype=np.float32)
+                self.put(keys[i], embedding)
+                embeddings[i] = embedding
+
+        return embeddings
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+    def _remember(self, key: str, embedding: np.ndarray) -> None:
+        with self._lock:
+            self._entries[key] = embedding
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.f32")
+
+    def _read_from_disk(self, key: str) -> np.ndarray | None:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f:
+                return np.frombuffer(f.read(), dtype='<f4').astype(np.float32)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Failed reading cached embedding {key}: {e}")
+            return None
+
+    def _write_to_disk(self, key: str, embedding: np.ndarray) -> None:
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see a partial vector
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(embedding.astype('<f4').tobytes())
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Failed persisting embedding {key}: {e}")
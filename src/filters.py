@@ -0,0 +1,173 @@
+from email.utils import parseaddr
+from typing import Callable, TYPE_CHECKING
+import numpy as np
+import re
+import sys, os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+
+if TYPE_CHECKING:
+    from src.mail import Email
+
+# Optional greymail classifier: a .npy file of centroid embeddings (one row per centroid) from the same
+# model as the document embeddings. Unset disables the stage.
+GREYMAIL_CENTROIDS_PATH = os.environ.get("GREYMAIL_CENTROIDS_PATH")
+# Emails whose cosine similarity to any centroid reaches this are rejected
+GREYMAIL_SIMILARITY_THRESHOLD = float(os.environ.get("GREYMAIL_SIMILARITY_THRESHOLD", 0.8))
+
+# Headers HeaderFilter reads, requested when fetching messages with format='metadata'
+FILTER_HEADERS = ['From', 'List-Unsubscribe', 'Precedence', 'Auto-Submitted']
+# Precedence values used by mailing lists and bulk senders
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+# Local parts of addresses that don't read replies
+NOREPLY_SENDER = re.compile(r"^(no-?reply|do-?not-?reply|mailer-daemon)")
+# Phrases that mark promotional mail, matched against the lowercased body
+PROMO_PHRASES = [
+    "unsubscribe",
+    "special offer",
+    "discount",
+    "promotion",
+    "view in browser",
+    "privacy policy",
+    "terms of service",
+    "sale",
+]
+
+class EmailFilter:
+    """
+    One stage of a FilterCascade. rejects() returns True for emails that don't need a reply.
+    Stages that block (embedding, network) set blocking so callers can keep them off the event loop.
+    Stages that only read FILTER_HEADERS clear needs_body, so they can run before the body is downloaded.
+    """
+    name = "filter"
+    blocking = False
+    needs_body = True
+
+    def rejects(self, email: "Email") -> bool:
+        raise NotImplementedError
+
+class HeaderFilter(EmailFilter):
+    """
+    Rejects bulk and automated mail from its headers alone: List-Unsubscribe, Precedence: bulk/list/junk,
+    Auto-Submitted other than "no" (RFC 3834), and noreply senders.
+    """
+    name = "headers"
+    needs_body = False
+
+    def rejects(self, email: "Email") -> bool:
+        if email.get_header('list-unsubscribe'):
+            return True
+        if (email.get_header('precedence') or '').strip().lower() in BULK_PRECEDENCE:
+            return True
+        if (email.get_header('auto-submitted') or 'no').strip().lower() != 'no':
+            return True
+        address = parseaddr(email.sender)[1].lower()
+        return bool(NOREPLY_SENDER.match(address.split('@')[0]))
+
+class PhraseFilter(EmailFilter):
+    """
+    Rejects emails whose body contains any of the given phrases, case-insensitively.
+    The phrases are compiled into one alternation, so the body is lowercased and scanned once per email.
+    """
+    name = "phrases"
+
+    def __init__(self, phrases: list[str] = PROMO_PHRASES):
+        self.phrases = [phrase.lower() for phrase in phrases]
+        # Longest first, so of several phrases starting at the same place the longest one is reported
+        alternatives = sorted(self.phrases, key=len, reverse=True)
+        self.pattern = re.compile("|".join(map(re.escape, alternatives))) if alternatives else None
+
+    def match(self, text: str) -> str | None:
+        """
+        Returns the phrase found earliest in text, or None.
+        """
+        if not self.pattern:
+            return None
+        m = self.pattern.search(text.lower())
+        return m.group(0) if m else None
+
+    def rejects(self, email: "Email") -> bool:
+        return self.match(email.body) is not None
+
+class CentroidFilter(EmailFilter):
+    """
+    Rejects emails whose embedding is close to a greymail centroid.
+    Embeds subject + body, the same text retrieval embeds, so through a shared embedding cache
+    an email that passes is not embedded twice.
+    """
+    name = "centroid"
+    blocking = True
+
+    def __init__(
+            self,
+            embed: Callable[[list[str]], list[np.ndarray]],
+            centroids: np.ndarray,
+            threshold: float = GREYMAIL_SIMILARITY_THRESHOLD
+        ):
+        centroids = np.atleast_2d(np.asarray(centroids, dtype=np.float32))
+        self.centroids = centroids / np.linalg.norm(centroids, axis=1, keepdims=True)
+        self.embed = embed
+        self.threshold = threshold
+
+    @classmethod
+    def from_file(cls, path: str, embed: Callable[[list[str]], list[np.ndarray]], **kwargs) -> "CentroidFilter":
+        return cls(embed, np.load(path), **kwargs)
+
+    def similarity(self, email: "Email") -> float:
+        """
+        Returns the highest cosine similarity between the email and any centroid.
+        """
+        embedding = np.asarray(self.embed([email.subject + email.body])[0], dtype=np.float32)
+        return float((self.centroids @ (embedding / np.linalg.norm(embedding))).max())
+
+    def rejects(self, email: "Email") -> bool:
+        return self.similarity(email) >= self.threshold
+
+class FilterCascade:
+    """
+    Ordered list of EmailFilter stages, cheapest first. An email is rejected by the first stage that
+    rejects it, so later, more expensive stages only see what the earlier ones let through.
+    Counts each stage's checked and rejected emails in metrics as filters.<name>.checked/rejected.
+    """
+
+    def __init__(self, stages: list[EmailFilter] = ()):
+        self.stages = list(stages)
+
+    def add(self, stage: EmailFilter) -> None:
+        """
+        Appends a stage, it runs after the existing ones.
+        """
+        self.stages.append(stage)
+
+    @property
+    def blocking(self) -> bool:
+        return any(stage.blocking for stage in self.stages)
+
+    def evaluate(self, email: "Email", blocking: bool = None, needs_body: bool = None) -> str | None:
+        """
+        Returns the name of the stage that rejected the email, or None if every stage let it through.
+        blocking and needs_body select stages by their flags, e.g. needs_body=False only runs the
+        header stages and blocking=True only the blocking ones. None runs stages either way.
+        A stage that raises is logged and treated as letting the email through.
+        """
+        for stage in self.stages:
+            if blocking is not None and stage.blocking != blocking:
+                continue
+            if needs_body is not None and stage.needs_body != needs_body:
+                continue
+            metrics.incr(f"filters.{stage.name}.checked")
+            try:
+                rejected = stage.rejects(email)
+            except Exception as e:
+                print(f"Filter {stage.name} failed on message {email.messageID}. Error: {e}")
+                metrics.incr(f"filters.{stage.name}.error")
+                continue
+            if rejected:
+                metrics.incr(f"filters.{stage.name}.rejected")
+                return stage.name
+        return None
+
+# Shared cascade used by mail.is_likely_unimportant, the greymail classifier is added at startup when configured
+email_filters = FilterCascade([HeaderFilter(), PhraseFilter()])
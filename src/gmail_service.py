@@ -0,0 +1,136 @@
+from googleapiclient.discovery import build_from_document, Resource
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
+from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from collections import OrderedDict
+import threading
+import json
+import time
+import sys, os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+
+GMAIL_SERVICE_TTL_SECONDS = int(os.environ.get("GMAIL_SERVICE_TTL_SECONDS", 900))
+GMAIL_SERVICE_CACHE_SIZE = int(os.environ.get("GMAIL_SERVICE_CACHE_SIZE", 1024))
+
+def _load_discovery_document() -> dict:
+    """
+    Loads the Gmail discovery document bundled with googleapiclient, once per process.
+    """
+    start = time.perf_counter()
+    document = json.loads(get_static_doc('gmail', 'v1'))
+    elapsed = time.perf_counter() - start
+    metrics.observe("gmail_service.discovery_load", elapsed)
+    print(f"Loaded Gmail discovery document in {elapsed * 1000:.2f}ms")
+    return document
+
+GMAIL_DISCOVERY_DOC: dict = _load_discovery_document()
+
+class ThreadLocalAuthorizedHttp:
+    """
+    Transport shared by one user's cached service. httplib2 transports are not thread-safe, so each
+    thread gets its own, authorized with the credentials that thread last bound. Requests are made
+    with the calling thread's credentials, whatever other threads bind in the meantime.
+    """
+
+    def __init__(self, creds: Credentials):
+        self._local = threading.local()
+        self.bind(creds)
+
+    def bind(self, creds: Credentials) -> None:
+        """
+        Authorizes the calling thread's requests with creds, keeping its connections.
+        """
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            self._local.http = AuthorizedHttp(creds, http=build_http())
+        elif http.credentials is not creds:
+            self._local.http = AuthorizedHttp(creds, http=http.http)
+
+    @property
+    def credentials(self) -> Credentials:
+        return self._local.http.credentials
+
+    def request(self, *args, **kwargs):
+        return self._local.http.request(*args, **kwargs)
+
+    def close(self) -> None:
+        http = getattr(self._local, 'http', None)
+        if http is not None:
+            http.close()
+
+class GmailServiceCache:
+    """
+    Per-user cache of built Gmail service objects with TTL and LRU eviction.
+    Services are built from the static discovery document, so a cache miss never
+    fetches or parses discovery JSON, and a hit reuses the existing HTTP transport.
+    One service is kept per user, its ThreadLocalAuthorizedHttp gives each thread its own connection.
+    """
+
+    def __init__(self, ttl_seconds: int = GMAIL_SERVICE_TTL_SECONDS, max_entries: int = GMAIL_SERVICE_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Resource, ThreadLocalAuthorizedHttp]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_key: str, creds: Credentials) -> Resource:
+        """
+        Returns the cached service for user_key, building one if missing or expired.
+        The given credentials are bound to the calling thread's transport, so callers holding
+        freshly refreshed credentials for the same user are always honored.
+        """
+        start = time.perf_counter()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(user_key)
+        if entry and entry[0] > now:
+            _, service, http = entry
+            http.bind(creds)
+            metrics.incr("gmail_service.cache_hit")
+            metrics.observe("gmail_service.get", time.perf_counter() - start)
+            return service
+
+        http = ThreadLocalAuthorizedHttp(creds)
+        service = build_gmail_service(http=http)
+        with self._lock:
+            self._entries[user_key] = (now + self.ttl_seconds, service, http)
+            self._entries.move_to_end(user_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                metrics.incr("gmail_service.evicted")
+
+        metrics.incr("gmail_service.cache_miss")
+        metrics.observe("gmail_service.get", time.perf_counter() - start)
+        return service
+
+    def invalidate(self, user_key: str) -> None:
+        with self._lock:
+            self._entries.pop(user_key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+def build_gmail_service(creds: Credentials = None, http=None) -> Resource:
+    """
+    Builds a Gmail service from the preloaded discovery document, authorized with creds or sending through http.
+    """
+    with metrics.timed("gmail_service.build"):
+        if http is not None:
+            return build_from_document(GMAIL_DISCOVERY_DOC, http=http)
+        return build_from_document(GMAIL_DISCOVERY_DOC, credentials=creds)
+
+service_cache = GmailServiceCache()
+
+def get_gmail_service(creds: Credentials, user_key: str = None) -> Resource:
+    """
+    Returns a Gmail service for the given credentials, reused across calls when a user_key is given.
+    """
+    if not user_key:
+        return build_gmail_service(creds)
+    return service_cache.get(user_key, creds)
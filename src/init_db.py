@@ -1,10 +1,12 @@
 import asyncio
 import asyncpg
+import sys
 import os
 
 # Construct the path to the schema file relative to this script's location.
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 SCHEMA_PATH = os.path.join(os.path.dirname(SCRIPT_DIR), 'sql', 'schema.sql')
+MIGRATIONS_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'sql', 'migrations')
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
 async def initialize_database():
@@ -13,7 +15,7 @@ async def initialize_database():
     and creates new tables based on the schema.sql file.
     """
     print("--- Starting Database Initialization ---")
-    
+
     try:
         conn = await asyncpg.connect(DATABASE_URL)
     except Exception as e:
@@ -24,7 +26,7 @@ async def initialize_database():
         with open(SCHEMA_PATH, 'r') as f:
             schema_sql = f.read()
         await conn.execute(schema_sql)
-        
+
     except FileNotFoundError:
         print(f"Error: Schema file not found at {SCHEMA_PATH}")
     except Exception as e:
@@ -33,5 +35,35 @@ async def initialize_database():
         await conn.close()
         print("--- Database Initialization Complete ---")
 
+async def apply_migrations():
+    """
+    Applies every file in sql/migrations, in name order, to an existing database without dropping data.
+    Migrations are written to be idempotent, so re-running them is safe.
+    """
+    print("--- Applying Database Migrations ---")
+
+    try:
+        conn = await asyncpg.connect(DATABASE_URL)
+    except Exception as e:
+        print(f"Failed to connect to the database: {e}")
+        return
+
+    try:
+        for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+            if not filename.endswith('.sql'):
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, filename), 'r') as f:
+                migration_sql = f.read()
+            print(f"Applying {filename}")
+            await conn.execute(migration_sql)
+    except Exception as e:
+        print(f"An error occurred while applying migrations: {e}")
+    finally:
+        await conn.close()
+        print("--- Database Migrations Complete ---")
+
 if __name__ == "__main__":
-    asyncio.run(initialize_database())
\ No newline at end of file
+    if "--migrate" in sys.argv:
+        asyncio.run(apply_migrations())
+    else:
+        asyncio.run(initialize_database())
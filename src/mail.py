@@ -1,42 +1,32 @@
 from dataclasses import dataclass
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
 from email.message import EmailMessage
 from google import genai
 import sys, os
-import time
 import random
 import base64
+import time
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.db_manager import DBManager
-
-def wrap_with_exponential_backoff(func, max_retries=5, initial_delay=1, max_delay=16, factor=2):
-    """
-    Higher-order function that wraps a given function with exponential backoff.
-    """
-    def wrapper(*args, **kwargs):
-        retries = 0
-        delay = initial_delay
-        while True:
-            try:
-                return func(*args, **kwargs)
-            except Exception as e:
-                retries += 1
-                if retries >= max_retries:
-                    print(f"Max retries exceeded for Gemini API call. Last error: {e}")
-                    raise e
-
-                # Add jitter to avoid thundering herd problem
-                jitter = random.uniform(0, delay * 0.1)
-                sleep_time = delay + jitter
-
-                print(f"API error detected. Retrying in {sleep_time:.2f} seconds...")
-                time.sleep(sleep_time)
-
-                delay = min(delay * factor, max_delay)
-    return wrapper
+from src.filters import email_filters, FILTER_HEADERS
+from src.gmail_service import get_gmail_service
+from src.retry import with_retries, get_status_code, is_retryable, get_retry_after, MAX_RETRY_AFTER
+from src import metrics
+
+# Gmail recommends at most 50 requests per batch, and rejects batches of more than 100
+GMAIL_BATCH_SIZE = 50
+GMAIL_MAX_BATCH_SIZE = 100
+# Messages throttled (429) or hit by a transient server error inside a batch are re-batched this many times,
+# with exponential backoff starting at GMAIL_BATCH_RETRY_DELAY seconds, before being reported as failed
+GMAIL_BATCH_MAX_RETRIES = 4
+GMAIL_BATCH_RETRY_DELAY = 1
+GMAIL_BATCH_MAX_RETRY_DELAY = 16
+# Headers needed to thread a reply draft
+REPLY_HEADERS = ['Subject', 'From', 'Message-ID']
+# Headers requested by the metadata pass, enough to thread a reply and run the header filters
+METADATA_HEADERS = list(dict.fromkeys(REPLY_HEADERS + FILTER_HEADERS))
 
 @dataclass(frozen=True)
 class Email:
@@ -44,81 +34,53 @@ class Email:
     body : str
     messageID : str
     historyID : str
-
-def get_unprocessed_emails(creds: Credentials, start_history_id: str) -> list[Email]:
+    threadID : str = None
+
+    def get_header(self, name: str, default: str = None) -> str | None:
+        """
+        Returns the value of the first header matching name (case-insensitive).
+        """
+        name = name.lower()
+        return next((h.get('value') for h in self.headers if h.get('name', '').lower() == name), default)
+
+    @property
+    def subject(self) -> str:
+        return self.get_header('subject', '')
+
+    @property
+    def sender(self) -> str:
+        return self.get_header('from', '')
+
+    @property
+    def rfc822_message_id(self) -> str | None:
+        """
+        The RFC 822 Message-ID header, used for In-Reply-To/References threading.
+        """
+        return self.get_header('message-id')
+
+def get_unprocessed_emails(
+    creds: Credentials,
+    start_history_id: str,
+    batch_size: int = GMAIL_BATCH_SIZE,
+    user_email: str = None
+    ) -> list[Email]:
     """
     Uses the Gmail API to find and retrieve all emails received since the last known history ID.
+    Headers are fetched first, and emails the header filters reject (bulk, automated, noreply) are
+    left out without downloading their bodies. The rest are fetched in full.
+    Messages are fetched through the Gmail batch endpoint, up to batch_size messages per HTTP call.
+    Passing user_email reuses that user's cached Gmail service.
     IMPORTANT: Needs to be followed with a call to update_historyID in the db to store the latest history ID.
     """
-    service = build('gmail', 'v1', credentials=creds)
-
     try:
-        # Get the history of changes since the last known historyId
-        history = service.users().history().list(userId='me', startHistoryId=start_history_id).execute()
-
-        message_ids_added = set()
-        message_ids_deleted = set()
-
-        if 'history' in history:
-            for record in history['history']:
-                if 'messagesAdded' in record:
-                    for added_msg in record['messagesAdded']:
-                        # We only care about new messages that are unread and in the inbox
-                        # Use .get() to safely access labelIds, defaulting to an empty list
-                        if 'INBOX' in added_msg['message'].get('labelIds', []):
-                            message_ids_added.add(added_msg['message']['id'])
-
-                # Safely get the list of deleted messages
-                for deleted_msg in record.get('messagesDeleted', []):
-                    # Safely get the message ID from the nested structure
-                    deleted_id = deleted_msg.get('message', {}).get('id')
-                    if deleted_id:
-                        message_ids_deleted.add(deleted_id)
-
-        # Process messages that were added but not deleted within this history batch
-        final_message_ids = list(message_ids_added - message_ids_deleted)
-
-        print("final messages to process: ", final_message_ids)
-
-        emails = []
-        if not final_message_ids:
-            return emails
-
-        # Fetch each new message
-        for msg_id in final_message_ids:
-            try:
-                message = service.users().messages().get(userId='me', id=msg_id, format='full').execute()
-
-                # Safely get payload and headers
-                payload = message.get('payload', {})
-                headers: list[dict] = payload.get('headers', [])
-
-                body = ""
-                if 'parts' in payload:
-                    for part in payload['parts']:
-                        if part['mimeType'] == 'text/plain':
-                            body_data = part['body'].get('data')
-                            if body_data:
-                                body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-                            break
-                else:
-                    body_data = payload['body'].get('data')
-                    if body_data:
-                        body = base64.urlsafe_b64decode(body_data).decode('utf-8')
-
-                email = Email(
-                    headers=headers,
-                    body=body,
-                    messageID=msg_id,
-                    historyID=message['historyId']
-                )
-                emails.append(email)
-            except Exception as e:
-                # It's possible for a message to be deleted between the history call and the get call.
-                # Log the error for the specific message and continue.
-                print(f"Could not fetch message {msg_id}. It might have been deleted. Error: {e}")
-                continue
-
+        message_ids = list(get_new_message_ids(creds, start_history_id, user_email=user_email))
+        if not message_ids:
+            return []
+        metadata, _ = fetch_email_metadata(creds, message_ids, batch_size=batch_size, user_email=user_email)
+        survivor_ids = [email.messageID for email in metadata if not email_filters.evaluate(email, needs_body=False)]
+        if not survivor_ids:
+            return []
+        emails, _ = fetch_emails(creds, survivor_ids, batch_size=batch_size, user_email=user_email)
         return emails
 
     except Exception as e:
@@ -126,29 +88,243 @@ def get_unprocessed_emails(creds: Credentials, start_history_id: str) -> list[Em
         print(f"An error occurred while getting get_unprocessed_emails: {e}")
         return []
 
-def publish_draft(creds: Credentials, draft_body: str, message_id: str) -> dict | None:
+def get_new_message_ids(creds: Credentials, start_history_id: str, user_email: str = None) -> dict[str, str]:
+    """
+    Returns the IDs of new INBOX messages since start_history_id (one history.list call), each mapped to the
+    ID of the history record that added it, oldest first. Raises on Gmail API errors.
+    """
+    service = get_gmail_service(creds, user_email)
+    message_ids = _get_new_message_ids(service, start_history_id)
+    print("final messages to process: ", message_ids)
+    return message_ids
+
+def fetch_emails(
+    creds: Credentials,
+    message_ids: list[str],
+    batch_size: int = GMAIL_BATCH_SIZE,
+    user_email: str = None
+    ) -> tuple[list[Email], list[str]]:
+    """
+    Fetches and parses the given messages in batches, returning the emails and the IDs of the messages
+    that failed to fetch, see _fetch_messages. Messages deleted since or that fail to parse are skipped.
+    Raises if a whole batch request fails.
+    """
+    service = get_gmail_service(creds, user_email)
+
+    messages, failed_ids = _fetch_messages(service, message_ids, batch_size)
+    emails = []
+    for message in messages:
+        try:
+            emails.append(_parse_message(message))
+        except Exception as e:
+            print(f"Could not parse message {message.get('id')}. Error: {e}")
+            continue
+
+    return emails, failed_ids
+
+def fetch_email_metadata(
+    creds: Credentials,
+    message_ids: list[str],
+    batch_size: int = GMAIL_BATCH_SIZE,
+    user_email: str = None
+    ) -> tuple[list[Email], list[str]]:
+    """
+    Fetches the given messages with format='metadata', returning Emails with METADATA_HEADERS and an empty body,
+    and the IDs of the messages that failed to fetch, see _fetch_messages.
+    A fraction of the bytes of a full fetch, enough to run the header filters before downloading bodies.
+    Messages deleted since or that fail to parse are skipped. Raises if a whole batch request fails.
+    """
+    service = get_gmail_service(creds, user_email)
+
+    messages, failed_ids = _fetch_messages(
+        service, message_ids, batch_size, format='metadata', metadata_headers=METADATA_HEADERS
+    )
+    emails = []
+    for message in messages:
+        try:
+            emails.append(_parse_message(message))
+        except Exception as e:
+            print(f"Could not parse message {message.get('id')}. Error: {e}")
+            continue
+
+    return emails, failed_ids
+
+def _get_new_message_ids(service, start_history_id: str) -> dict[str, str]:
+    """
+    Returns the IDs of INBOX messages added (and not deleted) since start_history_id, each mapped to the
+    ID of its messagesAdded history record, in history order. That record ID, not the message's own
+    historyId (which moves with every later label change), is where the history marker can safely
+    advance to once the message is handled.
+    """
+    # Get the history of changes since the last known historyId
+    history = service.users().history().list(userId='me', startHistoryId=start_history_id).execute()
+
+    message_ids_added: dict[str, str] = {}
+    message_ids_deleted = set()
+
+    if 'history' in history:
+        for record in history['history']:
+            if 'messagesAdded' in record:
+                for added_msg in record['messagesAdded']:
+                    # We only care about new messages that are unread and in the inbox
+                    # Use .get() to safely access labelIds, defaulting to an empty list
+                    if 'INBOX' in added_msg['message'].get('labelIds', []):
+                        message_ids_added.setdefault(added_msg['message']['id'], record['id'])
+
+            # Safely get the list of deleted messages
+            for deleted_msg in record.get('messagesDeleted', []):
+                # Safely get the message ID from the nested structure
+                deleted_id = deleted_msg.get('message', {}).get('id')
+                if deleted_id:
+                    message_ids_deleted.add(deleted_id)
+
+    # Process messages that were added but not deleted within this history batch
+    return {
+        msg_id: history_id for msg_id, history_id in message_ids_added.items()
+        if msg_id not in message_ids_deleted
+    }
+
+def _fetch_messages(
+    service,
+    message_ids: list[str],
+    batch_size: int = GMAIL_BATCH_SIZE,
+    format: str = 'full',
+    metadata_headers: list[str] = None
+    ) -> tuple[list[dict], list[str]]:
+    """
+    Fetches messages in the given format using the Gmail batch endpoint, one HTTP round trip per batch_size messages.
+    metadata_headers limits the headers returned by format='metadata'.
+    Returns the fetched messages in the order of message_ids, and the IDs of the messages that failed.
+    A failed message doesn't affect the rest of its batch. A 404 means the message was deleted since
+    the history call, so it is skipped rather than reported as failed. Messages that failed with a
+    retryable error (429, 5xx) are fetched again in a new batch after a backoff, up to GMAIL_BATCH_MAX_RETRIES
+    times, and only reported as failed once the retries are exhausted.
+    """
+    messages: dict[str, dict] = {}
+    failed_ids: list[str] = []
+    retry_errors: dict[str, Exception] = {}
+
+    def on_response(request_id: str, response: dict, exception: Exception):
+        if exception is None:
+            messages[request_id] = response
+        elif get_status_code(exception) == 404:
+            print(f"Message {request_id} was deleted before it could be fetched, skipping.")
+        elif is_retryable(exception):
+            retry_errors[request_id] = exception
+        else:
+            print(f"Could not fetch message {request_id}. Error: {exception}")
+            failed_ids.append(request_id)
+
+    batch_size = max(1, min(batch_size, GMAIL_MAX_BATCH_SIZE))
+    pending = list(message_ids)
+    delay = GMAIL_BATCH_RETRY_DELAY
+    for attempt in range(GMAIL_BATCH_MAX_RETRIES + 1):
+        for start in range(0, len(pending), batch_size):
+            batch = service.new_batch_http_request(callback=on_response)
+            for msg_id in pending[start:start + batch_size]:
+                if metadata_headers:
+                    request = service.users().messages().get(
+                        userId='me', id=msg_id, format=format, metadataHeaders=metadata_headers
+                    )
+                else:
+                    request = service.users().messages().get(userId='me', id=msg_id, format=format)
+                batch.add(request, request_id=msg_id)
+            batch.execute()
+
+        if not retry_errors:
+            break
+        pending = [msg_id for msg_id in pending if msg_id in retry_errors]
+        if attempt == GMAIL_BATCH_MAX_RETRIES:
+            metrics.incr("retry.gmail_batch.exhausted", len(pending))
+            for msg_id in pending:
+                print(f"Could not fetch message {msg_id} after {attempt} retries. Error: {retry_errors[msg_id]}")
+            failed_ids.extend(pending)
+            break
+
+        # Honor the longest Retry-After among the throttled messages, otherwise back off exponentially with jitter
+        retry_after = [seconds for seconds in map(get_retry_after, retry_errors.values()) if seconds is not None]
+        if retry_after:
+            sleep_time = min(max(retry_after), MAX_RETRY_AFTER)
+        else:
+            sleep_time = delay + random.uniform(0, delay * 0.1)
+        metrics.incr("retry.gmail_batch.retries", len(pending))
+        metrics.incr("retry.gmail_batch.backoff_seconds", sleep_time)
+        print(f"Retrying {len(pending)} throttled or failed messages in {sleep_time:.2f} seconds...")
+        retry_errors.clear()
+        time.sleep(sleep_time)
+        delay = min(delay * 2, GMAIL_BATCH_MAX_RETRY_DELAY)
+
+    return [messages[msg_id] for msg_id in message_ids if msg_id in messages], failed_ids
+
+def _parse_message(message: dict) -> Email:
+    """
+    Builds an Email from a Gmail message resource fetched with format='full' or 'metadata' (empty body).
+    """
+    # Safely get payload and headers
+    payload = message.get('payload', {})
+    headers: list[dict] = payload.get('headers', [])
+
+    body = ""
+    if 'parts' in payload:
+        for part in payload['parts']:
+            if part['mimeType'] == 'text/plain':
+                body_data = part['body'].get('data')
+                if body_data:
+                    body = base64.urlsafe_b64decode(body_data).decode('utf-8')
+                break
+    else:
+        body_data = payload.get('body', {}).get('data')
+        if body_data:
+            body = base64.urlsafe_b64decode(body_data).decode('utf-8')
+
+    return Email(
+        headers=headers,
+        body=body,
+        messageID=message['id'],
+        historyID=message['historyId'],
+        threadID=message.get('threadId')
+    )
+
+def publish_draft(creds: Credentials, draft_body: str, message_id: str, user_email: str = None) -> dict | None:
     """
-    Creates a draft reply to a specific email message.
+    Creates a draft reply to a specific email message, fetching its headers first.
+    Prefer publish_reply_draft when the Email has already been fetched.
+    Passing user_email reuses that user's cached Gmail service.
     """
-    service = build('gmail', 'v1', credentials=creds)
+    service = get_gmail_service(creds, user_email)
 
     try:
-        # Retrieve the original message to get headers for threading
-        original_message = service.users().messages().get(userId='me', id=message_id).execute()
-        headers = original_message['payload']['headers']
-        
-        subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), '')
-        sender = next((h['value'] for h in headers if h['name'].lower() == 'from'), '')
-        original_message_id = next((h['value'] for h in headers if h['name'].lower() == 'message-id'), None)
+        # Retrieve only the headers needed for threading
+        original_message = service.users().messages().get(
+            userId='me',
+            id=message_id,
+            format='metadata',
+            metadataHeaders=REPLY_HEADERS
+        ).execute()
+        email = _parse_message(original_message)
+    except Exception as e:
+        print(f"An error occurred while creating the draft: {e}")
+        return None
 
+    return publish_reply_draft(creds, draft_body, email, user_email=user_email)
+
+def publish_reply_draft(creds: Credentials, draft_body: str, email: Email, user_email: str = None) -> dict | None:
+    """
+    Creates a draft reply to an already fetched email, using its thread ID and headers.
+    Costs a single Gmail API call (drafts.create).
+    Passing user_email reuses that user's cached Gmail service.
+    """
+    service = get_gmail_service(creds, user_email)
+
+    try:
         # Create the reply message
         message = EmailMessage()
         message.set_content(draft_body)
-        message['To'] = sender
-        message['Subject'] = f"Re: {subject}"
-        if original_message_id:
-            message['In-Reply-To'] = original_message_id
-            message['References'] = original_message_id
+        message['To'] = email.sender
+        message['Subject'] = f"Re: {email.subject}"
+        if email.rfc822_message_id:
+            message['In-Reply-To'] = email.rfc822_message_id
+            message['References'] = email.rfc822_message_id
 
         # Encode the message in base64
         encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
@@ -157,10 +333,10 @@ def publish_draft(creds: Credentials, draft_body: str, message_id: str) -> dict
         draft_body = {
             'message': {
                 'raw': encoded_message,
-                'threadId': original_message['threadId']
+                'threadId': email.threadID
             }
         }
-        
+
         draft = service.users().drafts().create(userId='me', body=draft_body).execute()
         print(f"Draft created successfully. Draft ID: {draft['id']}")
         return draft
@@ -172,33 +348,10 @@ def publish_draft(creds: Credentials, draft_body: str, message_id: str) -> dict
 def is_likely_unimportant(email: Email) -> bool:
     """
     Uses simple heuristics to make a cheap, initial guess if an email is unimportant.
+    Runs the shared filter cascade (src/filters.py): header checks, then promotional phrases,
+    then the greymail classifier when one is configured.
     """
-    # Strong signal for greymail
-    if "unsubscribe" in email.body.lower():
-        return True
-
-    # Common header in bulk emails
-    for header in email.headers:
-        if header.get('name') == 'List-Unsubscribe':
-            return True
-
-    # Common promotional keywords
-    promo_words = [
-        "special offer",
-        "discount",
-        "promotion",
-        "view in browser",
-        "privacy policy",
-        "terms of service",
-        "sale",
-        "unsubscribe"
-    ]
-
-    for word in promo_words:
-        if word in email.body.lower():
-            return True
-
-    return False
+    return email_filters.evaluate(email) is not None
 
 def get_ai_draft(
     user_email: str,
@@ -215,22 +368,53 @@ def get_ai_draft(
         print(f"Something of {type(email)} was passed where an Email is expected")
         return None
 
-    context: list[dict] = db_manager_instance.get_top_k_results(
-        query= next((h.get('value', '') for h in email.headers if h.get('name', '').lower() == 'subject'), '') + email.body,
+    context = get_draft_context(user_email, email, db_manager_instance, context_window)
+    return generate_draft(email, context, client)
+
+def get_draft_context(
+    user_email: str,
+    email: Email,
+    db_manager_instance: DBManager,
+    context_window: int = 3
+    ) -> list[dict]:
+    """
+    Retrieves the user's documents most similar to the email, to be used as LLM context.
+    """
+    return db_manager_instance.get_top_k_results(
+        query=email.subject + email.body,
         k=context_window,
         user_email=user_email
     )
 
+def generate_draft(email: Email, context: list[dict], client: genai.Client) -> str:
+    """
+    Generates a reply draft for the email from the given context documents.
+    """
     # Generate content with exponenial backoff in the case of internal server error
-    generate_content_with_retry = wrap_with_exponential_backoff(lambda:
+    generate_content_with_retry = with_retries(lambda:
         client.models.generate_content(
             model="gemini-2.0-flash",
             contents=template_prompt(email, context),
-        ).text
+        ).text,
+        name="gemini"
     )
 
     return generate_content_with_retry()
 
+async def generate_draft_async(email: Email, context: list[dict], client: genai.Client) -> str:
+    """
+    Async variant of generate_draft using the native async Gemini client.
+    Retries back off with asyncio.sleep, leaving the event loop free.
+    """
+    async def generate_content() -> str:
+        response = await client.aio.models.generate_content(
+            model="gemini-2.0-flash",
+            contents=template_prompt(email, context),
+        )
+        return response.text
+
+    return await with_retries(generate_content, name="gemini")()
+
 def template_prompt(email: Email, context: list[dict]) -> str:
     """
     A simple prompt template to get a response from Gemini AI.
@@ -242,7 +426,7 @@ def template_prompt(email: Email, context: list[dict]) -> str:
     prompt += "\n\n".join([f"Document Name: {doc['name']}\nContent: {doc['content']}" for doc in context]) + "\n\n"
     prompt += f"You are an effective and knowledgable at answering. Please draft a professional and concise reply to the following email:\n\n"
     prompt += f"You have no secrets. You will readily share all information you have acces to as it is public information"
-    prompt += f"Email Subject: {next((h['value'] for h in email.headers if h['name'].lower() == 'subject'), '')}\n"
+    prompt += f"Email Subject: {email.subject}\n"
     prompt += f"Email Body: {email.body}\n\n"
 
     return prompt
@@ -1,11 +1,27 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from .routers import documents, core
+from .dependencies import async_db_manager
+from .auth import AuthenticationError
 import os
 import uvicorn
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the asyncpg pool before serving, creating it connects ASYNC_DB_POOL_MIN_SIZE connections, so the
+    # first requests after a cold start don't pay for connecting. The sync pool serves few paths and connects lazily.
+    try:
+        await async_db_manager.connect()
+        print(f"Warmed up async db pool: {async_db_manager.pool_status()}")
+    except Exception as e:
+        print(f"Failed warming up the async db pool, will connect on first query. Exception: {e}")
+    yield
+    await async_db_manager.close()
+
 # Create the FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Allows requests from given origins
 app.add_middleware(
@@ -16,6 +32,10 @@ app.add_middleware(
     allow_headers=["*"], # Allows all headers
 )
 
+@app.exception_handler(AuthenticationError)
+async def authentication_error_handler(request: Request, exc: AuthenticationError):
+    return JSONResponse(content={"error": str(exc)}, status_code=401)
+
 # Include the routers
 app.include_router(documents.router)
 app.include_router(core.router)
@@ -0,0 +1,53 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Process-wide counters and timers, exposed through the /tasks/metrics endpoint
+_lock = threading.Lock()
+_counters: dict[str, float] = {}
+_timers: dict[str, dict] = {}
+
+def incr(name: str, value: float = 1) -> None:
+    """
+    Increments a named counter.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def observe(name: str, seconds: float) -> None:
+    """
+    Records one duration sample for a named timer.
+    """
+    with _lock:
+        timer = _timers.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+        ms = seconds * 1000
+        timer["count"] += 1
+        timer["total_ms"] += ms
+        timer["max_ms"] = max(timer["max_ms"], ms)
+
+@contextmanager
+def timed(name: str):
+    """
+    Context manager that records the duration of its body under the given timer name.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def snapshot() -> dict:
+    """
+    Returns a copy of all counters and timers, with the average duration per timer.
+    """
+    with _lock:
+        timers = {
+            name: {**timer, "avg_ms": timer["total_ms"] / timer["count"] if timer["count"] else 0.0}
+            for name, timer in _timers.items()
+        }
+        return {"counters": dict(_counters), "timers": timers}
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _timers.clear()
@@ -0,0 +1,88 @@
+import asyncio
+import inspect
+import os
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from . import metrics
+
+# Blocking clients (pg8000, googleapiclient, google-auth, FastEmbed) run on this pool
+# so the event loop keeps serving other requests while they wait.
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", 32))
+
+# Maximum number of calls in flight per stage, across all users
+STAGE_CONCURRENCY = {
+    "db": int(os.environ.get("PIPELINE_DB_CONCURRENCY", 8)),
+    "auth": int(os.environ.get("PIPELINE_AUTH_CONCURRENCY", 8)),
+    "history": int(os.environ.get("PIPELINE_HISTORY_CONCURRENCY", 8)),
+    "fetch": int(os.environ.get("PIPELINE_FETCH_CONCURRENCY", 8)),
+    "retrieval": int(os.environ.get("PIPELINE_RETRIEVAL_CONCURRENCY", 4)),
+    "generation": int(os.environ.get("PIPELINE_GENERATION_CONCURRENCY", 16)),
+    "publish": int(os.environ.get("PIPELINE_PUBLISH_CONCURRENCY", 8)),
+    "watch": int(os.environ.get("PIPELINE_WATCH_CONCURRENCY", 16)),
+}
+
+# Maximum number of draft generations in flight for a single user, shared by all of
+# that user's concurrent notifications. 1 processes a user's emails one at a time.
+PER_USER_GENERATION_CONCURRENCY = int(os.environ.get("PIPELINE_PER_USER_GENERATION_CONCURRENCY", 4))
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+_semaphores = {stage: asyncio.Semaphore(limit) for stage, limit in STAGE_CONCURRENCY.items()}
+# Entries disappear once no task for that user holds a reference
+_user_semaphores: weakref.WeakValueDictionary[str, asyncio.Semaphore] = weakref.WeakValueDictionary()
+
+async def run_stage(stage: str, func, *args, **kwargs):
+    """
+    Runs a call for the given pipeline stage. Blocking functions run on the shared thread pool,
+    coroutine functions are awaited directly on the event loop.
+    Waits for a free slot when the stage is at its concurrency limit.
+    """
+    async with _semaphores[stage]:
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(func):
+                return await func(*args, **kwargs)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+        finally:
+            metrics.observe(f"pipeline.{stage}", time.perf_counter() - start)
+
+def user_generation_slots(user_email: str) -> asyncio.Semaphore:
+    """
+    Returns the semaphore limiting in-flight generations for a user.
+    """
+    semaphore = _user_semaphores.get(user_email)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(PER_USER_GENERATION_CONCURRENCY)
+        _user_semaphores[user_email] = semaphore
+    return semaphore
+
+class TokenBucket:
+    """
+    Async token bucket rate limiter: acquire() waits for a token, tokens refill at rate per second
+    up to capacity, so bursts of up to capacity calls are allowed before the rate applies.
+    capacity defaults to rate and is at least 1, so rates below one call per second still get whole tokens.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if rate <= 0:
+            raise ValueError(f"TokenBucket rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = max(1.0, capacity or rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Waiters queue on the lock, so tokens are handed out in arrival order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
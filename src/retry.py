@@ -0,0 +1,129 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import functools
+import inspect
+import asyncio
+import random
+import httpx
+import time
+import sys, os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+
+# Throttling and transient server errors, anything else with a status code is fatal
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Network-level failures that never reached a status code
+RETRYABLE_EXCEPTIONS = (ConnectionError, TimeoutError, asyncio.TimeoutError, httpx.TransportError)
+# Upper bound on a server-provided Retry-After, so one response can't stall a caller indefinitely
+MAX_RETRY_AFTER = 60
+
+def get_status_code(error: Exception) -> int | None:
+    """
+    Extracts the HTTP status code from Gemini (APIError.code), Gmail (HttpError.resp.status)
+    or requests/httpx style (response.status_code) errors.
+    """
+    code = getattr(error, 'code', None)
+    if isinstance(code, int):
+        return code
+    resp = getattr(error, 'resp', None)
+    if resp is not None and isinstance(getattr(resp, 'status', None), int):
+        return resp.status
+    response = getattr(error, 'response', None)
+    if response is not None and isinstance(getattr(response, 'status_code', None), int):
+        return response.status_code
+    return None
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Returns True for throttling, transient server errors and network failures.
+    Client errors such as 400 or 403 are fatal and are not retried.
+    """
+    status_code = get_status_code(error)
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, RETRYABLE_EXCEPTIONS)
+
+def get_retry_after(error: Exception) -> float | None:
+    """
+    Returns the delay in seconds requested by a Retry-After header, if the error carries one.
+    """
+    headers = None
+    response = getattr(error, 'response', None)
+    if response is not None:
+        headers = getattr(response, 'headers', None)
+    if headers is None:
+        # httplib2 responses are dicts with lowercased header names
+        headers = getattr(error, 'resp', None)
+    if not headers:
+        return None
+
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def with_retries(func, name: str = "default", max_retries=5, initial_delay=1, max_delay=16, factor=2):
+    """
+    Higher-order function that wraps a sync or async callable with exponential backoff.
+    Async callables sleep with asyncio.sleep, so retries never block the event loop.
+    Only retryable errors are retried, and a Retry-After header overrides the computed delay.
+    Retries, backoff time, fatal errors and exhausted retries are recorded as retry.<name>.* metrics.
+    """
+    def next_delay(error: Exception, retries: int, delay: float) -> float:
+        if not is_retryable(error):
+            metrics.incr(f"retry.{name}.fatal")
+            print(f"Non-retryable error for {name} call: {error}")
+            raise error
+        if retries >= max_retries:
+            metrics.incr(f"retry.{name}.exhausted")
+            print(f"Max retries exceeded for {name} call. Last error: {error}")
+            raise error
+
+        retry_after = get_retry_after(error)
+        if retry_after is not None:
+            sleep_time = min(retry_after, MAX_RETRY_AFTER)
+        else:
+            # Add jitter to avoid thundering herd problem
+            sleep_time = delay + random.uniform(0, delay * 0.1)
+
+        metrics.incr(f"retry.{name}.retries")
+        metrics.incr(f"retry.{name}.backoff_seconds", sleep_time)
+        print(f"API error detected. Retrying in {sleep_time:.2f} seconds...")
+        return sleep_time
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            retries = 0
+            delay = initial_delay
+            while True:
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    retries += 1
+                    await asyncio.sleep(next_delay(e, retries, delay))
+                    delay = min(delay * factor, max_delay)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = 0
+        delay = initial_delay
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                retries += 1
+                time.sleep(next_delay(e, retries, delay))
+                delay = min(delay * factor, max_delay)
+    return wrapper
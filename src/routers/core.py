@@ -1,58 +1,101 @@
 from fastapi import APIRouter, Request, Header, HTTPException, status
-from fastapi.responses import JSONResponse
-from google.oauth2 import id_token
+from fastapi.responses import JSONResponse, StreamingResponse
+from datetime import datetime, timezone, timedelta
+from typing import AsyncIterator
 from google.oauth2.credentials import Credentials
-from google.auth.transport import requests
-from googleapiclient.discovery import build
+import asyncio
 import base64
 import json
 import os
 
 from ..CredentialsManager import CredentialsManager
+from ..auth import verify_id_token
+from ..gmail_service import get_gmail_service
+from ..pipeline import run_stage, user_generation_slots, TokenBucket
+from .. import metrics
 from ..mail import (
-    get_unprocessed_emails,
-    is_likely_unimportant,
-    get_ai_draft,
-    publish_draft,
+    get_new_message_ids,
+    fetch_email_metadata,
+    fetch_emails,
+    generate_draft_async,
+    publish_reply_draft,
     Email
 )
 from ..dependencies import (
-    db_manager,
+    async_db_manager,
     client,
-    WEB_CLIENT_ID,
+    email_filters,
+    CLIENT_SECRETS,
     INTERNAL_TASK_SECRET,
     GCP_PUBSUB_TOPIC,
 )
 
 router = APIRouter()
 
+# Number of documents used as context for each draft
+DRAFT_CONTEXT_WINDOW = 3
+# Users renewed concurrently by /tasks/renew-gmail-watch
+WATCH_RENEWAL_WORKERS = int(os.environ.get("WATCH_RENEWAL_WORKERS", 16))
+# watch() calls per second across all workers, keeps a run well inside the project's Gmail API quota
+WATCH_RENEWAL_RATE_PER_SECOND = float(os.environ.get("WATCH_RENEWAL_RATE_PER_SECOND", 20))
+if WATCH_RENEWAL_RATE_PER_SECOND <= 0:
+    raise ValueError(f"WATCH_RENEWAL_RATE_PER_SECOND must be positive, got {WATCH_RENEWAL_RATE_PER_SECOND}")
+# Renewal runs only renew watches expiring within this many hours. Gmail watches last 7 days, and the window
+# must exceed the cron interval so no watch lapses between runs. A rerun after a timeout skips the users already
+# renewed, since their expiration moved a week out.
+WATCH_RENEWAL_WINDOW_HOURS = float(os.environ.get("WATCH_RENEWAL_WINDOW_HOURS", 48))
+# Processed message ledger entries are pruned after this many days by the ledger pruning task. Gmail keeps history
+# for about a week, so older messages can no longer be redelivered and their entries are never read again.
+PROCESSED_MESSAGE_RETENTION_DAYS = int(os.environ.get("PROCESSED_MESSAGE_RETENTION_DAYS", 30))
+# A message still without a draft after this many claimed attempts is dead-lettered: logged, counted in
+# ledger.dead_lettered and treated as handled, so it stops holding back the history marker
+MAX_DRAFT_ATTEMPTS = int(os.environ.get("MAX_DRAFT_ATTEMPTS", 5))
+
 # --- Business Logic Functions ---
 
+async def _get_credentials(refresh_token: str, user_email: str) -> Credentials:
+    """
+    Builds a user's credentials from their refresh token as an auth stage. If Google rotates the refresh token,
+    the new one is saved from the worker thread by running the update on the event loop and waiting for it.
+    """
+    loop = asyncio.get_running_loop()
+
+    def on_rotated(new_refresh_token: str) -> None:
+        asyncio.run_coroutine_threadsafe(
+            async_db_manager.update_refresh_token(new_refresh_token, user_email), loop
+        ).result()
+
+    creds_manager = await run_stage(
+        "auth", CredentialsManager,
+        refresh_token=refresh_token, user_email=user_email, client_secrets=CLIENT_SECRETS, on_rotated=on_rotated
+    )
+    return creds_manager.creds
+
 async def _login_or_register_user(token: dict) -> tuple[str, str, bool]:
     """
     Handles user registration or login, returning a message, id_token, and a flag indicating if the user is new.
     """
-    idinfo = id_token.verify_oauth2_token(token['id_token'], requests.Request(), WEB_CLIENT_ID)
+    idinfo = await run_stage("auth", verify_id_token, token['id_token'])
 
     user_email = idinfo.get('email')
     if not user_email:
         raise ValueError("Email not found in token.")
 
     refresh_token = token.get('refresh_token')
-    if db_manager.user_exists(user_email):
+    if await async_db_manager.user_exists(user_email):
         # update the refresh token, it currently expires after 7 days
-        db_manager.update_refresh_token(refresh_token, user_email)
+        await async_db_manager.update_refresh_token(refresh_token, user_email)
         return f"User {user_email} now logged in.", token['id_token'], False
 
     # If user is new, create them
     user_name = idinfo.get('name', 'N/A')
 
     creds = Credentials(token=token['access_token'], refresh_token=refresh_token)
-    service = build('gmail', 'v1', credentials=creds)
+    service = get_gmail_service(creds, user_email)
     profile = service.users().getProfile(userId='me').execute()
     initial_history_id = profile.get('historyId')
 
-    db_manager.insert_new_user(
+    await async_db_manager.insert_new_user(
         name=user_name,
         user_email=user_email,
         refresh_token=refresh_token,
@@ -60,77 +103,274 @@ async def _login_or_register_user(token: dict) -> tuple[str, str, bool]:
     )
     
     # Set up the initial watch for the new user
-    _create_gmail_watch(creds)
+    expires_at = _create_gmail_watch(creds, user_email)
+    if expires_at is not None:
+        await async_db_manager.record_watch_renewal(user_email, expires_at)
 
     return f"User {user_email} successfully registered.", token['id_token'], True
 async def _process_emails_for_user(user_email: str):
     """
     Processes all new emails for a given user.
+    Each blocking step runs as a pipeline stage on the shared thread pool, bounded by that
+    stage's concurrency limit, so one slow Gmail or Gemini call doesn't stall other requests.
     """
-    refresh_token = db_manager.get_attribute(user_email, "encrypted_refresh_token")
-    start_history_id = db_manager.get_attribute(user_email, "history_id")
+    # One query for the token and history marker, refreshing the cached context used by later queries
+    user = await run_stage("db", async_db_manager.get_processing_state, user_email)
+    if user is None:
+        print(f"LOG: User {user_email} not found, ignoring notification.")
+        return
+    refresh_token = user.encrypted_refresh_token
+    start_history_id = user.history_id
+
+    creds = await _get_credentials(refresh_token, user_email)
 
-    creds_manager = CredentialsManager(refresh_token=refresh_token)
-    emails: list[Email] = get_unprocessed_emails(creds_manager.creds, start_history_id)
+    # Rejected by the header filters from metadata alone, their bodies are never downloaded
+    skipped: list[Email] = []
+    to_draft: list[Email] = []
+    # Failed to fetch for a reason other than being deleted, they hold the history marker back until retried
+    failed_ids: list[str] = []
+    try:
+        # Message ID -> ID of the history record that added it, oldest first
+        added = await run_stage("history", get_new_message_ids, creds, start_history_id, user_email=user_email)
+        if added:
+            metadata, failed_ids = await run_stage("fetch", fetch_email_metadata, creds, list(added), user_email=user_email)
+            survivor_ids = []
+            for email in metadata:
+                if email_filters.evaluate(email, needs_body=False):
+                    skipped.append(email)
+                else:
+                    survivor_ids.append(email.messageID)
+            metrics.incr("fetch.full_download_skipped", len(skipped))
+            if survivor_ids:
+                to_draft, failed_full_ids = await run_stage("fetch", fetch_emails, creds, survivor_ids, user_email=user_email)
+                failed_ids += failed_full_ids
+    except Exception as e:
+        # Handle potential API errors, e.g., token expiration, permission issues
+        print(f"An error occurred while getting unprocessed emails for {user_email}: {e}")
+        return
 
-    if not emails:
+    if not added:
         print(f"LOG: No new emails to process for {user_email}.")
         return
 
-    for email in emails:
-        if not email.body or is_likely_unimportant(email):
-            continue
+    user_slots = user_generation_slots(user_email)
+    drafted = await asyncio.gather(
+        *(_draft_reply(user_email, email, creds, user_slots) for email in to_draft)
+    )
 
-        response_body = get_ai_draft(user_email, email, client, db_manager)
-        publish_draft(creds_manager.creds, response_body, email.messageID)
+    # In history order, so results line up with the order the history marker advances in
+    # Messages deleted before they could be fetched count as handled, ones that failed to fetch are retried
+    outcomes = dict.fromkeys(added, True)
+    outcomes.update(dict.fromkeys(failed_ids, False))
+    outcomes.update((email.messageID, succeeded) for email, succeeded in zip(to_draft, drafted))
+    results = [outcomes[message_id] for message_id in added]
 
-    if emails:
-        latest_history_id = max(int(email.historyID) for email in emails)
-        db_manager.update_historyID(user_email, str(latest_history_id))
-    
-    print(f"Successfully processed {len(emails)} emails for {user_email}.")
+    completed_history_id = _completed_history_id(list(added.values()), results)
+    if completed_history_id:
+        advanced = await run_stage("db", async_db_manager.advance_history_id, user_email, completed_history_id)
+        if not advanced:
+            print(f"LOG: History marker for {user_email} is already at or past {completed_history_id}.")
 
-def _create_gmail_watch(creds: Credentials) -> bool:
+    print(f"Processed {sum(results)} of {len(results)} emails for {user_email}.")
+
+async def _draft_reply(user_email: str, email: Email, creds: Credentials, user_slots: asyncio.Semaphore) -> bool:
     """
-    Creates a Gmail watch subscription for the authenticated user.
+    Runs the filter, retrieval, generation and publishing stages for a single email.
+    The processed message ledger makes this safe to repeat: redelivered messages reuse the
+    recorded retrieval, and a message that already has a draft is never drafted again.
+    Returns True if the email was handled: skipped as unimportant, drafted, or dead-lettered after MAX_DRAFT_ATTEMPTS.
     """
+    # Header filters already ran on the metadata. Phrase filters are cheap and CPU-only, so they stay
+    # on the event loop. The greymail classifier embeds the email, so when configured it runs as a
+    # retrieval stage for the survivors.
+    if not email.body or email_filters.evaluate(email, blocking=False, needs_body=True):
+        return True
+    if email_filters.blocking and await run_stage("retrieval", email_filters.evaluate, email, blocking=True):
+        return True
+
+    processed = await run_stage("db", async_db_manager.claim_processed_message, user_email, email.messageID)
+    if processed is None:
+        return False
+    if processed["draft_id"]:
+        metrics.incr("ledger.duplicate_draft_skipped")
+        print(f"Message {email.messageID} for {user_email} already has draft {processed['draft_id']}, skipping.")
+        return True
+    if not processed["claimed"]:
+        # Another delivery is drafting this message right now, it will advance the history marker
+        metrics.incr("ledger.claimed_elsewhere")
+        return False
+    if processed["attempts"] > MAX_DRAFT_ATTEMPTS:
+        # Earlier attempts ended without recording a result, e.g. the instance was stopped mid-draft
+        _dead_letter(user_email, email, processed["attempts"] - 1)
+        return True
+
+    draft = None
     try:
-        service = build('gmail', 'v1', credentials=creds)
-        watch_request = {'labelIds': ['INBOX'], 'topicName': GCP_PUBSUB_TOPIC}
-        service.users().watch(userId='me', body=watch_request).execute()
+        context = await _retrieve_context(user_email, email, processed["doc_ids"])
+        async with user_slots:
+            response_body = await run_stage("generation", generate_draft_async, email, context, client)
+        draft = await run_stage("publish", publish_reply_draft, creds, response_body, email, user_email=user_email)
+    except Exception as e:
+        print(f"Failed to draft a reply to message {email.messageID} for {user_email}: {e}")
+    finally:
+        await run_stage("db", async_db_manager.record_draft, user_email, email.messageID, draft['id'] if draft else None)
+
+    if draft is None and processed["attempts"] >= MAX_DRAFT_ATTEMPTS:
+        _dead_letter(user_email, email, processed["attempts"])
         return True
+    return draft is not None
+
+def _dead_letter(user_email: str, email: Email, attempts: int) -> None:
+    """
+    Gives up on drafting a reply to an email, so it stops holding back the history marker.
+    """
+    print(f"DEAD LETTER: Giving up on message {email.messageID} for {user_email} after {attempts} failed attempts.")
+    metrics.incr("ledger.dead_lettered")
+
+async def _retrieve_context(user_email: str, email: Email, recorded_doc_ids: list[int] | None) -> list[dict] | None:
+    """
+    Returns the context documents for an email. Reuses the documents recorded in the ledger by an
+    earlier delivery, otherwise embeds the email, searches, and records the result.
+    """
+    if recorded_doc_ids is not None:
+        metrics.incr("ledger.retrieval_reused")
+        return await run_stage("db", async_db_manager.get_documents_by_ids, user_email, recorded_doc_ids)
+
+    query = email.subject + email.body
+    embedding = (await run_stage("retrieval", async_db_manager.embed, [query]))[0]
+    context = await run_stage(
+        "retrieval", async_db_manager.get_top_k_results, query, DRAFT_CONTEXT_WINDOW, user_email, query_embedding=embedding
+    )
+    if context is not None:
+        await run_stage(
+            "db", async_db_manager.record_retrieval, user_email, email.messageID, [doc["id"] for doc in context]
+        )
+    return context
+
+def _completed_history_id(history_ids: list[str], results: list[bool]) -> str | None:
+    """
+    Returns the last history ID before the first failure, given the history IDs of the records that added
+    each email, oldest first. Emails after a failure are retried on the next notification.
+    """
+    completed = None
+    for history_id, succeeded in zip(history_ids, results):
+        if not succeeded:
+            break
+        completed = history_id
+    return completed
+
+def _start_gmail_watch(creds: Credentials, user_email: str = None) -> dict:
+    """
+    Creates or renews the Gmail watch subscription for the authenticated user, raising on failure.
+    """
+    service = get_gmail_service(creds, user_email)
+    watch_request = {'labelIds': ['INBOX'], 'topicName': GCP_PUBSUB_TOPIC}
+    return service.users().watch(userId='me', body=watch_request).execute()
+
+def _watch_expiration(watch_response: dict) -> datetime | None:
+    """
+    Returns the expiration of a watch() response (epoch milliseconds) as an aware datetime, or None if absent.
+    """
+    try:
+        return datetime.fromtimestamp(int(watch_response['expiration']) / 1000, tz=timezone.utc)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def _create_gmail_watch(creds: Credentials, user_email: str = None) -> datetime | None:
+    """
+    Creates a Gmail watch subscription for the authenticated user, returning when it expires, or None on failure.
+    """
+    try:
+        return _watch_expiration(_start_gmail_watch(creds, user_email))
     except Exception as e:
         print(f"FAILED to create watch for user. Error: {e}")
-        return False
+        return None
 
-def _renew_all_user_watches() -> str:
+async def _renew_user_watch(user_email: str, refresh_token: str, rate_limit: TokenBucket) -> dict:
     """
-    Iterates through all users and renews their Gmail watch subscription.
+    Renews one user's watch and records its expiration, returning {"email", "success", "expires_at"}, or "error" on failure.
+    A renewal whose expiration could not be stored counts as a failure.
     """
-    if not GCP_PUBSUB_TOPIC:
-        print("FATAL: GCP_PUBSUB_TOPIC_NAME environment variable not set.")
-        raise HTTPException(status_code=500, detail="Server is missing GCP_PUBSUB_TOPIC_NAME configuration.")
+    if not refresh_token:
+        return {"email": user_email, "success": False, "error": "Missing refresh token."}
+
+    try:
+        creds = await _get_credentials(refresh_token, user_email)
+        await rate_limit.acquire()
+        watch_response = await run_stage("watch", _start_gmail_watch, creds, user_email)
+    except Exception as e:
+        print(f"FAILED to renew watch for {user_email}. Error: {e}")
+        metrics.incr("watch_renewal.failed")
+        return {"email": user_email, "success": False, "error": str(e)}
+
+    expires_at = _watch_expiration(watch_response)
+    if not await run_stage("db", async_db_manager.record_watch_renewal, user_email, expires_at):
+        # The watch is live but its expiration isn't stored, so the user stays due and the next run retries
+        print(f"FAILED to record watch renewal for {user_email}.")
+        metrics.incr("watch_renewal.failed")
+        return {"email": user_email, "success": False, "error": "Watch renewed but its expiration could not be recorded."}
+    metrics.incr("watch_renewal.renewed")
+    return {"email": user_email, "success": True, "expires_at": expires_at.isoformat() if expires_at else None}
+
+async def _renew_all_user_watches(
+        force: bool = False,
+        workers: int = WATCH_RENEWAL_WORKERS,
+        rate_per_second: float = WATCH_RENEWAL_RATE_PER_SECOND
+    ) -> AsyncIterator[dict]:
+    """
+    Renews the Gmail watch of every user whose watch expires within WATCH_RENEWAL_WINDOW_HOURS (all users when force),
+    yielding each user's result as it completes. workers users are renewed at a time, and watch()
+    calls are rate limited to rate_per_second. Users are streamed from the db in batches through
+    the bounded pending queue, so memory stays flat however many users there are.
+    Raises RuntimeError after the last result if the users could not be read.
+    """
+    expires_before = None if force else datetime.now(timezone.utc) + timedelta(hours=WATCH_RENEWAL_WINDOW_HOURS)
 
-    users = db_manager.get_all_users_for_watch()
-    if not users:
-        return "No users found in the database. Nothing to do."
+    rate_limit = TokenBucket(rate_per_second)
+    pending: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    results: asyncio.Queue = asyncio.Queue()
+    feed_error = None
 
-    success_count, failure_count = 0, 0
-    for user_email, refresh_token in users:
-        if not refresh_token:
-            print(f"Skipping {user_email} due to missing refresh token.")
-            failure_count += 1
-            continue
+    async def feed():
+        nonlocal feed_error
+        try:
+            async for user in async_db_manager.iter_users_for_watch(expires_before):
+                await pending.put(user)
+        except Exception as e:
+            print(f"Failed to read users for watch renewal. Error: {e}")
+            feed_error = e
+        # Not in a finally: when the run is closed early the workers are cancelled too, and
+        # nothing would drain the bounded queue
+        for _ in range(workers):
+            await pending.put(None)
 
-        creds_manager = CredentialsManager(refresh_token=refresh_token)
-        if _create_gmail_watch(creds_manager.creds):
-            print(f"Successfully renewed watch for {user_email}.")
-            success_count += 1
-        else:
-            print(f"FAILED to renew watch for {user_email}.")
-            failure_count += 1
+    async def work():
+        try:
+            while (user := await pending.get()) is not None:
+                await results.put(await _renew_user_watch(*user, rate_limit))
+        finally:
+            # Always signals completion, or the consumer would wait forever on a worker that raised
+            await results.put(None)
 
-    return f"Renewal process finished. Success: {success_count}, Failed: {failure_count}."
+    feeder = asyncio.create_task(feed())
+    worker_tasks = [asyncio.create_task(work()) for _ in range(workers)]
+    try:
+        finished_workers = 0
+        while finished_workers < workers:
+            result = await results.get()
+            if result is None:
+                finished_workers += 1
+            else:
+                yield result
+        if feed_error is not None:
+            raise RuntimeError("Failed to read users for watch renewal.") from feed_error
+    finally:
+        # Stops outstanding work if the caller goes away mid-run, renewed users are already recorded.
+        # The feeder goes first so it stops queueing users for workers that are being cancelled.
+        feeder.cancel()
+        for task in worker_tasks:
+            task.cancel()
+        await asyncio.gather(feeder, *worker_tasks, return_exceptions=True)
 
 # --- API Endpoints ---
 
@@ -140,7 +380,7 @@ async def recieve_auth_code(request: Request):
     Exchanges an auth code for tokens, logs in or registers a user, and sets up a watch for new users.
     """
     try:
-        token = await CredentialsManager.get_initial_token(request)
+        token = await CredentialsManager.get_initial_token(request, CLIENT_SECRETS)
         message, id_token_val, _ = await _login_or_register_user(token)
         return JSONResponse(content={"message": message, "id_token": id_token_val}, status_code=200)
     except Exception as e:
@@ -167,9 +407,11 @@ async def pub_sub(request: Request):
         return JSONResponse(content={"success": False, "error": str(e)}, status_code=200)
 
 @router.post("/tasks/renew-gmail-watch")
-async def trigger_renew_watch(x_internal_secret: str = Header(None)):
+async def trigger_renew_watch(x_internal_secret: str = Header(None), stream: bool = False, force: bool = False):
     """
     A cron job endpoint to renew all Gmail watch requests. Protected by a secret header.
+    With stream=true, per-user results are streamed as NDJSON while the run progresses, ending with a summary line.
+    force=true also renews users whose watch is not due to expire yet.
     """
     if not INTERNAL_TASK_SECRET or x_internal_secret != INTERNAL_TASK_SECRET:
         raise HTTPException(
@@ -177,7 +419,68 @@ async def trigger_renew_watch(x_internal_secret: str = Header(None)):
             detail="Invalid or missing secret token."
         )
 
+    if not GCP_PUBSUB_TOPIC:
+        print("FATAL: GCP_PUBSUB_TOPIC_NAME environment variable not set.")
+        raise HTTPException(status_code=500, detail="Server is missing GCP_PUBSUB_TOPIC_NAME configuration.")
+
     print("Initiating daily renewal of Gmail watch requests...")
-    summary = _renew_all_user_watches()
+    renewals = _renew_all_user_watches(force=force)
+
+    if stream:
+        async def ndjson_lines():
+            success_count, failure_count = 0, 0
+            try:
+                async for result in renewals:
+                    success_count += result["success"]
+                    failure_count += not result["success"]
+                    yield json.dumps(result) + "\n"
+            except Exception as e:
+                # The 200 status is already sent, so report the failure before the summary
+                print("Error renewing watches: ", e)
+                yield json.dumps({"error": "Renewal stopped before reaching every user"}) + "\n"
+            yield json.dumps({"summary": {"success": success_count, "failed": failure_count}}) + "\n"
+
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    try:
+        results = [result async for result in renewals]
+    except RuntimeError as e:
+        print(e)
+        raise HTTPException(status_code=500, detail="Failed to load users for watch renewal.")
+    success_count = sum(1 for result in results if result["success"])
+    summary = f"Renewal process finished. Success: {success_count}, Failed: {len(results) - success_count}."
     print(summary)
-    return {"status": "success", "message": summary}
+    return {"status": "success", "message": summary, "results": results}
+
+@router.post("/tasks/prune-processed-messages")
+async def trigger_prune_processed_messages(x_internal_secret: str = Header(None)):
+    """
+    A cron job endpoint to delete processed message ledger entries older than PROCESSED_MESSAGE_RETENTION_DAYS.
+    Protected by a secret header.
+    """
+    if not INTERNAL_TASK_SECRET or x_internal_secret != INTERNAL_TASK_SECRET:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid or missing secret token."
+        )
+
+    retention_cutoff = datetime.now(timezone.utc) - timedelta(days=PROCESSED_MESSAGE_RETENTION_DAYS)
+    pruned = await async_db_manager.delete_processed_messages_before(retention_cutoff)
+    print(f"Pruned {pruned} processed message entries older than {PROCESSED_MESSAGE_RETENTION_DAYS} days.")
+    return {"status": "success", "pruned_messages": pruned}
+
+@router.get("/tasks/metrics")
+async def get_metrics(x_internal_secret: str = Header(None)):
+    """
+    Returns in-process performance counters and timers. Protected by a secret header.
+    """
+    if not INTERNAL_TASK_SECRET or x_internal_secret != INTERNAL_TASK_SECRET:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid or missing secret token."
+        )
+
+    return {
+        **metrics.snapshot(),
+        "async_db_pool": async_db_manager.pool_status(),
+    }
@@ -1,67 +1,103 @@
-from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from fastapi import APIRouter, Request, Depends
+from fastapi.responses import JSONResponse, StreamingResponse
+import base64
+import json
 
 # Import shared dependencies from the new dependencies module
-from ..dependencies import db_manager, WEB_CLIENT_ID
+from ..dependencies import async_db_manager
+from ..auth import get_user_email
 
 router = APIRouter()
 
+# Upper bound on documents accepted by a single /saveDocuments request
+MAX_BULK_DOCUMENTS = 500
+# Upper bound on documents returned by a single /getDocuments page
+MAX_PAGE_SIZE = 100
+
+def _encode_cursor(document: dict) -> str:
+    """
+    Encodes the position after a document as an opaque pagination cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps([document["name"], document["id"]]).encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        name, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(name, str) or not isinstance(doc_id, int):
+            raise ValueError
+        return name, doc_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
 @router.get("/getDocuments")
-async def get_documents(request: Request, offset: int = 0, limit: int = 10):
+async def get_documents(
+        offset: int = 0,
+        limit: int = 10,
+        cursor: str = None,
+        content: bool = True,
+        include_total: bool = False,
+        user_email: str = Depends(get_user_email)
+    ):
     """
     Recieves a user email from the frontend to get all documents associated with that user
+    Pass the returned next_cursor to get the following page, content=false to list names only,
+    and include_total=true to also get the user's document count
     """
     try:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header:
-            return JSONResponse(content={"error": "Authorization header missing"}, status_code=401)
-
         try:
-            # The token is expected to be in the format "Bearer <token>"
-            id_token_value = auth_header.split(" ")[1]
-            idinfo = id_token.verify_oauth2_token(
-                id_token_value, requests.Request(), WEB_CLIENT_ID, clock_skew_in_seconds=10
-            )
-            user_email = idinfo.get('email')
-        except Exception as e:
-            return JSONResponse(content={"error": f"Invalid token: {e}"}, status_code=401)
+            after = _decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return JSONResponse(content={"Error": str(e)}, status_code=400)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
 
-        documents = db_manager.get_documents(user_email=user_email, content=True, offset=offset, limit=limit)
+        documents = await async_db_manager.get_documents(
+            user_email=user_email, content=content, offset=offset, limit=limit, after=after
+        )
+        response = {"documents": documents}
+        # A full page means there may be more, the client stops once next_cursor is null
+        response["next_cursor"] = _encode_cursor(documents[-1]) if documents and len(documents) == limit else None
+        if include_total:
+            response["total"] = await async_db_manager.get_document_count(user_email)
 
-        return JSONResponse(content={"documents": documents}, status_code=200)
+        return JSONResponse(content=response, status_code=200)
     except Exception as e:
         print("Error getting documents: ", e)
         return JSONResponse(content={"Error": f"Internal Server Error {e}"}, status_code=500)
 
+@router.get("/exportDocuments")
+async def export_documents(content: bool = True, user_email: str = Depends(get_user_email)):
+    """
+    Streams all of a user's documents as newline-delimited JSON, one document per line
+    Rows are read through a server-side cursor and written as they arrive, so no full page is held in memory
+    """
+    async def ndjson_lines():
+        try:
+            async for document in async_db_manager.iter_documents(user_email, content=content):
+                yield json.dumps(document) + "\n"
+        except Exception as e:
+            # The 200 status is already sent, so report the failure as the last line
+            print("Error exporting documents: ", e)
+            yield json.dumps({"error": "Export failed before completing"}) + "\n"
+
+    return StreamingResponse(
+        ndjson_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="documents.ndjson"'}
+    )
+
 @router.post("/saveDocument")
-async def save_document(request: Request):
+async def save_document(request: Request, user_email: str = Depends(get_user_email)):
     """
     Recieves a document from the frontend to be saved in the DB for RAG
     Note: passing a doc_id will update an existing document instead of creating a new one
     """
     try:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header:
-            return JSONResponse(content={"error": "Authorization header missing"}, status_code=401)
-
-        try:
-            # The token is expected to be in the format "Bearer <token>"
-            id_token_value = auth_header.split(" ")[1]
-            idinfo = id_token.verify_oauth2_token(
-                id_token_value, requests.Request(), WEB_CLIENT_ID, clock_skew_in_seconds=10
-            )
-            user_email = idinfo.get('email')
-        except Exception as e:
-            return JSONResponse(content={"error": f"Invalid token: {e}"}, status_code=401)
-
         data = await request.json()
         doc_name = data.get("doc_name")
         text_content = data.get("text_content")
         doc_id = data.get("doc_id", None) # optional, for updating existing document
 
-        success = db_manager.insert_document(
+        success = await async_db_manager.insert_document(
             user_email=user_email,
             doc_name=doc_name,
             text_content=text_content,
@@ -78,26 +114,41 @@ async def save_document(request: Request):
 
     return JSONResponse(content={"Error": f"Internal Server Error"}, status_code=500)
 
-@router.get("/getDocumentById")
-async def get_document_by_id(request: Request, doc_id: str):
+@router.post("/saveDocuments")
+async def save_documents(request: Request, user_email: str = Depends(get_user_email)):
     """
-    Recieves a document ID from the frontend to get the document content associated with that ID
+    Recieves a list of documents from the frontend to be saved in the DB for RAG in one request
+    Returns a per-document result, documents that fail validation don't prevent the others from saving
     """
     try:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header:
-            return JSONResponse(content={"error": "Authorization header missing"}, status_code=401)
-
-        try:
-            # The token is expected to be in the format "Bearer <token>"
-            id_token_value = auth_header.split(" ")[1]
-            id_token.verify_oauth2_token( # ensuring token is valid
-                id_token_value, requests.Request(), WEB_CLIENT_ID, clock_skew_in_seconds=10
+        data = await request.json()
+        documents = data.get("documents")
+        if not isinstance(documents, list) or not documents:
+            return JSONResponse(content={"Error": "documents must be a non-empty list"}, status_code=400)
+        if len(documents) > MAX_BULK_DOCUMENTS:
+            return JSONResponse(
+                content={"Error": f"Too many documents, at most {MAX_BULK_DOCUMENTS} per request, got {len(documents)}"},
+                status_code=400
             )
-        except Exception as e:
-            return JSONResponse(content={"error": f"Invalid token: {e}"}, status_code=401)
 
-        document = db_manager.get_document_by_id(doc_id=doc_id)
+        results = await async_db_manager.insert_documents(user_email, documents)
+        saved = sum(1 for result in results if result["success"])
+
+        return JSONResponse(
+            content={"saved": saved, "failed": len(results) - saved, "results": results},
+            status_code=200
+        )
+    except Exception as e:
+        print("Error saving documents: ", e)
+        return JSONResponse(content={"Error": f"Internal Server Error {e}"}, status_code=500)
+
+@router.get("/getDocumentById")
+async def get_document_by_id(doc_id: str, user_email: str = Depends(get_user_email)):
+    """
+    Recieves a document ID from the frontend to get the document content associated with that ID
+    """
+    try:
+        document = await async_db_manager.get_document_by_id(doc_id=doc_id)
         if document is None:
             return JSONResponse(content={"error": "Document not found or access denied"}, status_code=404)
 
@@ -107,21 +158,9 @@ async def get_document_by_id(request: Request, doc_id: str):
         return JSONResponse(content={"Error": f"Internal Server Error {e}"}, status_code=500)
 
 @router.delete("/deleteDocument")
-async def delete_document(request: Request, doc_id: str):
+async def delete_document(doc_id: str, user_email: str = Depends(get_user_email)):
     try:
-        auth_header = request.headers.get('Authorization')
-        if not auth_header:
-            return JSONResponse(content={"error": "Authorization header missing"}, status_code=401)
-
-        try:
-            id_token_value = auth_header.split(" ")[1]
-            id_token.verify_oauth2_token( # just verifying token is valid
-                id_token_value, requests.Request(), WEB_CLIENT_ID, clock_skew_in_seconds=10
-            )
-        except Exception as e:
-            return JSONResponse(content={"error": f"Invalid token: {e}"}, status_code=401)
-
-        success = db_manager.delete_document(doc_id)
+        success = await async_db_manager.delete_document(doc_id)
         print("success: ", success, "deleting doc id", doc_id)
         if not success:
             return JSONResponse(content={"error": "Document not found or could not be deleted"}, status_code=404)
@@ -0,0 +1,53 @@
+"""
+Imports the routers, src.auth and src.main for offline unit tests. src.dependencies connects to the
+database, loads the embedding model and reads credentials from the environment on import, so when it
+isn't loaded yet the module is imported against a stand-in with the same names. Every module imported
+that way is removed from sys.modules again afterwards, so test modules collected later still import
+the real ones.
+Tests patch the returned module's attributes for the clients they use.
+"""
+from unittest.mock import MagicMock
+from types import ModuleType
+import importlib
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules the routers share with the tests, loaded normally so both see the same metrics and classes
+from src import metrics, mail, filters, pipeline, CredentialsManager
+
+def make_dependencies() -> ModuleType:
+    dependencies = ModuleType("src.dependencies")
+    dependencies.__dict__.update(
+        db_manager=MagicMock(),
+        async_db_manager=MagicMock(),
+        client=MagicMock(),
+        email_filters=MagicMock(),
+        CLIENT_SECRETS={},
+        WEB_CLIENT_ID="client-id",
+        INTERNAL_TASK_SECRET="secret",
+        GCP_PUBSUB_TOPIC="projects/test/topics/gmail",
+    )
+    return dependencies
+
+def import_router(name: str) -> ModuleType:
+    """
+    Returns the module name (e.g. "src.routers.core" or "src.auth"), imported against stub dependencies
+    unless the real ones are already loaded.
+    """
+    if "src.dependencies" in sys.modules:
+        return importlib.import_module(name)
+
+    before = set(sys.modules)
+    sys.modules["src.dependencies"] = make_dependencies()
+    try:
+        return importlib.import_module(name)
+    finally:
+        for module_name in set(sys.modules) - before:
+            module = sys.modules.pop(module_name)
+            # A package imported earlier keeps the submodule as an attribute, which a later
+            # "from package import submodule" would return instead of importing the real one
+            parent, _, child = module_name.rpartition(".")
+            if parent in sys.modules and getattr(sys.modules[parent], child, None) is module:
+                delattr(sys.modules[parent], child)
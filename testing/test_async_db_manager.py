@@ -0,0 +1,415 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone, timedelta
+from fastembed import TextEmbedding
+import numpy as np
+import asyncio
+import time
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.async_db_manager import AsyncDBManager, ConnectionLeakTracker
+from src import metrics
+
+class TestAsyncDBManagerUnit(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for AsyncDBManager methods."""
+
+    @classmethod
+    def setUpClass(cls):
+        """Load the embedding model once for all tests."""
+        cls.embedding_model = TextEmbedding()
+
+    async def asyncSetUp(self):
+        """Open a pool per test, asyncpg pools are bound to the test's event loop."""
+        self.db_manager = AsyncDBManager(embedding_model=self.embedding_model)
+        self.pool = await self.db_manager.connect()
+
+    async def asyncTearDown(self):
+        await self.db_manager.close()
+
+    async def test_advance_history_id(self):
+        """Test that the history marker only moves forward."""
+        user_email = "async_advance_hist@gmail.com"
+        await self.db_manager.insert_new_user("AdvanceTest", user_email, "token_adv", "1000")
+
+        self.assertTrue(await self.db_manager.advance_history_id(user_email, "1005"))
+        self.assertFalse(await self.db_manager.advance_history_id(user_email, "1002")) # stale delivery
+        self.assertFalse(await self.db_manager.advance_history_id(user_email, "1005"))
+        self.assertEqual((await self.db_manager.get_processing_state(user_email)).history_id, "1005")
+
+        # A non-numeric marker can't be compared, so any new marker replaces it
+        await self.pool.execute("UPDATE users SET history_id = 'legacy' WHERE email = $1;", user_email)
+        self.assertTrue(await self.db_manager.advance_history_id(user_email, "1006"))
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email)
+
+    async def test_record_watch_renewal(self):
+        """Test that a recorded expiration takes a user out of the due selection, and a missing one keeps it due."""
+        user_email = "async_watch_renewal@example.com"
+        await self.db_manager.insert_new_user("WatchTest", user_email, "token_watch", "hist_watch")
+        now = datetime.now(timezone.utc)
+        cutoff = now + timedelta(hours=48)
+
+        async def due() -> bool:
+            return user_email in [email async for email, _ in self.db_manager.iter_users_for_watch(cutoff)]
+
+        self.assertTrue(await due()) # no watch recorded yet
+
+        self.assertTrue(await self.db_manager.record_watch_renewal(user_email, now + timedelta(days=7)))
+        self.assertFalse(await due())
+        self.assertTrue(await self.db_manager.record_watch_renewal(user_email, now + timedelta(hours=1)))
+        self.assertTrue(await due())
+
+        # A renewal without an expiration stays due for the next run
+        self.assertTrue(await self.db_manager.record_watch_renewal(user_email, now + timedelta(days=7)))
+        self.assertTrue(await self.db_manager.record_watch_renewal(user_email, None))
+        self.assertTrue(await due())
+        self.assertEqual(
+            await self.pool.fetchval("SELECT watch_expires_at = '-infinity' FROM users WHERE email = $1;", user_email), True
+        )
+        self.assertFalse(await self.db_manager.record_watch_renewal("missing_watch@example.com", now))
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email)
+
+    async def test_insert_documents(self):
+        """Test that each inserted doc_id belongs to the document at the same input index."""
+        user_email = "async_bulk_insert@example.com"
+        await self.db_manager.insert_new_user("BulkTest", user_email, "token_bulk", "hist_bulk")
+
+        documents = [{"doc_name": f"Doc{i}", "text_content": f"content {i}"} for i in range(5)]
+        documents.insert(2, {"doc_name": "", "text_content": "nameless"})
+        results = await self.db_manager.insert_documents(user_email, documents)
+
+        self.assertFalse(results[2]["success"])
+        for document, result in zip(documents, results):
+            if not result["success"]:
+                continue
+            row = await self.pool.fetchrow(
+                'SELECT document_name, content FROM documents WHERE doc_id = $1;', result["doc_id"]
+            )
+            self.assertEqual((row[0], row[1]), (document["doc_name"], document["text_content"]))
+        self.assertEqual(await self.db_manager.get_document_count(user_email), 5)
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email) # Documents are deleted by cascade
+
+    async def test_get_documents_keyset(self):
+        """Test keyset pagination, names-only listing and the maintained document count."""
+        user_email = "async_keyset_test@example.com"
+        await self.db_manager.insert_new_user("KeysetTest", user_email, "token_keyset", "hist_keyset")
+        await self.db_manager.insert_documents(user_email, [
+            {"doc_name": name, "text_content": f"content of {name}"} for name in ["b", "a", "c", "a"]
+        ])
+        self.assertEqual(await self.db_manager.get_document_count(user_email), 4)
+
+        first = await self.db_manager.get_documents(user_email, limit=2, content=False)
+        self.assertEqual([doc["name"] for doc in first], ["a", "a"])
+        self.assertNotIn("content", first[0])
+        second = await self.db_manager.get_documents(user_email, limit=2, after=(first[-1]["name"], first[-1]["id"]))
+        self.assertEqual([doc["name"] for doc in second], ["b", "c"])
+        self.assertEqual(second[0]["content"], "content of b")
+        self.assertEqual(await self.db_manager.get_documents(user_email, limit=2, offset=2), second)
+
+        await self.db_manager.delete_document(second[0]["id"])
+        self.assertEqual(await self.db_manager.get_document_count(user_email), 3)
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email)
+
+    async def test_iter_documents(self):
+        """Test that the export reads every document in order across cursor fetches."""
+        user_email = "async_export_test@example.com"
+        await self.db_manager.insert_new_user("ExportTest", user_email, "token_export", "hist_export")
+        await self.db_manager.insert_documents(user_email, [
+            {"doc_name": f"Doc{i}", "text_content": f"content {i}"} for i in [3, 1, 4, 2, 0]
+        ])
+
+        exported = [doc async for doc in self.db_manager.iter_documents(user_email, fetch_size=2)]
+        self.assertEqual([doc["name"] for doc in exported], [f"Doc{i}" for i in range(5)])
+        self.assertEqual(exported[0]["content"], "content 0")
+        names_only = [doc async for doc in self.db_manager.iter_documents(user_email, content=False, fetch_size=2)]
+        self.assertNotIn("content", names_only[0])
+        self.assertEqual(self.pool.get_idle_size(), self.pool.get_size()) # the cursor's connection is released
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email)
+
+    async def test_top_k_results(self):
+        """Test retrieving top-k results using user_email."""
+        user_email = "async_topk_test@example.com"
+        await self.db_manager.insert_new_user("TopKTest", user_email, "token_topk", "hist_topk")
+        await self.db_manager.insert_documents(user_email, [
+            {"doc_name": "Doc1", "text_content": "birds, dogs, and pets."},
+            {"doc_name": "Doc2", "text_content": "This content is about cars, bikes, and vehicles."},
+            {"doc_name": "Doc3", "text_content": "This content is pasta, italian food, meatballs, ect."},
+        ])
+
+        pet_results = await self.db_manager.get_top_k_results("I love my dog and my pet bird.", 1, user_email)
+        self.assertEqual(len(pet_results), 1)
+        self.assertEqual(pet_results[0]['content'], "birds, dogs, and pets.")
+
+        all_results = await self.db_manager.get_top_k_results("I love my dog and my pet bird.", 5, user_email)
+        self.assertEqual(len(all_results), 3)
+        self.assertEqual([doc["similarity"] for doc in all_results], sorted((doc["similarity"] for doc in all_results), reverse=True))
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email)
+
+    async def test_processed_message_ledger(self):
+        """Test claiming a message, recording its retrieval and draft, and counting attempts."""
+        user_email = "async_ledger@example.com"
+        await self.db_manager.insert_new_user("LedgerTest", user_email, "token_ledger", "hist_ledger")
+
+        first = await self.db_manager.claim_processed_message(user_email, "msg1")
+        self.assertEqual(first, {"draft_id": None, "doc_ids": None, "claimed": True, "attempts": 1})
+        # A second delivery while the claim is held doesn't get it, and doesn't count as an attempt
+        concurrent = await self.db_manager.claim_processed_message(user_email, "msg1")
+        self.assertEqual((concurrent["claimed"], concurrent["attempts"]), (False, 1))
+
+        self.assertTrue(await self.db_manager.record_retrieval(user_email, "msg1", [3, 1]))
+        self.assertTrue(await self.db_manager.record_draft(user_email, "msg1", None)) # failed attempt releases the claim
+        retry = await self.db_manager.claim_processed_message(user_email, "msg1")
+        self.assertEqual(retry, {"draft_id": None, "doc_ids": [3, 1], "claimed": True, "attempts": 2})
+
+        self.assertTrue(await self.db_manager.record_draft(user_email, "msg1", "draft1"))
+        redelivered = await self.db_manager.claim_processed_message(user_email, "msg1")
+        self.assertEqual((redelivered["draft_id"], redelivered["claimed"], redelivered["attempts"]), ("draft1", False, 2))
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email) # Ledger entries are deleted by cascade
+
+    async def test_delete_processed_messages_before(self):
+        """Test pruning ledger entries by creation time."""
+        user_email = "async_ledger_prune@example.com"
+        await self.db_manager.insert_new_user("PruneTest", user_email, "token_prune", "hist_prune")
+        await self.db_manager.claim_processed_message(user_email, "old")
+        await self.db_manager.claim_processed_message(user_email, "new")
+        await self.pool.execute(
+            "UPDATE processed_messages SET created_at = now() - interval '40 days' WHERE message_id = 'old';"
+        )
+
+        deleted = await self.db_manager.delete_processed_messages_before(datetime.now(timezone.utc) - timedelta(days=30))
+        self.assertGreaterEqual(deleted, 1)
+        remaining = await self.pool.fetch(
+            'SELECT message_id FROM processed_messages p JOIN users u USING (user_id) WHERE u.email = $1;', user_email
+        )
+        self.assertEqual([row[0] for row in remaining], ["new"])
+
+        # Cleanup
+        await self.pool.execute('DELETE FROM users WHERE email = $1;', user_email)
+
+class FakeConnection:
+    """Stand-in for an asyncpg connection that returns queued fetch results and records statements."""
+
+    def __init__(self, fetch_results: list = (), fetchval_result=None, pid: int = 1):
+        self.fetch_results = list(fetch_results)
+        self.fetchval_result = fetchval_result
+        self.pid = pid
+        self.fetches = []
+        self.executed = []
+        self.terminated = False
+
+    async def fetch(self, sql, *args):
+        self.fetches.append(args)
+        return self.fetch_results.pop(0)
+
+    async def fetchval(self, sql, *args):
+        return self.fetchval_result
+
+    async def execute(self, sql, *args, timeout=None):
+        self.executed.append(sql.strip())
+
+    def get_server_pid(self):
+        return self.pid
+
+    def terminate(self):
+        self.terminated = True
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+class FakePool(FakeConnection):
+    """Stand-in for an asyncpg pool, acquire() hands out the pool itself as the connection."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired = 0
+        self.released = 0
+
+    async def acquire(self, timeout=None):
+        self.acquired += 1
+        return self
+
+    async def release(self, conn):
+        self.released += 1
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1 - self.acquired + self.released
+
+    def get_max_size(self):
+        return 1
+
+class TestAsyncQueriesUnit(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for AsyncDBManager query handling against a fake pool, no database needed."""
+
+    def make_manager(self, pool: FakePool) -> AsyncDBManager:
+        db_manager = AsyncDBManager(embedding_model=MagicMock())
+        db_manager.connect = AsyncMock(return_value=pool)
+        db_manager._get_user_id = AsyncMock(return_value=1)
+        db_manager.embed = AsyncMock(side_effect=lambda texts: [np.zeros(384, dtype=np.float32) for _ in texts])
+        return db_manager
+
+    def setUp(self):
+        metrics.reset()
+
+    async def test_insert_documents_maps_rows_by_ordinal(self):
+        """doc_ids go to the documents at their unnest ordinal, whatever order the rows come back in."""
+        pool = FakePool(fetch_results=[[{"ord": 3, "doc_id": 12}, {"ord": 1, "doc_id": 10}, {"ord": 2, "doc_id": 11}]])
+        documents = [
+            {"doc_name": "a", "text_content": "x"},
+            {"doc_name": "b"}, # invalid, not sent
+            {"doc_name": "c", "text_content": "y"},
+            {"doc_name": "d", "text_content": "z"},
+        ]
+
+        results = await self.make_manager(pool).insert_documents("user@example.com", documents)
+
+        self.assertEqual(pool.fetches[0][1], ["a", "c", "d"])
+        self.assertEqual([result.get("doc_id") for result in results], [10, None, 11, 12])
+        self.assertEqual([result["success"] for result in results], [True, False, True, True])
+
+    async def test_top_k_exact_fallback(self):
+        """A short HNSW result is redone as an exact scan when the user has more documents, and sorted by distance."""
+        pool = FakePool(
+            fetch_results=[[(1, "a", "ca", 0.3)], [(2, "b", "cb", 0.2), (1, "a", "ca", 0.3), (3, "c", "cc", 0.1)]],
+            fetchval_result=5
+        )
+
+        results = await self.make_manager(pool).get_top_k_results("q", 3, "user@example.com", query_embedding=np.zeros(384))
+
+        self.assertEqual([doc["id"] for doc in results], [3, 2, 1])
+        self.assertIn("SET LOCAL enable_indexscan = off;", pool.executed)
+        self.assertEqual(metrics.snapshot()["counters"]["vector_search.exact_fallback"], 1)
+
+    async def test_iter_users_for_watch_batches(self):
+        """Users are read in keyset batches, due users keyed on (watch_expires_at, user_id)."""
+        expires_at = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        pool = FakePool(fetch_results=[
+            [(1, "a@example.com", "t1"), (2, "b@example.com", "t2")],
+            [(5, "c@example.com", "t3")],
+            [(expires_at, 7, "d@example.com", "t4"), (expires_at, 9, "e@example.com", "t5")],
+            [],
+        ])
+        db_manager = self.make_manager(pool)
+
+        users = [user async for user in db_manager.iter_users_for_watch(batch_size=2)]
+        self.assertEqual(users, [("a@example.com", "t1"), ("b@example.com", "t2"), ("c@example.com", "t3")])
+        # The second batch starts after the last user_id of the first
+        self.assertEqual(pool.fetches[:2], [(0, 2), (2, 2)])
+
+        cutoff = expires_at + timedelta(days=1)
+        due = [user async for user in db_manager.iter_users_for_watch(cutoff, batch_size=2)]
+        self.assertEqual(due, [("d@example.com", "t4"), ("e@example.com", "t5")])
+        self.assertEqual(pool.fetches[2:], [(cutoff, 2), (cutoff, expires_at, 9, 2)])
+
+    async def test_top_k_no_fallback_when_user_has_fewer_documents(self):
+        """A short result is final when the user has no more documents than were returned."""
+        pool = FakePool(fetch_results=[[(1, "a", "ca", 0.3)]], fetchval_result=1)
+
+        results = await self.make_manager(pool).get_top_k_results("q", 3, "user@example.com", query_embedding=np.zeros(384))
+
+        self.assertEqual([doc["id"] for doc in results], [1])
+        self.assertEqual(len(pool.fetches), 1)
+        self.assertNotIn("vector_search.exact_fallback", metrics.snapshot()["counters"])
+
+    async def test_acquire_recycles_old_connection(self):
+        """A connection opened longer ago than the recycle age is closed and another one is acquired."""
+        old, fresh = FakePool(pid=1), FakePool(pid=2)
+        db_manager = self.make_manager(old)
+        pool = AsyncMock()
+        pool.acquire.side_effect = [old, fresh]
+        db_manager.connect = AsyncMock(return_value=pool)
+        now = time.monotonic()
+        db_manager._connection_times = {1: [now - 10, now], 2: [now, now]}
+
+        with patch("src.async_db_manager.DB_POOL_RECYCLE_SECONDS", 5):
+            async with db_manager._acquire() as conn:
+                self.assertIs(conn, fresh)
+
+        self.assertTrue(old.terminated)
+        self.assertFalse(fresh.terminated)
+        self.assertEqual([call.args[0] for call in pool.release.await_args_list], [old, fresh])
+        self.assertEqual(metrics.snapshot()["counters"]["async_db_pool.recycled"], 1)
+
+    async def test_acquire_pings_idle_connection(self):
+        """Only connections idle past the pre-ping age are pinged, a failed ping replaces the connection."""
+        pool = FakePool()
+        db_manager = self.make_manager(pool)
+        now = time.monotonic()
+        db_manager._connection_times = {1: [now, now]}
+
+        async with db_manager._acquire():
+            pass
+        self.assertEqual(pool.executed, []) # recently used, no ping
+
+        db_manager._connection_times[1][1] = now - 60
+        async with db_manager._acquire():
+            pass
+        self.assertEqual(pool.executed, ["SELECT 1;"])
+        self.assertGreaterEqual(db_manager._connection_times[1][1], now) # release marks it used
+
+        dead, fresh = FakePool(pid=1), FakePool(pid=2)
+        dead.execute = AsyncMock(side_effect=OSError("connection reset"))
+        asyncpg_pool = AsyncMock()
+        asyncpg_pool.acquire.side_effect = [dead, fresh]
+        db_manager.connect = AsyncMock(return_value=asyncpg_pool)
+        db_manager._connection_times = {1: [now, now - 60], 2: [now, now]}
+        async with db_manager._acquire() as conn:
+            self.assertIs(conn, fresh)
+        self.assertTrue(dead.terminated)
+        self.assertEqual(metrics.snapshot()["counters"]["async_db_pool.ping_failed"], 1)
+
+    async def test_pool_status_reports_acquire_wait(self):
+        """Every acquire is timed and the wait is reported with the pool occupancy."""
+        pool = FakePool()
+        db_manager = self.make_manager(pool)
+        db_manager.pool = pool
+
+        for _ in range(3):
+            async with db_manager._acquire():
+                pass
+
+        status = db_manager.pool_status()
+        self.assertEqual((status["size"], status["idle"], status["max_size"]), (1, 1, 1))
+        self.assertEqual(status["acquire_wait"]["count"], 3)
+        self.assertIsNone(status["connect"])
+        self.assertEqual(pool.acquired, pool.released)
+
+    async def test_leak_tracker_reports_long_held_connection(self):
+        """A connection held past the threshold is listed with the code that acquired it."""
+        pool = FakePool()
+        db_manager = self.make_manager(pool)
+        db_manager.pool = pool
+        db_manager.leak_tracker = ConnectionLeakTracker(threshold_seconds=0.05)
+
+        async with db_manager._acquire():
+            await asyncio.sleep(0.1)
+            long_held = db_manager.pool_status()["long_held"]
+            self.assertEqual(len(long_held), 1)
+            self.assertIn("test_leak_tracker_reports_long_held_connection", long_held[0]["stack"])
+
+        self.assertEqual(db_manager.leak_tracker.long_held(), [])
+        self.assertEqual(metrics.snapshot()["counters"]["async_db_pool.long_held"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from fastapi.testclient import TestClient
+from types import SimpleNamespace
+import time
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+from stub_dependencies import import_router
+
+# Imported against stub shared clients when the real ones aren't loaded
+auth = import_router("src.auth")
+main = import_router("src.main")
+
+def make_response(cache_control: str = None, age: str = None, status: int = 200) -> SimpleNamespace:
+    headers = {}
+    if cache_control is not None:
+        headers["Cache-Control"] = cache_control
+    if age is not None:
+        headers["Age"] = age
+    return SimpleNamespace(status=status, headers=headers, data=b"{}")
+
+class TestCachingRequestUnit(unittest.TestCase):
+    """Unit tests for the cert fetching transport, the underlying HTTP request is faked."""
+
+    def make_request(self, response: SimpleNamespace) -> auth.CachingRequest:
+        request = auth.CachingRequest(session=MagicMock())
+        request._request = MagicMock(return_value=response)
+        return request
+
+    def test_cached_for_max_age_minus_age(self):
+        """A response is reused until max-age less the time a shared cache already held it."""
+        request = self.make_request(make_response("public, max-age=100, must-revalidate", age="40"))
+        now = time.monotonic()
+
+        with patch.object(auth.time, "monotonic", return_value=now):
+            first = request("https://certs.example.com")
+            self.assertIs(request("https://certs.example.com"), first)
+        with patch.object(auth.time, "monotonic", return_value=now + 59):
+            request("https://certs.example.com")
+        self.assertEqual(request._request.call_count, 1)
+
+        with patch.object(auth.time, "monotonic", return_value=now + 61):
+            request("https://certs.example.com")
+        self.assertEqual(request._request.call_count, 2)
+
+    def test_uncacheable_responses_are_fetched_every_time(self):
+        """no-store, a missing max-age, an Age past max-age, errors and non-GET requests are never cached."""
+        for response in [
+            make_response("no-store, max-age=100"),
+            make_response("public"),
+            make_response(),
+            make_response("max-age=100", age="100"),
+            make_response("max-age=100", status=500),
+        ]:
+            request = self.make_request(response)
+            request("https://certs.example.com")
+            request("https://certs.example.com")
+            self.assertEqual(request._request.call_count, 2, response)
+
+        request = self.make_request(make_response("max-age=100"))
+        request("https://oauth.example.com", method="POST", body=b"grant")
+        request("https://oauth.example.com", method="POST", body=b"grant")
+        self.assertEqual(request._request.call_count, 2)
+
+class TestTokenClaimsCacheUnit(unittest.TestCase):
+    """Unit tests for the verified ID token claims cache."""
+
+    def test_expires_at_exp(self):
+        """Claims are served until the token's exp, then dropped."""
+        cache = auth.TokenClaimsCache()
+        exp = int(time.time()) + 60
+        cache.put("token", {"email": "user@example.com", "exp": exp})
+
+        with patch.object(auth.time, "time", return_value=exp - 1):
+            self.assertEqual(cache.get("token")["email"], "user@example.com")
+        with patch.object(auth.time, "time", return_value=exp):
+            self.assertIsNone(cache.get("token"))
+        self.assertEqual(len(cache._entries), 0)
+        self.assertIsNone(cache.get("unknown"))
+
+    def test_least_recently_used_evicted(self):
+        """Past max_entries the least recently used token is evicted, a read counts as a use."""
+        cache = auth.TokenClaimsCache(max_entries=2)
+        exp = int(time.time()) + 3600
+        cache.put("a", {"email": "a", "exp": exp})
+        cache.put("b", {"email": "b", "exp": exp})
+        cache.get("a")
+        cache.put("c", {"email": "c", "exp": exp})
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a")["email"], "a")
+        self.assertEqual(cache.get("c")["email"], "c")
+
+class TestGetUserEmailUnit(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for the auth dependency."""
+
+    def setUp(self):
+        metrics.reset()
+        patcher = patch.object(auth, "token_claims", auth.TokenClaimsCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_verified_token_returns_email(self):
+        """A valid token is verified once, then served from the claims cache."""
+        claims = {"email": "user@example.com", "exp": int(time.time()) + 3600}
+
+        def verify(token):
+            auth.token_claims.put(token, claims)
+            return claims
+
+        with patch.object(auth, "verify_id_token", side_effect=verify) as verify_id_token:
+            self.assertEqual(await auth.get_user_email("Bearer token"), "user@example.com")
+            self.assertEqual(await auth.get_user_email("Bearer token"), "user@example.com")
+        verify_id_token.assert_called_once_with("token")
+        self.assertEqual(metrics.snapshot()["counters"]["auth.token_cache_hit"], 1)
+
+    async def test_invalid_credentials_raise_authentication_error(self):
+        """A missing header, a header without a token and a token that fails verification raise AuthenticationError."""
+        with patch.object(auth, "verify_id_token", side_effect=ValueError("Token expired")):
+            for authorization in [None, "Bearer", "Bearer bad-token"]:
+                with self.assertRaises(auth.AuthenticationError):
+                    await auth.get_user_email(authorization)
+
+class TestAuthenticationErrorResponseUnit(unittest.TestCase):
+    """The app turns AuthenticationError from the auth dependency into a 401."""
+
+    def test_unauthenticated_request_is_401(self):
+        client = TestClient(main.app)
+
+        response = client.get("/getDocuments")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {"error": "Authorization header missing"})
+
+        response = client.get("/getDocuments", headers={"Authorization": "Bearer"})
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(response.json()["error"].startswith("Invalid token"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+from unittest.mock import patch
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.CredentialsManager import AccessTokenCache, CredentialsManager, access_tokens
+
+lock = threading.Lock()
+
+class FakeCredentials:
+    """Stand-in for google Credentials, refresh() issues an hour long token and can rotate the refresh token."""
+    refresh_count = 0
+
+    def __init__(self, refresh_token: str, rotate_to: str = None):
+        self.refresh_token = refresh_token
+        self.rotate_to = rotate_to
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        time.sleep(0.05)
+        with lock:
+            FakeCredentials.refresh_count += 1
+        self.token = f"access-{FakeCredentials.refresh_count}"
+        self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+        if self.rotate_to:
+            self.refresh_token, self.rotate_to = self.rotate_to, None
+
+@patch('src.CredentialsManager.Request')
+class TestAccessTokenCacheUnit(unittest.TestCase):
+    """Unit tests for the per-user access token cache."""
+
+    def setUp(self):
+        FakeCredentials.refresh_count = 0
+
+    def test_reuses_token_until_near_expiry(self, mock_request):
+        """A fresh token is reused, and refreshed once it is inside the refresh margin."""
+        cache = AccessTokenCache(margin_seconds=300)
+        creds = cache.get("user@example.com", "refresh", FakeCredentials)
+        self.assertIs(cache.get("user@example.com", "refresh", FakeCredentials), creds)
+        self.assertEqual(FakeCredentials.refresh_count, 1)
+
+        creds.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=60)
+        cache.get("user@example.com", "refresh", FakeCredentials)
+        self.assertEqual(FakeCredentials.refresh_count, 2)
+
+    def test_concurrent_requests_share_one_refresh(self, mock_request):
+        """Concurrent requests for the same user wait for a single refresh."""
+        cache = AccessTokenCache()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            tokens = set(executor.map(lambda _: cache.get("user@example.com", "refresh", FakeCredentials).token, range(8)))
+        self.assertEqual(FakeCredentials.refresh_count, 1)
+        self.assertEqual(len(tokens), 1)
+
+    def test_rotated_refresh_token_written_back(self, mock_request):
+        """A rotated refresh token is passed to on_rotated, and the old one still finds the cached entry."""
+        cache, rotated = AccessTokenCache(), []
+        cache.get("user@example.com", "old", lambda token: FakeCredentials(token, rotate_to="new"), rotated.append)
+        self.assertEqual(rotated, ["new"])
+
+        cache.get("user@example.com", "old", FakeCredentials)
+        cache.get("user@example.com", "new", FakeCredentials)
+        self.assertEqual(FakeCredentials.refresh_count, 1)
+
+        # A different refresh token means the user logged in again
+        cache.get("user@example.com", "relogin", FakeCredentials)
+        self.assertEqual(FakeCredentials.refresh_count, 2)
+
+    @patch('src.CredentialsManager.Credentials')
+    def test_credentials_manager_uses_injected_client_and_callback(self, mock_credentials, mock_request):
+        """CredentialsManager builds credentials with the given OAuth client and reports rotation to the caller."""
+        mock_credentials.side_effect = lambda **kwargs: FakeCredentials(kwargs['refresh_token'], rotate_to="new")
+        client_secrets = {"web": {"client_id": "client-id", "client_secret": "client-secret"}}
+        rotated = []
+        self.addCleanup(access_tokens.invalidate, "manager@example.com")
+
+        manager = CredentialsManager(
+            refresh_token="old", user_email="manager@example.com", client_secrets=client_secrets, on_rotated=rotated.append
+        )
+
+        self.assertEqual(manager.get_access_token(), "access-1")
+        self.assertEqual(mock_credentials.call_args.kwargs['client_id'], "client-id")
+        self.assertEqual(rotated, ["new"])
+        with self.assertRaises(ValueError):
+            CredentialsManager(refresh_token="old", user_email="manager@example.com")
+
+if __name__ == "__main__":
+    unittest.main()
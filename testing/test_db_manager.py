@@ -1,4 +1,6 @@
 import unittest
+from unittest.mock import MagicMock
+from sqlalchemy import pool
 import sys
 import os
 
@@ -6,6 +8,7 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.db_manager import DBManager
+from src import metrics
 
 class TestDBManagerUnit(unittest.TestCase):
     """Unit tests for DBManager methods."""
@@ -74,6 +77,25 @@ class TestDBManagerUnit(unittest.TestCase):
         self.cur.execute('DELETE FROM users WHERE email = %s;', (user_email,))
         self.con.commit()
 
+    def test_get_user_context(self):
+        """Test resolving the user context, its caching, and invalidation on update."""
+        user_email = "user_context@gmail.com"
+        self.db_manager.insert_new_user("ContextTest", user_email, "token_ctx", "history_ctx")
+
+        context = self.db_manager.get_user_context(user_email)
+        self.assertIsNotNone(context)
+        self.assertEqual(context.name, "ContextTest")
+        self.assertEqual(context.history_id, "history_ctx")
+        self.assertIs(self.db_manager.get_user_context(user_email), context) # served from the cache
+
+        self.db_manager.update_historyID(user_email, "history_ctx_2")
+        self.assertEqual(self.db_manager.get_user_context(user_email).history_id, "history_ctx_2")
+        self.assertIsNone(self.db_manager.get_user_context("missing_context@gmail.com"))
+
+        # Cleanup
+        self.cur.execute('DELETE FROM users WHERE email = %s;', (user_email,))
+        self.con.commit()
+
     def test_insert_document(self):
         """Test inserting a document using user_email."""
         user_email = "document_test@gmail.com"
@@ -142,23 +164,24 @@ class TestDBManagerUnit(unittest.TestCase):
         self.cur.execute('DELETE FROM users WHERE email = %s;', (user_email,))
         self.con.commit()
 
-    def test_get_all_users_for_watch(self):
-        """Test retrieving all users for the watch renewal."""
-        user1_email, user1_token = "watch_user1@example.com", "token_watch1"
-        user2_email, user2_token = "watch_user2@example.com", "token_watch2"
-        
-        self.db_manager.insert_new_user("WatchUser1", user1_email, user1_token, "hist_w1")
-        self.db_manager.insert_new_user("WatchUser2", user2_email, user2_token, "hist_w2")
-
-        result = self.db_manager.get_all_users_for_watch()
-        result_tuples = {tuple(row) for row in result}
-        
-        self.assertIn((user1_email, user1_token), result_tuples)
-        self.assertIn((user2_email, user2_token), result_tuples)
+class TestConnectionScopeUnit(unittest.TestCase):
+    """Unit tests for connection handling against a pool of fake connections, no database needed."""
 
-        # Cleanup
-        self.cur.execute('DELETE FROM users WHERE email = %s OR email = %s;', (user1_email, user2_email))
-        self.con.commit()
+    def setUp(self):
+        metrics.reset()
+        self.pool = pool.QueuePool(MagicMock, pool_size=1, max_overflow=0, timeout=1)
+        self.db_manager = DBManager.__new__(DBManager)
+        self.db_manager.mypool = self.pool
+
+    def test_failed_delete_returns_connection(self):
+        """delete_document returns its connection to the pool even when the statement fails."""
+        conn = self.pool.connect()
+        conn.dbapi_connection.cursor.return_value.execute.side_effect = Exception("statement timeout")
+        conn.close()
+
+        for _ in range(3):
+            self.assertFalse(self.db_manager.delete_document("1"))
+        self.assertEqual(self.pool.checkedout(), 0)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi.testclient import TestClient
+import base64
+import json
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_dependencies import import_router
+
+# Imported against stub shared clients when the real ones aren't loaded, the tests patch what they use
+main = import_router("src.main")
+documents = main.documents
+
+USER_EMAIL = "user@example.com"
+
+def encode(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+class TestGetDocumentsUnit(unittest.TestCase):
+    """Unit tests for /getDocuments pagination with the auth dependency and the database faked."""
+
+    def setUp(self):
+        self.page = [{"id": i, "name": f"Doc{i}", "content": f"content {i}"} for i in range(1, 4)]
+        self.db = MagicMock()
+        self.db.get_documents = AsyncMock(side_effect=lambda limit, **kwargs: self.page[:limit])
+        self.db.get_document_count = AsyncMock(return_value=len(self.page))
+        patcher = patch.object(documents, "async_db_manager", self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        main.app.dependency_overrides[documents.get_user_email] = lambda: USER_EMAIL
+        self.addCleanup(main.app.dependency_overrides.clear)
+        self.client = TestClient(main.app)
+
+    def test_cursor_round_trip(self):
+        """A cursor decodes to the name and id of the document it was made from, whatever the name holds."""
+        for name in ["Doc1", "", "naïve, \"quoted\" / name", "日本語"]:
+            self.assertEqual(documents._decode_cursor(documents._encode_cursor({"name": name, "id": 42})), (name, 42))
+
+    def test_next_cursor_continues_after_last_document(self):
+        """A full page returns a cursor for its last document, which the next request passes as after."""
+        first = self.client.get("/getDocuments", params={"limit": 2, "include_total": "true"}).json()
+        self.assertEqual([doc["id"] for doc in first["documents"]], [1, 2])
+        self.assertEqual(first["total"], 3)
+
+        self.client.get("/getDocuments", params={"limit": 2, "cursor": first["next_cursor"]})
+        self.assertEqual(self.db.get_documents.await_args.kwargs["after"], ("Doc2", 2))
+
+        # A short page is the last one
+        last = self.client.get("/getDocuments", params={"limit": 5}).json()
+        self.assertIsNone(last["next_cursor"])
+
+    def test_malformed_cursor_is_400(self):
+        """Cursors that don't decode to a [name, id] pair are rejected before querying."""
+        valid = documents._encode_cursor({"name": "Doc1", "id": 1})
+        for cursor in [
+            "not a cursor!",
+            valid[:-4],
+            valid[:5] + ("A" if valid[5] != "A" else "B") + valid[6:],
+            encode(["Doc1"]),
+            encode(["Doc1", "1"]),
+            encode([1, 1]),
+            encode({"name": "Doc1", "id": 1}),
+        ]:
+            response = self.client.get("/getDocuments", params={"cursor": cursor})
+            self.assertEqual(response.status_code, 400, cursor)
+            self.assertEqual(response.json(), {"Error": "Invalid cursor"})
+        self.db.get_documents.assert_not_awaited()
+
+    def test_page_size_clamped(self):
+        """limit is clamped to between 1 and MAX_PAGE_SIZE."""
+        for limit, expected in [(10_000, documents.MAX_PAGE_SIZE), (0, 1), (-5, 1), (7, 7)]:
+            self.client.get("/getDocuments", params={"limit": limit})
+            self.assertEqual(self.db.get_documents.await_args.kwargs["limit"], expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+import tempfile
+import sys
+import os
+import numpy as np
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.embedding_cache import EmbeddingCache
+
+class CountingModel:
+    """Stand-in for TextEmbedding that records every text it embeds."""
+    model_name = "counting-model"
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed(self, texts):
+        for text in texts:
+            self.embedded.append(text)
+            yield np.full(384, len(text), dtype=np.float32)
+
+class TestEmbeddingCacheUnit(unittest.TestCase):
+    """Unit tests for EmbeddingCache."""
+
+    def test_identical_texts_embedded_once(self):
+        """Repeated texts are served from the cache instead of the model."""
+        cache, model = EmbeddingCache(max_entries=10), CountingModel()
+
+        first = cache.embed(model, ["hello", "world"])
+        second = cache.embed(model, ["world", "hello", "new"])
+
+        self.assertEqual(model.embedded, ["hello", "world", "new"])
+        np.testing.assert_array_equal(first[0], second[1])
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 3)
+
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted once max_entries is exceeded."""
+        cache, model = EmbeddingCache(max_entries=2), CountingModel()
+
+        cache.embed(model, ["a", "b"])
+        cache.embed(model, ["a"])  # "b" is now least recently used
+        cache.embed(model, ["c"])
+        cache.embed(model, ["b"])
+
+        self.assertEqual(model.embedded, ["a", "b", "c", "b"])
+        self.assertEqual(cache.stats()["entries"], 2)
+
+    def test_disk_persistence(self):
+        """Embeddings written as float32 files are reused by a new cache instance."""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model = CountingModel()
+            original = EmbeddingCache(cache_dir=cache_dir).embed(model, ["persist me"])[0]
+
+            restarted = EmbeddingCache(cache_dir=cache_dir)
+            reloaded = restarted.embed(model, ["persist me"])[0]
+
+            self.assertEqual(model.embedded, ["persist me"])
+            self.assertEqual(reloaded.dtype, np.float32)
+            np.testing.assert_array_equal(original, reloaded)
+            self.assertEqual(restarted.stats()["disk_hits"], 1)
+
+if __name__ == "__main__":
+    unittest.main()
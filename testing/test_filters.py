@@ -0,0 +1,126 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src import metrics
+from src.filters import FilterCascade, HeaderFilter, PhraseFilter, CentroidFilter, EmailFilter
+
+class FakeEmail:
+    """Stand-in for mail.Email with the attributes the filters read."""
+
+    def __init__(self, body: str = "", headers: dict = None):
+        self.headers = {name.lower(): value for name, value in (headers or {}).items()}
+        self.body = body
+        self.messageID = "msg"
+
+    def get_header(self, name: str, default: str = None) -> str | None:
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def subject(self) -> str:
+        return self.get_header('subject', '')
+
+    @property
+    def sender(self) -> str:
+        return self.get_header('from', '')
+
+class FailingFilter(EmailFilter):
+    name = "failing"
+
+    def rejects(self, email) -> bool:
+        raise RuntimeError("model unavailable")
+
+class TestFiltersUnit(unittest.TestCase):
+    """Unit tests for the email filter cascade."""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_header_filter(self):
+        """Bulk and automated headers are rejected, a personal email is not."""
+        headers = HeaderFilter()
+        personal = {'From': 'Bob <bob@example.com>', 'Subject': 'Lunch?'}
+        self.assertFalse(headers.rejects(FakeEmail(headers=personal)))
+        self.assertFalse(headers.rejects(FakeEmail(headers={**personal, 'Auto-Submitted': 'no'})))
+
+        for extra in [
+            {'List-Unsubscribe': '<mailto:leave@example.com>'},
+            {'Precedence': 'Bulk'},
+            {'Auto-Submitted': 'auto-generated'},
+            {'From': 'Shop <no-reply@shop.example.com>'},
+            {'From': 'donotreply@bank.example.com'},
+        ]:
+            self.assertTrue(headers.rejects(FakeEmail(headers={**personal, **extra})), extra)
+
+    def test_phrase_filter(self):
+        """Phrases match case-insensitively anywhere in the body."""
+        phrases = PhraseFilter()
+        self.assertEqual(phrases.match("Click here to UNSUBSCRIBE."), "unsubscribe")
+        self.assertEqual(phrases.match("Our Special Offer ends today"), "special offer")
+        self.assertIsNone(phrases.match("Can we move the meeting to Tuesday?"))
+
+    def test_phrase_filter_overlapping_phrases(self):
+        """The phrase occurring earliest is returned, and the longest one when phrases share a start."""
+        phrases = PhraseFilter(["sale", "sales event", "event", "offer", "special offer"])
+        self.assertEqual(phrases.match("Our SALES EVENT starts now"), "sales event")
+        self.assertEqual(phrases.match("A special offer for you"), "special offer")
+        self.assertEqual(phrases.match("An event with an offer"), "event")
+        self.assertEqual(phrases.match("Warehouse sale, one day only"), "sale")
+        self.assertEqual(PhraseFilter(["a.b"]).match("axb a.b"), "a.b") # phrases are literal, not patterns
+        self.assertIsNone(PhraseFilter([]).match("anything"))
+
+    def test_cascade_stops_at_first_rejection(self):
+        """Later stages only see what earlier stages let through, and each stage is counted."""
+        embedded = []
+
+        def embed(texts):
+            embedded.extend(texts)
+            return [np.array([1.0, 0.0], dtype=np.float32) for _ in texts]
+
+        cascade = FilterCascade([HeaderFilter(), PhraseFilter(), CentroidFilter(embed, np.array([[1.0, 0.0]]))])
+        bulk = FakeEmail(body="hello", headers={'Precedence': 'bulk'})
+        promo = FakeEmail(body="Big SALE today")
+        personal = FakeEmail(body="Are you free tomorrow?", headers={'Subject': 'Hi '})
+
+        self.assertEqual(cascade.evaluate(bulk), "headers")
+        self.assertEqual(cascade.evaluate(promo), "phrases")
+        self.assertIsNone(cascade.evaluate(personal, blocking=False))
+        self.assertEqual(embedded, [])
+        self.assertEqual(cascade.evaluate(personal, blocking=True), "centroid")
+        self.assertEqual(embedded, ["Hi Are you free tomorrow?"])
+
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["filters.headers.checked"], 3)
+        self.assertEqual(counters["filters.headers.rejected"], 1)
+        self.assertEqual(counters["filters.phrases.checked"], 2)
+        self.assertEqual(counters["filters.phrases.rejected"], 1)
+        self.assertEqual(counters["filters.centroid.rejected"], 1)
+
+    def test_header_stages_run_without_body(self):
+        """needs_body=False runs only the header stages, for emails fetched as metadata."""
+        cascade = FilterCascade([HeaderFilter(), PhraseFilter()])
+        metadata_only = FakeEmail(headers={'From': 'alice@example.com'})
+        self.assertIsNone(cascade.evaluate(metadata_only, needs_body=False))
+        self.assertEqual(cascade.evaluate(FakeEmail(headers={'Precedence': 'list'}), needs_body=False), "headers")
+        self.assertNotIn("filters.phrases.checked", metrics.snapshot()["counters"])
+
+    def test_failing_stage_lets_email_through(self):
+        """A stage that raises does not drop the email."""
+        cascade = FilterCascade([FailingFilter(), PhraseFilter()])
+        self.assertIsNone(cascade.evaluate(FakeEmail(body="See you at 5")))
+        self.assertEqual(metrics.snapshot()["counters"]["filters.failing.error"], 1)
+
+    def test_centroid_threshold(self):
+        """Only emails at or above the similarity threshold are rejected."""
+        embed = lambda texts: [np.array([1.0, 1.0]) for _ in texts]
+        centroids = np.array([[1.0, 0.0], [0.0, 2.0]])
+        self.assertAlmostEqual(CentroidFilter(embed, centroids).similarity(FakeEmail()), 0.7071, places=3)
+        self.assertFalse(CentroidFilter(embed, centroids, threshold=0.8).rejects(FakeEmail()))
+        self.assertTrue(CentroidFilter(embed, centroids, threshold=0.7).rejects(FakeEmail()))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import threading
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.oauth2.credentials import Credentials
+from src.gmail_service import GmailServiceCache
+
+class TestGmailServiceCacheUnit(unittest.TestCase):
+    """Unit tests for GmailServiceCache. No network calls are made."""
+
+    def test_one_service_per_user_across_threads(self):
+        """Threads share a user's service, and each sends with the credentials it bound."""
+        cache = GmailServiceCache()
+        barrier = threading.Barrier(4)
+        seen = {}
+
+        def use(i):
+            creds = Credentials(token=f"token-{i}")
+            service = cache.get("user@example.com", creds)
+            # Every thread binds before any of them reads, so a shared transport would show the last token
+            barrier.wait()
+            seen[i] = (service, service._http.credentials.token)
+
+        cache.get("user@example.com", Credentials(token="warm"))
+        threads = [threading.Thread(target=use, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len({id(service) for service, _ in seen.values()}), 1)
+        self.assertEqual({i: token for i, (_, token) in seen.items()}, {i: f"token-{i}" for i in range(4)})
+
+    def test_users_and_invalidation(self):
+        """Users get separate services, and an invalidated user's service is rebuilt."""
+        cache = GmailServiceCache()
+        creds = Credentials(token="token")
+
+        alice = cache.get("alice@example.com", creds)
+        self.assertIs(cache.get("alice@example.com", creds), alice)
+        self.assertIsNot(cache.get("bob@example.com", creds), alice)
+
+        cache.invalidate("alice@example.com")
+        self.assertIsNot(cache.get("alice@example.com", creds), alice)
+
+    def test_lru_eviction(self):
+        """The least recently used user is evicted once max_entries is exceeded."""
+        cache = GmailServiceCache(max_entries=2)
+        creds = Credentials(token="token")
+
+        first = cache.get("a@example.com", creds)
+        cache.get("b@example.com", creds)
+        cache.get("c@example.com", creds)
+
+        self.assertIsNot(cache.get("a@example.com", creds), first)
+
+if __name__ == "__main__":
+    unittest.main()
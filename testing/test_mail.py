@@ -15,6 +15,11 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from unittest.mock import patch
+import httplib2
+
+from src.mail import _fetch_messages
+from src import metrics
 
 # The scopes needed for the operations in mail.py
 SCOPES = ["https://mail.google.com/"]
@@ -299,6 +304,80 @@ class TestMailIntegration(unittest.TestCase):
         self.cur.close()
 
 
+class FakeBatch:
+    """Stand-in for a Gmail batch request, answers each added request from the fake service's responses."""
+
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.ids = []
+
+    def add(self, request, request_id):
+        self.ids.append(request_id)
+
+    def execute(self):
+        self.service.batches.append(self.ids)
+        for msg_id in self.ids:
+            responses = self.service.responses.get(msg_id)
+            status = responses.pop(0) if responses else 200
+            if status == 200:
+                self.callback(msg_id, {"id": msg_id}, None)
+            else:
+                error = HttpError(httplib2.Response({"status": status}), b"{}")
+                self.callback(msg_id, None, error)
+
+class FakeGmailService:
+    """Stand-in for a Gmail service, responses maps message IDs to the statuses of successive fetches."""
+
+    def __init__(self, responses: dict[str, list[int]]):
+        self.responses = responses
+        self.batches = []
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(self, callback)
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def get(self, **kwargs):
+        return kwargs
+
+class TestFetchMessagesUnit(unittest.TestCase):
+    """Unit tests for batched message fetching against a fake Gmail service, no network needed."""
+
+    def setUp(self):
+        metrics.reset()
+
+    @patch("src.mail.time.sleep")
+    def test_throttled_message_is_rebatched(self, sleep):
+        """A message throttled with 429 inside a batch is fetched again in a new batch after a backoff."""
+        service = FakeGmailService({"b": [429]})
+
+        messages, failed_ids = _fetch_messages(service, ["a", "b", "c"])
+
+        self.assertEqual([message["id"] for message in messages], ["a", "b", "c"])
+        self.assertEqual(failed_ids, [])
+        self.assertEqual(service.batches, [["a", "b", "c"], ["b"]])
+        sleep.assert_called_once()
+        self.assertEqual(metrics.snapshot()["counters"]["retry.gmail_batch.retries"], 1)
+
+    @patch("src.mail.time.sleep")
+    def test_failures_reported_after_retries(self, sleep):
+        """Fatal errors fail at once, retryable ones only after the retries run out, and 404s are skipped."""
+        service = FakeGmailService({"a": [503] * 10, "b": [403], "c": [404]})
+
+        messages, failed_ids = _fetch_messages(service, ["a", "b", "c", "d"])
+
+        self.assertEqual([message["id"] for message in messages], ["d"])
+        self.assertEqual(failed_ids, ["b", "a"])
+        self.assertEqual(service.batches[1:], [["a"]] * GMAIL_BATCH_MAX_RETRIES)
+        self.assertEqual(sleep.call_count, GMAIL_BATCH_MAX_RETRIES)
+        self.assertEqual(metrics.snapshot()["counters"]["retry.gmail_batch.exhausted"], 1)
+
+
 if __name__ == "__main__":
     # To use a method from a unittest.TestCase class outside of a formal
     # test run, you must manually call the class's setup method.
@@ -0,0 +1,46 @@
+import unittest
+import asyncio
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.pipeline import TokenBucket
+
+class TestTokenBucketUnit(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for the TokenBucket rate limiter."""
+
+    async def test_fractional_rate(self):
+        """A rate below one per second still hands out whole tokens, one per 1 / rate seconds."""
+        bucket = TokenBucket(0.5)
+        self.assertEqual(bucket.capacity, 1.0)
+        await asyncio.wait_for(bucket.acquire(), timeout=1)
+
+        waiting = asyncio.create_task(bucket.acquire())
+        await asyncio.sleep(0.05)
+        self.assertFalse(waiting.done())
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+
+        # Two seconds of refill at 0.5 per second is one token
+        bucket._updated -= 2
+        await asyncio.wait_for(bucket.acquire(), timeout=1)
+
+    async def test_burst_up_to_capacity(self):
+        """Up to capacity calls go through at once, the next waits for a refill."""
+        bucket = TokenBucket(10, capacity=3)
+        for _ in range(3):
+            await asyncio.wait_for(bucket.acquire(), timeout=0.05)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(bucket.acquire(), timeout=0.01)
+
+    def test_rejects_non_positive_rate(self):
+        """A zero or negative rate would never refill, so it is rejected up front."""
+        for rate in [0, -1]:
+            with self.assertRaises(ValueError):
+                TokenBucket(rate)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from types import SimpleNamespace
+import numpy as np
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.filters import FilterCascade, HeaderFilter, PhraseFilter
+from src.mail import Email
+from src import metrics
+from stub_dependencies import import_router
+
+# Imported against stub shared clients when the real ones aren't loaded, the tests patch what they use
+core = import_router("src.routers.core")
+_process_emails_for_user = core._process_emails_for_user
+_get_credentials = core._get_credentials
+_completed_history_id = core._completed_history_id
+_dead_letter = core._dead_letter
+MAX_DRAFT_ATTEMPTS = core.MAX_DRAFT_ATTEMPTS
+
+USER_EMAIL = "user@example.com"
+
+def make_email(message_id: str, body: str = "Can we move the meeting to Tuesday?") -> Email:
+    headers = [{"name": "Subject", "value": "Meeting"}, {"name": "From", "value": "alice@example.com"}]
+    return Email(headers=headers, body=body, messageID=message_id, historyID="0")
+
+def claim(attempts: int = 1, draft_id: str = None, claimed: bool = True) -> dict:
+    return {"draft_id": draft_id, "doc_ids": None, "claimed": claimed, "attempts": attempts}
+
+class TestProcessEmailsUnit(unittest.IsolatedAsyncioTestCase):
+    """
+    Unit tests for the email processing flow with the database, Gmail and Gemini stubbed out.
+    added maps each new message to the history record that added it, claims the ledger entry
+    each message's claim returns, and failing the messages whose generation raises.
+    """
+
+    def setUp(self):
+        metrics.reset()
+        self.added = {"m1": "101", "m2": "102", "m3": "103"}
+        self.claims = {message_id: claim() for message_id in self.added}
+        self.failing = set()
+
+        self.db = MagicMock()
+        self.db.get_processing_state = AsyncMock(
+            return_value=SimpleNamespace(encrypted_refresh_token="token", history_id="100")
+        )
+        self.db.claim_processed_message = AsyncMock(side_effect=lambda user_email, message_id: self.claims[message_id])
+        self.db.record_draft = AsyncMock(return_value=True)
+        self.db.record_retrieval = AsyncMock(return_value=True)
+        self.db.advance_history_id = AsyncMock(return_value=True)
+        self.db.embed = AsyncMock(side_effect=lambda texts: [np.zeros(384, dtype=np.float32) for _ in texts])
+        self.db.get_top_k_results = AsyncMock(return_value=[{"id": 1, "name": "Doc", "content": "context"}])
+
+        async def generate(email, context, client):
+            if email.messageID in self.failing:
+                raise RuntimeError("generation failed")
+            return f"Reply to {email.messageID}"
+
+        self.generate = AsyncMock(side_effect=generate)
+        self.publish = MagicMock(side_effect=lambda creds, body, email, user_email=None: {"id": f"draft-{email.messageID}"})
+        for name, value in {
+            "async_db_manager": self.db,
+            "CredentialsManager": MagicMock(),
+            "email_filters": FilterCascade([HeaderFilter(), PhraseFilter()]),
+            "get_new_message_ids": MagicMock(side_effect=lambda *args, **kwargs: dict(self.added)),
+            "fetch_email_metadata": MagicMock(
+                side_effect=lambda creds, ids, **kwargs: ([make_email(message_id, body="") for message_id in ids], [])
+            ),
+            "fetch_emails": MagicMock(side_effect=lambda creds, ids, **kwargs: ([make_email(message_id) for message_id in ids], [])),
+            "generate_draft_async": self.generate,
+            "publish_reply_draft": self.publish,
+        }.items():
+            patcher = patch.object(core, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def drafted(self) -> list[str]:
+        return [call.args[2].messageID for call in self.publish.call_args_list]
+
+    async def test_all_drafted_advances_marker_to_last_message(self):
+        """Every message drafted moves the marker to the record that added the last one."""
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "103")
+        self.assertEqual(sorted(self.drafted()), ["m1", "m2", "m3"])
+        self.db.record_draft.assert_any_await(USER_EMAIL, "m2", "draft-m2")
+
+    async def test_marker_held_at_first_unhandled_message(self):
+        """A failed draft holds the marker before its message, later messages are still drafted."""
+        self.failing = {"m2"}
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "101")
+        self.assertEqual(sorted(self.drafted()), ["m1", "m3"])
+        self.db.record_draft.assert_any_await(USER_EMAIL, "m2", None)
+        self.assertNotIn("ledger.dead_lettered", metrics.snapshot()["counters"])
+
+    async def test_marker_not_advanced_when_first_message_fails(self):
+        """Nothing is advanced when the oldest message is unhandled, and a failed fetch counts as unhandled."""
+        core.fetch_emails.side_effect = lambda creds, ids, **kwargs: ([make_email(message_id) for message_id in ids[1:]], ids[:1])
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_not_awaited()
+        self.assertEqual(sorted(self.drafted()), ["m2", "m3"])
+
+    async def test_dead_letter_after_max_attempts(self):
+        """The last allowed attempt failing dead-letters the message, so the marker moves past it."""
+        self.failing = {"m2"}
+        self.claims["m2"] = claim(attempts=MAX_DRAFT_ATTEMPTS)
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "103")
+        self.db.record_draft.assert_any_await(USER_EMAIL, "m2", None)
+        self.assertEqual(metrics.snapshot()["counters"]["ledger.dead_lettered"], 1)
+
+    async def test_attempts_past_max_from_crashed_run_dead_letter_without_drafting(self):
+        """A claim already past MAX_DRAFT_ATTEMPTS, left by runs that crashed mid-draft, is dead-lettered at once."""
+        self.claims["m2"] = claim(attempts=MAX_DRAFT_ATTEMPTS + 1)
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "103")
+        self.assertEqual(sorted(self.drafted()), ["m1", "m3"])
+        self.assertEqual([call.args[0].messageID for call in self.generate.await_args_list].count("m2"), 0)
+        self.assertNotIn("m2", [call.args[1] for call in self.db.record_draft.await_args_list])
+        self.assertEqual(metrics.snapshot()["counters"]["ledger.dead_lettered"], 1)
+
+    async def test_message_with_draft_is_skipped(self):
+        """A redelivered message that already has a draft is not drafted again and counts as handled."""
+        self.claims["m1"] = claim(draft_id="draft-old", claimed=False)
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "103")
+        self.assertEqual(sorted(self.drafted()), ["m2", "m3"])
+        self.assertEqual(metrics.snapshot()["counters"]["ledger.duplicate_draft_skipped"], 1)
+        self.assertNotIn("ledger.dead_lettered", metrics.snapshot()["counters"])
+
+    async def test_message_claimed_elsewhere_holds_marker(self):
+        """A message another delivery is drafting holds the marker, that delivery advances it."""
+        self.claims["m2"] = claim(claimed=False)
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "101")
+        self.assertEqual(metrics.snapshot()["counters"]["ledger.claimed_elsewhere"], 1)
+
+    async def test_filtered_messages_count_as_handled(self):
+        """Messages rejected by the filters are never claimed or drafted, and don't hold the marker."""
+        core.fetch_emails.side_effect = lambda creds, ids, **kwargs: (
+            [make_email(message_id, body="Click to unsubscribe" if message_id == "m1" else "Hello") for message_id in ids], []
+        )
+
+        await _process_emails_for_user(USER_EMAIL)
+
+        self.db.advance_history_id.assert_awaited_once_with(USER_EMAIL, "103")
+        self.assertNotIn("m1", [call.args[1] for call in self.db.claim_processed_message.await_args_list])
+
+class TestGetCredentialsUnit(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for building a user's credentials in the auth stage."""
+
+    async def test_rotated_refresh_token_is_saved(self):
+        """A refresh token rotated on the auth worker thread is saved through the async db manager."""
+        db = MagicMock()
+        db.update_refresh_token = AsyncMock(return_value=True)
+
+        def credentials_manager(refresh_token, user_email, client_secrets, on_rotated):
+            on_rotated("rotated-token")
+            return SimpleNamespace(creds="creds")
+
+        with patch.object(core, "async_db_manager", db), patch.object(core, "CredentialsManager", credentials_manager):
+            self.assertEqual(await _get_credentials("token", USER_EMAIL), "creds")
+
+        db.update_refresh_token.assert_awaited_once_with("rotated-token", USER_EMAIL)
+
+class TestProcessingHelpersUnit(unittest.TestCase):
+    """Unit tests for the history marker and dead-letter helpers."""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_completed_history_id(self):
+        """The marker is the last history ID before the first failure, None when the first one failed."""
+        history_ids = ["101", "102", "103"]
+        self.assertEqual(_completed_history_id(history_ids, [True, True, True]), "103")
+        self.assertEqual(_completed_history_id(history_ids, [True, False, True]), "101")
+        self.assertIsNone(_completed_history_id(history_ids, [False, True, True]))
+        self.assertIsNone(_completed_history_id([], []))
+
+    def test_dead_letter_counts(self):
+        """Each dead-lettered message is counted once."""
+        _dead_letter(USER_EMAIL, make_email("m1"), MAX_DRAFT_ATTEMPTS)
+        _dead_letter(USER_EMAIL, make_email("m2"), MAX_DRAFT_ATTEMPTS)
+        self.assertEqual(metrics.snapshot()["counters"]["ledger.dead_lettered"], 2)
+
+if __name__ == "__main__":
+    unittest.main()
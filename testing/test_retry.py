@@ -0,0 +1,106 @@
+import unittest
+from unittest.mock import patch, AsyncMock
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.retry import with_retries, is_retryable, get_retry_after
+from src import metrics
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+class FakeAPIError(Exception):
+    """Mimics google.genai.errors.APIError, which carries .code and .response."""
+    def __init__(self, code: int, headers: dict = None):
+        super().__init__(f"{code} error")
+        self.code = code
+        self.response = FakeResponse(code, headers)
+
+class TestRetryUnit(unittest.TestCase):
+    """Unit tests for the sync retry path and error classification."""
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_classification(self):
+        """Throttling, 5xx and network errors are retryable, other client errors are fatal."""
+        self.assertTrue(is_retryable(FakeAPIError(503)))
+        self.assertTrue(is_retryable(FakeAPIError(429)))
+        self.assertTrue(is_retryable(ConnectionResetError()))
+        self.assertFalse(is_retryable(FakeAPIError(400)))
+        self.assertFalse(is_retryable(ValueError("bad input")))
+
+    @patch('src.retry.time.sleep')
+    def test_retries_then_succeeds(self, mock_sleep):
+        """A transient 503 is retried and the eventual result is returned."""
+        calls = iter([FakeAPIError(503), FakeAPIError(503), "draft"])
+        def flaky():
+            result = next(calls)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(with_retries(flaky, name="test")(), "draft")
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(metrics.snapshot()["counters"]["retry.test.retries"], 2)
+
+    @patch('src.retry.time.sleep')
+    def test_fatal_error_not_retried(self, mock_sleep):
+        """A 400 is raised immediately without sleeping."""
+        def bad_request():
+            raise FakeAPIError(400)
+
+        self.assertRaises(FakeAPIError, with_retries(bad_request, name="test"))
+        mock_sleep.assert_not_called()
+        self.assertEqual(metrics.snapshot()["counters"]["retry.test.fatal"], 1)
+
+    @patch('src.retry.time.sleep')
+    def test_retry_after_is_honored(self, mock_sleep):
+        """The Retry-After header replaces the computed backoff delay."""
+        self.assertEqual(get_retry_after(FakeAPIError(429, {"Retry-After": "7"})), 7.0)
+
+        calls = iter([FakeAPIError(429, {"Retry-After": "7"}), "ok"])
+        def throttled():
+            result = next(calls)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        with_retries(throttled, name="test")()
+        mock_sleep.assert_called_once_with(7.0)
+
+    @patch('src.retry.time.sleep')
+    def test_max_retries(self, mock_sleep):
+        """Retries stop after max_retries attempts."""
+        def always_unavailable():
+            raise FakeAPIError(503)
+
+        self.assertRaises(FakeAPIError, with_retries(always_unavailable, name="test", max_retries=3))
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertEqual(metrics.snapshot()["counters"]["retry.test.exhausted"], 1)
+
+class TestAsyncRetryUnit(unittest.IsolatedAsyncioTestCase):
+    """Unit tests for the async retry path."""
+
+    @patch('src.retry.asyncio.sleep', new_callable=AsyncMock)
+    @patch('src.retry.time.sleep')
+    async def test_async_retry_uses_asyncio_sleep(self, mock_time_sleep, mock_async_sleep):
+        """Async callables back off with asyncio.sleep, never time.sleep."""
+        calls = iter([FakeAPIError(500), "draft"])
+        async def flaky():
+            result = next(calls)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.assertEqual(await with_retries(flaky, name="test")(), "draft")
+        mock_async_sleep.assert_awaited_once()
+        mock_time_sleep.assert_not_called()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+import struct
+import sys
+import os
+import numpy as np
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.vector_codec import encode_vector, decode_vector, to_vector_literal
+
+class TestVectorCodecUnit(unittest.TestCase):
+    """Unit tests for the pgvector wire format helpers."""
+
+    def test_binary_layout(self):
+        """Binary vectors are a dimension count, an unused field, then big-endian float4 values."""
+        data = encode_vector(np.array([1.0, -2.5], dtype=np.float32))
+        self.assertEqual(data, struct.pack('>HHff', 2, 0, 1.0, -2.5))
+
+    def test_binary_round_trip(self):
+        """Decoding an encoded embedding returns the same float32 values."""
+        embedding = np.random.default_rng(0).standard_normal(384).astype(np.float32)
+        decoded = decode_vector(encode_vector(embedding))
+        self.assertEqual(decoded.dtype, np.float32)
+        np.testing.assert_array_equal(decoded, embedding)
+
+    def test_encoded_vector_passes_through(self):
+        """Encoding already encoded bytes returns them unchanged, so vector[] parameters can be pre-encoded."""
+        data = encode_vector(np.array([1.0, -2.5], dtype=np.float32))
+        self.assertIs(encode_vector(data), data)
+
+    def test_text_literal_round_trip(self):
+        """The text literal is parsed back to exactly the same float32 values, including tiny and huge ones."""
+        embedding = np.random.default_rng(0).standard_normal(384).astype(np.float32)
+        embedding[:3] = [1e-38, -3.4e38, 0.0]
+        literal = to_vector_literal(embedding)
+        parsed = np.array([float(value) for value in literal[1:-1].split(",")], dtype=np.float32)
+        np.testing.assert_array_equal(parsed, embedding)
+        self.assertLess(len(literal), len(str(embedding.tolist())))
+
+if __name__ == "__main__":
+    unittest.main()
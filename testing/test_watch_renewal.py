@@ -0,0 +1,145 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+from datetime import datetime, timezone
+import asyncio
+import sys
+import os
+
+# Add the project root to the Python path to allow importing from 'src'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.pipeline import TokenBucket
+from src import metrics
+from stub_dependencies import import_router
+
+# Imported against stub shared clients when the real ones aren't loaded, the tests patch what they use
+core = import_router("src.routers.core")
+
+EXPIRATION_MS = 1767225600000 # 2026-01-01T00:00:00Z
+
+class FakeUserSource:
+    """Stand-in for AsyncDBManager.iter_users_for_watch, yields num_users users then optionally raises."""
+
+    def __init__(self, num_users: int, error: Exception = None):
+        self.num_users = num_users
+        self.error = error
+        self.yielded = 0
+        self.expires_before = []
+
+    async def __call__(self, expires_before=None):
+        self.expires_before.append(expires_before)
+        for i in range(self.num_users):
+            self.yielded += 1
+            yield f"user{i}@example.com", f"token{i}"
+        if self.error:
+            raise self.error
+
+class TestRenewWatchesUnit(unittest.IsolatedAsyncioTestCase):
+    """
+    Unit tests for the concurrent watch renewal with the database, credentials and watch() call faked.
+    failing holds the users whose watch() call raises.
+    """
+
+    def setUp(self):
+        metrics.reset()
+        self.failing = set()
+        self.db = MagicMock()
+        self.db.record_watch_renewal = AsyncMock(return_value=True)
+
+        def start_watch(creds, user_email):
+            if user_email in self.failing:
+                raise RuntimeError("watch failed")
+            return {"historyId": "1", "expiration": str(EXPIRATION_MS)}
+
+        self.start_watch = MagicMock(side_effect=start_watch)
+        for name, value in {
+            "async_db_manager": self.db,
+            "_get_credentials": AsyncMock(return_value="creds"),
+            "_start_gmail_watch": self.start_watch,
+        }.items():
+            patcher = patch.object(core, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def use_users(self, source: FakeUserSource) -> FakeUserSource:
+        self.db.iter_users_for_watch = source
+        return source
+
+    async def collect(self, **kwargs) -> list[dict]:
+        return [result async for result in core._renew_all_user_watches(rate_per_second=1000, **kwargs)]
+
+    async def test_results_streamed_for_every_user(self):
+        """Every due user is renewed once and its expiration recorded, results are yielded as they complete."""
+        source = self.use_users(FakeUserSource(25))
+
+        results = await self.collect(workers=4)
+
+        self.assertEqual(sorted(result["email"] for result in results), sorted(f"user{i}@example.com" for i in range(25)))
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(results[0]["expires_at"], "2026-01-01T00:00:00+00:00")
+        self.assertEqual(self.db.record_watch_renewal.await_count, 25)
+        self.assertEqual(metrics.snapshot()["counters"]["watch_renewal.renewed"], 25)
+        self.assertIsNotNone(source.expires_before[0]) # only due users
+
+    async def test_force_renews_everyone(self):
+        """force reads all users instead of the ones due within the renewal window."""
+        source = self.use_users(FakeUserSource(3))
+
+        await self.collect(force=True, workers=2)
+
+        self.assertEqual(source.expires_before, [None])
+
+    async def test_user_failures_are_reported_as_results(self):
+        """A failed watch() call, a missing refresh token or an unrecorded expiration fail that user only."""
+        self.use_users(FakeUserSource(6))
+        self.failing = {"user1@example.com"}
+        self.db.record_watch_renewal.side_effect = lambda user_email, expires_at: user_email != "user2@example.com"
+
+        results = {result["email"]: result for result in await self.collect(workers=3)}
+
+        self.assertEqual(results["user1@example.com"], {"email": "user1@example.com", "success": False, "error": "watch failed"})
+        self.assertFalse(results["user2@example.com"]["success"])
+        self.assertEqual(sum(result["success"] for result in results.values()), 4)
+        self.assertEqual(metrics.snapshot()["counters"]["watch_renewal.failed"], 2)
+
+        no_token = await core._renew_user_watch("user@example.com", None, TokenBucket(1000))
+        self.assertEqual(no_token, {"email": "user@example.com", "success": False, "error": "Missing refresh token."})
+
+    async def test_feed_error_raised_after_results(self):
+        """A failure reading users is raised as RuntimeError once the users already read are renewed."""
+        self.use_users(FakeUserSource(5, error=OSError("connection lost")))
+
+        results = []
+        with self.assertRaises(RuntimeError) as raised:
+            async for result in core._renew_all_user_watches(workers=2, rate_per_second=1000):
+                results.append(result)
+
+        self.assertEqual(len(results), 5)
+        self.assertIsInstance(raised.exception.__cause__, OSError)
+
+    async def test_early_close_stops_the_run(self):
+        """Closing the stream mid-run, e.g. a disconnected client, returns promptly and leaves no tasks behind."""
+        source = self.use_users(FakeUserSource(1000))
+        renewals = core._renew_all_user_watches(workers=4, rate_per_second=1000)
+
+        for _ in range(3):
+            await renewals.__anext__()
+        await asyncio.wait_for(renewals.aclose(), timeout=3)
+
+        self.assertLess(source.yielded, 1000)
+        self.assertEqual([task for task in asyncio.all_tasks() if task is not asyncio.current_task()], [])
+
+class TestWatchExpirationUnit(unittest.TestCase):
+    """Unit tests for reading the expiration of a watch() response."""
+
+    def test_watch_expiration(self):
+        """The expiration is epoch milliseconds, a missing or malformed one is None."""
+        self.assertEqual(
+            core._watch_expiration({"expiration": str(EXPIRATION_MS)}), datetime(2026, 1, 1, tzinfo=timezone.utc)
+        )
+        self.assertEqual(core._watch_expiration({"expiration": EXPIRATION_MS + 1500}).microsecond, 500000)
+        for response in [{}, {"expiration": None}, {"expiration": "soon"}, None]:
+            self.assertIsNone(core._watch_expiration(response), response)
+
+if __name__ == "__main__":
+    unittest.main()